@@ -1,9 +1,69 @@
 # Originally from http://djangosnippets.org/snippets/243/
 
+import hmac
 import base64
+import hashlib
 
+from django.conf import settings
+from django.core.cache import get_cache
 from django.http import HttpResponse
 from django.contrib.auth import authenticate, login
+from django.contrib.auth.models import User
+from django.utils.crypto import constant_time_compare
+from rest_framework.authtoken.models import Token
+
+#############################################################################
+#
+def get_credentials_cache_key(authorization):
+    """
+    Cache key of verified 'Authorization' header. Keyed digest of it,
+    so neither credentials nor a plain hash of them are stored in cache.
+    """
+    digest = hmac.new(settings.SECRET_KEY, authorization, hashlib.sha256).hexdigest()
+    return 'api_auth_%s' % digest
+
+def get_password_digest(user):
+    """Keyed digest of user password hash, to detect password changes without caching the hash itself"""
+    return hmac.new(settings.SECRET_KEY, user.password, hashlib.sha256).hexdigest()
+
+def basicauth_user(authorization, credentials):
+    """
+    Returns user authenticated with basic auth credentials or None
+    and if credentials were verified now, rather then taken from cache.
+
+    Verified credentials are cached for settings.API_AUTH_CACHE_TIMEOUT seconds,
+    so repeated requests skip password hashing. Cached verification is dropped
+    once the user password changes.
+    """
+    cache = get_cache('core')
+    key = get_credentials_cache_key(authorization)
+    cached = cache.get(key)
+    if cached is not None:
+        user_pk, backend, password_digest = cached
+        try:
+            user = User.objects.get(pk=user_pk)
+        except User.DoesNotExist:
+            user = None
+        if user is not None and constant_time_compare(get_password_digest(user), password_digest):
+            user.backend = backend
+            return user, False
+        cache.delete(key)
+    try:
+        uname, passwd = base64.b64decode(credentials).split(':', 1)
+    except (TypeError, ValueError):
+        return None, True
+    user = authenticate(username=uname, password=passwd)
+    if user is not None:
+        timeout = getattr(settings, 'API_AUTH_CACHE_TIMEOUT', 60)
+        cache.set(key, (user.pk, user.backend, get_password_digest(user)), timeout)
+    return user, True
+
+def token_user(key):
+    """Returns user of API token or None"""
+    try:
+        return Token.objects.select_related('user').get(key=key).user
+    except Token.DoesNotExist:
+        return None
 
 #############################################################################
 #
@@ -22,18 +82,24 @@ def view_or_basicauth(view, request, test_func, realm = "", *args, **kwargs):
     # They are not logged in. See if they provided login credentials
     #
     if 'HTTP_AUTHORIZATION' in request.META:
-        auth = request.META['HTTP_AUTHORIZATION'].split()
+        authorization = request.META['HTTP_AUTHORIZATION']
+        auth = authorization.split()
         if len(auth) == 2:
-            # NOTE: We are only support basic authentication for now.
+            # NOTE: We are supporting basic and (optional) token authentication.
             #
+            user, verified = None, False
             if auth[0].lower() == "basic":
-                uname, passwd = base64.b64decode(auth[1]).split(':')
-                user = authenticate(username=uname, password=passwd)
-                if user is not None:
-                    if user.is_active:
+                user, verified = basicauth_user(authorization, auth[1])
+            elif auth[0].lower() == "token" and getattr(settings, 'API_TOKEN_AUTHENTICATION', False):
+                user = token_user(auth[1])
+            if user is not None:
+                if user.is_active:
+                    if verified:
+                        # Requests authenticated from cache or by token do not
+                        # start a new session each time.
                         login(request, user)
-                        request.user = user
-                        return view(request, *args, **kwargs)
+                    request.user = user
+                    return view(request, *args, **kwargs)
 
     # Either they did not provide an authorization header or
     # something in the authorization attempt failed. Send a 401
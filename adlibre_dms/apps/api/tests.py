@@ -7,18 +7,33 @@ License: See LICENSE for license information
 """
 import json
 import os
+import re
+import base64
+import tarfile
 import tempfile
+import zipfile
 
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
 from django.test.client import encode_multipart
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+from couchdbkit.exceptions import BulkSaveError
 
 from dms_plugins.models import DoccodePluginMapping
+from dms_plugins.workers.transfer.thumbnails import THUMBNAILS_QUEUE, generate_thumbnail_job
 from dms_plugins.workers.validators.hashcode import HashCodeWorker
 
 from adlibre.dms.base_test import DMSTestCase
+from api.decorators.auth import get_credentials_cache_key
+from core.jobs import get_job_queue
 from core.models import CoreConfiguration
 from core.models import DocumentTypeRuleManager
+from core.uploads import process_upload_job
+from dmscouch.models import CouchDocument
 
 # TODO: Test self.rules, self.rules_missing, self.documents_missing
 # TODO: Test with and without correct permissions.
@@ -59,6 +74,9 @@ class APITest(DMSTestCase):
         self.assertContains(response, '/api/thumbnail/UNC-0001')
         self.assertContains(response, '/api/new_file/UNC-0001')
         self.assertNotContains(response, '/api/thumbnail/UNC-0002')
+        response = self.client.get(url + '?compact=1')
+        self.assertContains(response, 'UNC-0001')
+        self.assertNotContains(response, 'thumb_url')
         url = reverse('api_file_list', kwargs={'id_rule': 100})  # Not existing rule
         response = self.client.get(url)
         self.assertEqual(response.status_code, 404)
@@ -488,6 +506,237 @@ class APITest(DMSTestCase):
             if not indexing_data[key] in self.doc1_dict.itervalues():
                 raise AssertionError('Value "%s" not present in indexing_data' % value)
 
+    def test_31_api_thumbnails_batch(self):
+        """Thumbnails of many documents are returned in one request"""
+        code = self.documents_pdf[0]
+        url = reverse('api_thumbnails') + '?codes=%s,ADL-9999' % code
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 401)
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        thumbnails = json.loads(response.content)
+        self.assertEqual(thumbnails['ADL-9999'], None)
+        # Not generated yet, generation is queued for existing documents only
+        self.assertEqual(thumbnails[code], None)
+        queue = get_job_queue()
+        self.assertEqual(queue.find(THUMBNAILS_QUEUE, {'code': 'ADL-9999'}), None)
+        job_id = queue.find(THUMBNAILS_QUEUE, {'code': code})['id']
+        self.assertEqual(generate_thumbnail_job(queue.get(job_id)['payload']), None)
+        queue.complete(job_id)
+        # Failed generation is not queued again
+        payload = {'code': code, 'size': 'large'}
+        queue.fail(queue.enqueue(THUMBNAILS_QUEUE, payload), 'Conversion failed')
+        response = self.client.get(url + '&size=large')
+        self.assertEqual(json.loads(response.content)[code], None)
+        self.assertEqual(queue.find(THUMBNAILS_QUEUE, payload), None)
+        response = self.client.get(url)
+        thumbnails = json.loads(response.content)
+        self.assertEqual(thumbnails[code]['content_type'], 'image/png')
+        self.assertTrue(base64.b64decode(thumbnails[code]['data']).startswith('\x89PNG'))
+        response = self.client.get(reverse('api_thumbnails'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_32_api_thumbnail_caching(self):
+        """Thumbnails support conditional requests and versioned immutable URLs"""
+        self.client.login(username=self.username, password=self.password)
+        url = reverse('api_thumbnail', kwargs={'code': self.documents_pdf[0]})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertFalse(response.has_header('Cache-Control'))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        # File list links versioned thumbnails
+        response = self.client.get(reverse('api_file_list', kwargs={'id_rule': self.adlibre_invoices_rule_id}))
+        self.assertContains(response, url + '?v=')
+        version = re.search(re.escape(url) + r'\?v=(\w+)', response.content).group(1)
+        response = self.client.get(url + '?v=' + version)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        response = self.client.get(url + '?v=' + version, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('immutable', response['Cache-Control'])
+        # Not a current version
+        response = self.client.get(url + '?v=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Cache-Control'))
+        # Stored thumbnail of a size is served with the document file name
+        for stored in (False, True):
+            response = self.client.get(url + '?size=large')
+            self.assertEqual(response['Content-Disposition'], 'filename=%s.pdf.png' % self.documents_pdf[0])
+
+    def test_33_api_auth_cache(self):
+        """Verified basic auth credentials are cached and API tokens authenticate when enabled"""
+        url = reverse('api_file_list', kwargs={'id_rule': self.adlibre_invoices_rule_id})
+        authorization = 'Basic ' + base64.b64encode('%s:%s' % (self.username, self.password))
+        response = self.client.get(url, HTTP_AUTHORIZATION=authorization)
+        self.assertEqual(response.status_code, 200)
+        cached = get_cache('core').get(get_credentials_cache_key(authorization))
+        self.assertNotEqual(cached, None)
+        # Password hash itself is not cached
+        self.assertFalse(User.objects.get(username=self.username).password in cached)
+        self.client.logout()
+        response = self.client.get(url, HTTP_AUTHORIZATION=authorization)
+        self.assertEqual(response.status_code, 200)
+        # Wrong credentials are not cached
+        wrong = 'Basic ' + base64.b64encode('%s:wrong' % self.username)
+        response = self.client.get(url, HTTP_AUTHORIZATION=wrong)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(get_cache('core').get(get_credentials_cache_key(wrong)), None)
+        # Password change drops cached verification
+        admin = User.objects.get(username=self.username)
+        admin.set_password('changed')
+        admin.save()
+        self.client.logout()
+        response = self.client.get(url, HTTP_AUTHORIZATION=authorization)
+        self.assertEqual(response.status_code, 401)
+        token = Token.objects.create(user=admin)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Token %s' % token.key)
+        self.assertEqual(response.status_code, 401)
+        with override_settings(API_TOKEN_AUTHENTICATION=True):
+            response = self.client.get(url, HTTP_AUTHORIZATION='Token %s' % token.key)
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(url, HTTP_AUTHORIZATION='Token wrong')
+            self.assertEqual(response.status_code, 401)
+
+    def test_34_api_file_info_batch(self):
+        """File info of many documents is returned in one request"""
+        codes = self.documents_pdf[:2]
+        url = reverse('api_file_info_batch') + '?codes=%s,ADL-9999' % ','.join(codes)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 401)
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        info = json.loads(response.content)
+        self.assertEqual(info['ADL-9999'], None)
+        for code in codes:
+            response = self.client.get(reverse('api_file_info', kwargs={'code': code}))
+            single_info = json.loads(json.loads(response.content))
+            self.assertEqual(info[code]['document_name'], code)
+            self.assertEqual(info[code]['metadata'], single_info['metadata'])
+            self.assertEqual(info[code]['tags'], single_info['tags'])
+            self.assertNotIn('indexing_data', info[code])
+        response = self.client.get(reverse('api_file_info_batch') + '?compact=1&codes=%s' % codes[0])
+        compact_info = json.loads(response.content)[codes[0]]
+        self.assertEqual(compact_info['current_metadata'], info[codes[0]]['current_metadata'])
+        self.assertNotIn('metadata', compact_info)
+        self.assertNotIn('document_list_url', compact_info)
+        response = self.client.get(reverse('api_file_info_batch') + '?indexing_data=1&codes=%s' % codes[0])
+        self.assertIn('description', json.loads(response.content)[codes[0]]['indexing_data'])
+        response = self.client.get(reverse('api_file_info_batch'))
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(DOCUMENT_BATCH_THREADS=1)
+    def test_35_api_file_batch(self):
+        """Many files and archives contents are created in one request with per file results"""
+        codes = ['ADL-1986', 'ADL-1987', 'ADL-1988']
+        file_path = os.path.join(self.test_document_files_dir, self.documents_pdf[0] + '.pdf')
+        archive = tempfile.NamedTemporaryFile(suffix='.zip')
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.write(file_path, 'batch/%s.pdf' % codes[0])
+            zip_file.write(file_path, '%s.pdf' % codes[1])
+        archive.seek(0)
+        url = reverse('api_file_batch')
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.post(url, {'file': [open(file_path, 'rb'), archive]})
+        self.assertEqual(response.status_code, 200)
+        items = json.loads(response.content)
+        self.assertEqual([item['name'] for item in items], [self.documents_pdf[0] + '.pdf', codes[0] + '.pdf', codes[1] + '.pdf'])
+        # Already existing document
+        self.assertEqual(items[0]['status'], 409)
+        self.assertEqual(items[0]['code'], None)
+        self.assertTrue(items[0]['errors'])
+        for item, code in zip(items[1:], codes):
+            self.assertEqual(item['status'], 201)
+            self.assertEqual(item['code'], code)
+        # Tar archive stream
+        stream = tempfile.TemporaryFile()
+        with tarfile.open(fileobj=stream, mode='w') as tar_file:
+            tar_file.add(file_path, '%s.pdf' % codes[2])
+        stream.seek(0)
+        response = self.client.post(url, stream.read(), content_type='application/x-tar')
+        self.assertEqual(json.loads(response.content)[0]['code'], codes[2])
+        response = self.client.get(reverse('api_file_info_batch') + '?codes=%s' % ','.join(codes))
+        for code in codes:
+            self.assertEqual(json.loads(response.content)[code]['document_name'], code)
+        response = self.client.post(url, 'broken', content_type='application/zip')
+        self.assertEqual(response.status_code, 400)
+        # Archives over files count or size limits are rejected before extracting
+        archive.seek(0)
+        with override_settings(API_BATCH_UPLOAD_LIMIT=1):
+            response = self.client.post(url, archive.read(), content_type='application/zip')
+        self.assertEqual(response.status_code, 400)
+        archive.seek(0)
+        with override_settings(API_BATCH_UPLOAD_ARCHIVE_MAX_SIZE=os.path.getsize(file_path)):
+            response = self.client.post(url, archive.read(), content_type='application/zip')
+        self.assertEqual(response.status_code, 400)
+        self.cleanUp(codes)
+
+    def test_36_api_async_upload(self):
+        """Upload with async parameter is accepted at once and processed by a queued job"""
+        code = 'ADL-1989'
+        self.client.login(username=self.username, password=self.password)
+        url, data = self._get_tests_file(self.documents_pdf[0], code, 'pdf')
+        response = self.client.post(url + '?async=1', data)
+        self.assertEqual(response.status_code, 202)
+        accepted = json.loads(response.content)
+        self.assertEqual(response['Location'], accepted['status_url'])
+        response = self.client.get(accepted['status_url'])
+        self.assertEqual(json.loads(response.content)['status'], 'pending')
+        self.assertEqual(json.loads(response.content)['code'], code)
+        # Not stored yet
+        response = self.client.get(reverse('api_file_info_batch') + '?codes=%s' % code)
+        self.assertEqual(json.loads(response.content)[code], None)
+        # Processing job as 'uploads_worker' does
+        queue = get_job_queue()
+        job = queue.get(accepted['job'])
+        self.assertTrue(os.path.isfile(job['payload']['path']))
+        error, result = process_upload_job(job['payload'])
+        self.assertEqual(error, None)
+        queue.complete(job['id'], result)
+        self.assertFalse(os.path.isfile(job['payload']['path']))
+        response = self.client.get(accepted['status_url'])
+        status = json.loads(response.content)
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['result']['code'], code)
+        response = self.client.get(reverse('api_file_info_batch') + '?codes=%s' % code)
+        self.assertEqual(json.loads(response.content)[code]['document_name'], code)
+        response = self.client.get(reverse('api_job', kwargs={'job_id': 0}))
+        self.assertEqual(response.status_code, 404)
+        self.cleanUp([code])
+
+    @override_settings(DOCUMENT_BATCH_THREADS=1)
+    def test_37_api_file_batch_couchdb_failure(self):
+        """Files of documents failed to save in CouchDB are not left in DMS"""
+        code = 'ADL-1990'
+        file_path = os.path.join(self.test_document_files_dir, self.documents_pdf[0] + '.pdf')
+        uploaded_file = SimpleUploadedFile(code + '.pdf', open(file_path, 'rb').read())
+        self.client.login(username=self.username, password=self.password)
+
+        def save_docs(couchdocs, **kwargs):
+            raise BulkSaveError([{'id': couchdoc.get_id, 'error': 'forbidden'} for couchdoc in couchdocs], [])
+
+        save_docs_method = CouchDocument.save_docs
+        CouchDocument.save_docs = staticmethod(save_docs)
+        try:
+            response = self.client.post(reverse('api_file_batch'), {'file': uploaded_file})
+        finally:
+            CouchDocument.save_docs = save_docs_method
+        item = json.loads(response.content)[0]
+        self.assertEqual(item['status'], 500)
+        self.assertEqual(item['code'], None)
+        response = self.client.get(reverse('api_file_info_batch') + '?codes=%s' % code)
+        self.assertEqual(json.loads(response.content)[code], None)
+        response = self.client.get(reverse('api_file', kwargs={'code': code}))
+        self.assertEqual(response.status_code, 404)
+        uploaded_file.seek(0)
+        response = self.client.post(reverse('api_file_batch'), {'file': uploaded_file})
+        self.assertEqual(json.loads(response.content)[0]['status'], 201)
+        self.cleanUp([code])
+
     def test_zz_cleanup(self):
         """Test Cleanup"""
         self.cleanAll()
@@ -44,6 +44,17 @@ urlpatterns = patterns(
         views.FileHandler.as_view(),
         name='api_file',
     ),
+    url(
+        r'^new_files/$',
+        views.FileBatchHandler.as_view(),
+        name='api_file_batch',
+    ),
+    # /api/file-info/?codes=ABC1234,ABC1235
+    url(
+        r'^file-info/$',
+        views.FileInfoBatchHandler.as_view(),
+        name='api_file_info_batch',
+    ),
     # /api/file-info/ABC1234
     url(
         r'^file-info/(?P<code>[\w_-]+)$',
@@ -101,6 +112,16 @@ urlpatterns = patterns(
         views.ThumbnailsHandler.as_view(),
         name='api_thumbnail',
     ),
+    url(
+        r'^thumbnails/$',
+        views.ThumbnailsBatchHandler.as_view(),
+        name='api_thumbnails',
+    ),
+    url(
+        r'^jobs/(?P<job_id>\d+)$',
+        views.JobHandler.as_view(),
+        name='api_job',
+    ),
     url(
         r'^version$',
         views.VersionHandler.as_view(),
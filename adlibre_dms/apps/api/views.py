@@ -7,13 +7,20 @@ License: See LICENSE for license information
 
 import json
 import os
+import base64
 import logging
+import mimetypes
+import shutil
+import tarfile
+import tempfile
 import traceback
+import zipfile
 from StringIO import StringIO
 
 from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.utils.decorators import method_decorator
 
 from rest_framework.views import APIView
@@ -29,20 +36,31 @@ from api.decorators.group_required import group_required
 from core.document_processor import DocumentProcessor
 from core.parallel_keys import process_pkeys_request
 from core.errors import DmsException
-from core.http import DMSObjectResponse, DMSOBjectRevisionsData
+from core.http import DMSObjectResponse, DMSOBjectRevisionsData, set_thumbnail_caching, thumbnail_etag
+from core.jobs import get_job_queue
+from core.models import Document
+from core.uploads import UPLOADS_QUEUE, enqueue_upload
+from dms_plugins import pluginpoints
 from dms_plugins.operator import PluginsOperator
 from dms_plugins.models import DoccodePluginMapping
+from dms_plugins.workers import PluginError
+from dms_plugins.workers.storage.local import Local
+from dms_plugins.workers.storage.metadata.local_json import LocalJSONMetadata
+from dms_plugins.workers.transfer.thumbnails import ThumbnailsFilesystemHandler, enqueue_thumbnail
 from mdt_manager import MetaDataTemplateManager
 from dms_plugins.workers.info.tags import TagsPlugin
 from models import API_GROUP_NAME
 
-from mdtui.security import list_permitted_docrules_qs
+from mdtui.security import permitted_docrules_set
 
 
 log = logging.getLogger('dms.api.handlers')
 
 AUTH_REALM = 'Adlibre DMS'
 
+ARCHIVE_TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2')
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
 
 class BaseFileHandler(APIView):
     """Typical request parsing task handler"""
@@ -55,6 +73,16 @@ class BaseFileHandler(APIView):
         return revision, hashcode, extra
 
 
+def accept_upload(request, action, code, uploaded_file, options):
+    """Queues upload processing by 'uploads_worker'. Returns 202 Accepted response with job status URL."""
+    job_id = enqueue_upload(action, code, uploaded_file, request.user, options)
+    url = reverse('api_job', kwargs={'job_id': job_id})
+    log.info('Upload of %s accepted as job %s' % (code, job_id))
+    response = Response({'job': job_id, 'status_url': url}, status=status.HTTP_202_ACCEPTED)
+    response['Location'] = url
+    return response
+
+
 class FileHandler(BaseFileHandler):
     """CRUD Methods for documents
 
@@ -76,6 +104,10 @@ class FileHandler(BaseFileHandler):
               Omitting this parameter returns the latest revision of the document.
     @param h: hashcode of requested dcoument. In case ve have a hashcode stamp for it.
 
+    POST and PUT with a file additional parameters:
+    @param async: return 202 Accepted with the job status URL right after the file is received,
+                  processing it by 'uploads_worker' command afterwards.
+
 
     POST method file API negotiation:
     POST method is used to create new documents in the system only.
@@ -115,6 +147,8 @@ class FileHandler(BaseFileHandler):
             uploaded_file = request.FILES['file']
         else:
             return Response(status=status.HTTP_400_BAD_REQUEST)
+        if request.QUERY_PARAMS.get('async', None):
+            return accept_upload(request, 'create', code, uploaded_file, {'barcode': code})
         processor = DocumentProcessor()
         options = {
             'user': request.user,
@@ -143,8 +177,8 @@ class FileHandler(BaseFileHandler):
         document = processor.read(code, options)
         if not request.user.is_superuser:
             # Hack: Used part of the code from MDTUI Wrong!
-            user_permissions = list_permitted_docrules_qs(request.user)
-            if not document.docrule in user_permissions:
+            docrule = document.docrule
+            if docrule is None or not docrule.pk in permitted_docrules_set(request.user):
                 return Response(status=status.HTTP_401_UNAUTHORIZED)
         if processor.errors:
             log.error('FileHandler.read manager errors: %s' % processor.errors)
@@ -200,6 +234,9 @@ class FileHandler(BaseFileHandler):
             'update_file': uploaded_obj,
             'user': request.user,
         }
+        if uploaded_obj and request.QUERY_PARAMS.get('async', None):
+            job_options = dict((key, value) for key, value in options.iteritems() if not key in ['update_file', 'user'])
+            return accept_upload(request, 'update', code, uploaded_obj, job_options)
         document = processor.update(code, options)
         if len(processor.errors) > 0:
             log.error('FileHandler.update manager errors %s' % processor.errors)
@@ -283,8 +320,8 @@ class OldFileHandler(BaseFileHandler):
         document = processor.read(code, options)
         if not request.user.is_superuser:
             # Hack: Used part of the code from MDTUI Wrong!
-            user_permissions = list_permitted_docrules_qs(request.user)
-            if not document.docrule in user_permissions:
+            docrule = document.docrule
+            if docrule is None or not docrule.pk in permitted_docrules_set(request.user):
                 return Response(status=status.HTTP_401_UNAUTHORIZED)
         if processor.errors:
             log.error('OldFileHandler.read manager errors: %s' % processor.errors)
@@ -298,6 +335,146 @@ class OldFileHandler(BaseFileHandler):
         return response
 
 
+def archive_member_file(fileobj, name, size):
+    """Copies an archive member into a temporary file. Returns it as an uploaded file named after the member.
+
+    Raises DmsException for a member expanding into more than its size in archive headers."""
+    temp_file = tempfile.TemporaryFile()
+    left = size
+    try:
+        while True:
+            chunk = fileobj.read(min(left + 1, ARCHIVE_CHUNK_SIZE))
+            if not chunk:
+                break
+            left -= len(chunk)
+            if left < 0:
+                raise DmsException('Archive member %s is larger than declared' % name, 400)
+            temp_file.write(chunk)
+    except:
+        temp_file.close()
+        raise
+    temp_file.seek(0)
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    return UploadedFile(temp_file, os.path.basename(name), content_type=content_type, size=size)
+
+
+def expand_archive(archive, name, limit, max_size):
+    """Returns list of uploaded files contained in a zip or tar (optionally compressed) archive, or None for other files
+
+    Archive headers are checked before extracting anything.
+    Raises DmsException for a broken archive, an archive of more than limit files
+    or of files larger than max_size bytes in total."""
+    name = name.lower()
+    try:
+        if name.endswith('.zip'):
+            zip_file = zipfile.ZipFile(archive)
+            members = []
+            for member in zip_file.infolist():
+                if not member.filename.endswith('/') and not os.path.basename(member.filename).startswith('.'):
+                    members.append((member, member.filename, member.file_size))
+                    if len(members) > limit:
+                        break
+            open_member = zip_file.open
+        elif name.endswith(ARCHIVE_TAR_EXTENSIONS):
+            tar_file = tarfile.open(fileobj=archive, mode='r:*')
+            members = []
+            member = tar_file.next()
+            while member is not None and len(members) <= limit:
+                if member.isfile() and not os.path.basename(member.name).startswith('.'):
+                    members.append((member, member.name, member.size))
+                member = tar_file.next()
+            open_member = tar_file.extractfile
+        else:
+            return None
+        if len(members) > limit:
+            raise DmsException('Archive %s has more than %s files' % (name, limit), 400)
+        if sum(size for member, member_name, size in members) > max_size:
+            raise DmsException('Archive %s files are larger than %s bytes' % (name, max_size), 400)
+        files = []
+        try:
+            for member, member_name, size in members:
+                files.append(archive_member_file(open_member(member), member_name, size))
+        except:
+            for uploaded_file in files:
+                uploaded_file.close()
+            raise
+    except (zipfile.BadZipfile, tarfile.TarError, EOFError, IOError), e:
+        raise DmsException('Broken archive %s: %s' % (name, e), 400)
+    return files
+
+
+class FileBatchHandler(APIView):
+    """Creates many documents at once, e.g. pages of a scanning station batch
+
+    POST request may be either:
+        multipart/form-data with any number of files (e.g. many 'file' fields)
+        zip or tar archive stream with Content-Type of settings.API_BATCH_UPLOAD_ARCHIVE_TYPES
+    Zip and tar (.tar, .tar.gz, .tgz, .tar.bz2) archives are expanded into the files they contain.
+    File names set document codes, the same way as for file handler POST without a code.
+    Up to settings.API_BATCH_UPLOAD_LIMIT files are created in one request. Archives are checked for the number
+    of files and their total size (settings.API_BATCH_UPLOAD_ARCHIVE_MAX_SIZE) before extracting.
+
+    Returns list of {"name": file name, "status": HTTP status code, "code": created document code or null,
+    "errors": list of error messages} in upload order."""
+    allowed_methods = ('POST', )
+    parser_classes = (MultiPartParser, FormParser)
+
+    @method_decorator(logged_in_or_basicauth(AUTH_REALM))
+    @method_decorator(group_required(API_GROUP_NAME))  # FIXME: Should be more granular permissions
+    def post(self, request):
+        archive_types = getattr(settings, 'API_BATCH_UPLOAD_ARCHIVE_TYPES', {})
+        limit = getattr(settings, 'API_BATCH_UPLOAD_LIMIT', 200)
+        max_size = getattr(settings, 'API_BATCH_UPLOAD_ARCHIVE_MAX_SIZE', 1024 * 1024 * 1024)
+        content_type = request.content_type.split(';')[0].strip()
+        uploaded_files = []
+        try:
+            if content_type in archive_types:
+                archive = tempfile.TemporaryFile()
+                try:
+                    shutil.copyfileobj(request.stream, archive)
+                    archive.seek(0)
+                    uploaded_files = expand_archive(archive, 'upload' + archive_types[content_type], limit, max_size)
+                finally:
+                    # Archive members are extracted into files of their own
+                    archive.close()
+            else:
+                for field_name in request.FILES:
+                    for uploaded_file in request.FILES.getlist(field_name):
+                        archive_files = expand_archive(
+                            uploaded_file, uploaded_file.name, limit - len(uploaded_files), max_size
+                        )
+                        if archive_files is None:
+                            uploaded_files.append(uploaded_file)
+                        else:
+                            uploaded_files.extend(archive_files)
+                            max_size -= sum(archive_file.size for archive_file in archive_files)
+                        if len(uploaded_files) > limit:
+                            raise DmsException('More than %s files uploaded' % limit, 400)
+        except DmsException, e:
+            log.error('FileBatchHandler.create error: %s' % e)
+            for uploaded_file in uploaded_files:
+                uploaded_file.close()
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if not uploaded_files:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        processor = DocumentProcessor()
+        results = processor.create_many(uploaded_files, {'user': request.user})
+        items = []
+        for uploaded_file, (document, errors) in zip(uploaded_files, results):
+            item = {'name': uploaded_file.name, 'status': status.HTTP_201_CREATED, 'code': None, 'errors': []}
+            if errors:
+                code = getattr(errors[0], 'code', None)
+                item['status'] = code if isinstance(code, int) else status.HTTP_400_BAD_REQUEST
+                item['errors'] = [unicode(getattr(error, 'parameter', error)) for error in errors]
+            else:
+                item['code'] = document.get_code()
+            items.append(item)
+        if processor.errors:
+            log.error('FileBatchHandler.create manager errors: %s' % processor.errors)
+        log.info('FileBatchHandler.create request fulfilled for %s files' % len(uploaded_files))
+        return Response(items, status=status.HTTP_200_OK)
+
+
 class FileInfoHandler(BaseFileHandler):
     """Returns document file info data"""
     allowed_methods = ('GET',)
@@ -339,8 +516,70 @@ class FileInfoHandler(BaseFileHandler):
         return Response(info, status=status.HTTP_200_OK)
 
 
+class FileInfoBatchHandler(APIView):
+    """File info data of many documents at once
+
+    GET parameters:
+    @param codes: comma separated list of document codes, up to settings.API_FILE_INFO_BATCH_LIMIT
+    @param indexing_data: return documents indexing data too
+    @param compact: return current file revision data only, without all revisions and document list URL
+
+    Returns JSON object with the same document data as file info handler by code,
+    or null for codes having neither file revisions nor indexes stored.
+    Documents are read by document type, CouchDB documents of a type are fetched with one request
+    and file revisions data files are loaded in parallel.
+    User document type permissions are checked once per request."""
+    allowed_methods = ('GET', )
+
+    @method_decorator(logged_in_or_basicauth(AUTH_REALM))
+    @method_decorator(group_required(API_GROUP_NAME))  # FIXME: Should be more granular permissions
+    def get(self, request):
+        codes = [code for code in request.GET.get('codes', '').split(',') if code]
+        if not codes or len(codes) > getattr(settings, 'API_FILE_INFO_BATCH_LIMIT', 100):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        indexing_data = bool(request.GET.get('indexing_data', None))
+        compact = bool(request.GET.get('compact', None))
+        options = {
+            'only_metadata': not indexing_data,
+            'indexing_data': indexing_data or None,
+            'user': request.user,
+        }
+        permitted_codes = codes
+        if not request.user.is_superuser:
+            permitted = permitted_docrules_set(request.user)
+            permitted_codes = []
+            for code in codes:
+                doc = Document()
+                try:
+                    doc.set_filename(code)
+                    docrule = doc.get_docrule()
+                except DmsException:
+                    continue
+                if docrule.pk in permitted:
+                    permitted_codes.append(code)
+        processor = DocumentProcessor()
+        documents = processor.read_many(permitted_codes, options)
+        if processor.errors:
+            log.debug('FileInfoBatchHandler.read errors: %s' % processor.errors)
+        info = {}
+        for code in codes:
+            document = documents.get(code, None)
+            if document is None or document.marked_deleted:
+                info[code] = None
+            elif not document.get_file_revisions_data() and not document.get_db_info().get('mdt_indexes'):
+                # Code without file revisions and indexes is not stored
+                info[code] = None
+            else:
+                info[code] = DMSOBjectRevisionsData(document, compact=compact).data
+        log.info('FileInfoBatchHandler.get request fulfilled for %s codes' % len(codes))
+        return Response(info, status=status.HTTP_200_OK)
+
+
 class FileListHandler(APIView):
-    """Provides list of documents to be able to browse via document type rule id."""
+    """Provides list of documents to be able to browse via document type rule id.
+
+    GET parameters:
+    @param compact: return stored files data only, without document, thumbnail URLs and rule name of each file"""
     allowed_methods = ('GET', )
 
     @method_decorator(logged_in_or_basicauth(AUTH_REALM))
@@ -357,6 +596,7 @@ class FileListHandler(APIView):
         searchword = request.GET.get('q', None)
         tag = request.GET.get('tag', None)
         filter_date = request.GET.get('created_date', None)
+        compact = bool(request.GET.get('compact', None))
         if finish:
             finish = int(finish)
         file_list = operator.get_file_list(
@@ -368,20 +608,24 @@ class FileListHandler(APIView):
             tags=[tag],
             filter_date=filter_date
         )
-        for item in file_list:
-            document_name = item['name']
-            code, suggested_format = os.path.splitext(document_name)
-            if not suggested_format:
-                api_url = reverse('api_file', kwargs={'code': code, })
-            else:
-                suggested_format = suggested_format[1:]  # Remove . from file ext
-                api_url = reverse('api_file', kwargs={'code': code, 'suggested_format': suggested_format, })
-            thumb_url = reverse('api_thumbnail', kwargs={'code': item['name']})
-            item.update({
-                'ui_url': api_url,
-                'thumb_url': thumb_url,
-                'rule': mapping.get_name(),
-            })
+        if not compact:
+            rule = mapping.get_name()
+            for item in file_list:
+                document_name = item['name']
+                code, suggested_format = os.path.splitext(document_name)
+                if not suggested_format:
+                    api_url = reverse('api_file', kwargs={'code': code, })
+                else:
+                    suggested_format = suggested_format[1:]  # Remove . from file ext
+                    api_url = reverse('api_file', kwargs={'code': code, 'suggested_format': suggested_format, })
+                thumb_url = reverse('api_thumbnail', kwargs={'code': item['name']})
+                if item.get('version', None):
+                    thumb_url += '?v=%s' % item['version']
+                item.update({
+                    'ui_url': api_url,
+                    'thumb_url': thumb_url,
+                    'rule': rule,
+                })
         log.info(
             """FileListHandler.read request fulfilled for:
             start %s, finish %s, order %s, searchword %s, tag %s, filter_date %s."""
@@ -734,7 +978,15 @@ class ParallelKeysHandler(APIView):
 
 
 class ThumbnailsHandler(APIView):
-    """Work with thumbnails of files"""
+    """Work with thumbnails of files
+
+    GET parameters:
+    @param size: optional thumbnail size name of settings.THUMBNAILS_SIZES
+    @param v: document version from file list. Thumbnails of the current document version are cached by clients
+              as immutable.
+
+    Existing thumbnail is served from thumbnails storage without reading the document.
+    Supports conditional requests with ETag."""
     allowed_methods = ('GET', )
 
     @method_decorator(logged_in_or_basicauth(AUTH_REALM))
@@ -746,16 +998,154 @@ class ThumbnailsHandler(APIView):
                 log.error('ThumbnailsHandler.read attempted with unauthenticated user.')
                 return Response(status=status.HTTP_401_UNAUTHORIZED)
 
-            processor = DocumentProcessor()
-            doc = processor.read(code, options={'user': request.user, 'thumbnail': True})
-            if not processor.errors:
-                return DMSObjectResponse(doc, thumbnail=True)
-            else:
-                return Response(status=status.HTTP_404_NOT_FOUND)
+            size = request.GET.get('size', None)
+            version = request.GET.get('v', None)
+            doc = self.get_stored_thumbnail(request.user, code, size)
+            if doc is None:
+                processor = DocumentProcessor()
+                options = {'user': request.user, 'thumbnail': True, 'thumbnail_size': size}
+                doc = processor.read(code, options=options)
+                if processor.errors:
+                    return Response(status=status.HTTP_404_NOT_FOUND)
+            # Stale or unknown versions must not be cached forever
+            immutable = version is not None and version == self.get_current_version(doc)
+            etag = thumbnail_etag(doc.thumbnail)
+            if request.META.get('HTTP_IF_NONE_MATCH', None) == etag:
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                set_thumbnail_caching(response, immutable)
+                return response
+            return DMSObjectResponse(doc, thumbnail=True, immutable=immutable)
         except:
             log.error('ThumbnailsHandler Error: %s' % traceback.print_exc())
             raise
 
+    def get_current_version(self, doc):
+        """Returns version of document latest file revision, the same as file list has"""
+        return Local().get_version({'metadatas': stored_file_revisions(doc)})
+
+    def get_stored_thumbnail(self, user, code, size):
+        """Returns Document() with existing thumbnail, without reading the document, or None"""
+        doc = Document()
+        try:
+            doc.set_filename(code)
+            if size:
+                doc.update_options({'thumbnail_size': size})
+            if not doc.get_docrule() or not retrieval_permitted(user, doc):
+                return None
+            handler = ThumbnailsFilesystemHandler()
+            suffix = handler.get_suffix(handler.get_size(doc)[0])
+            thumbnail_path = handler.find_thumbnail(doc)
+        except (DmsException, PluginError):
+            return None
+        if thumbnail_path is None:
+            return None
+        with open(thumbnail_path, 'rb') as thumbnail:
+            doc.thumbnail = thumbnail.read()
+        # Filename thumbnail was generated for e.g. 'ADL-0001.pdf' ('ADL-0001.pdf.large.png' thumbnail)
+        doc.set_full_filename(os.path.basename(thumbnail_path)[:-len(suffix)])
+        return doc
+
+
+def stored_file_revisions(document):
+    """Returns stored file revisions data of document code ({} for no such document), without reading it"""
+    metadata = LocalJSONMetadata()
+    directory = metadata.filesystem.get_document_directory(document)
+    return metadata.load_metadata(document.get_code(), directory)[0]
+
+
+def retrieval_permitted(user, document, operator=None):
+    """Runs security plugins of document type retrieval workflow, without retrieving the document"""
+    operator = operator or PluginsOperator()
+    document.user = user
+    try:
+        for plugin in operator.get_plugins_for_point(
+                pluginpoints.BeforeRetrievalPluginPoint, document, plugin_type='security'):
+            plugin.work(document)
+    except PluginError:
+        return False
+    return True
+
+
+class ThumbnailsBatchHandler(APIView):
+    """Thumbnails of many documents at once, e.g. for a file list page
+
+    GET parameters:
+    @param codes: comma separated list of document codes, up to settings.API_THUMBNAILS_BATCH_LIMIT
+    @param size: optional thumbnails size name of settings.THUMBNAILS_SIZES
+
+    Returns JSON object with {"content_type": "image/png", "data": base64 encoded thumbnail}
+    or null (no such document or thumbnail) by code.
+    Existing thumbnails are served from thumbnails storage without reading documents.
+    Thumbnails not generated yet are null, with their generation queued for 'thumbnails_worker' command
+    (unless the document can not have a thumbnail or it's generation has failed).
+    Documents retrieval security plugins are checked once per document type."""
+    allowed_methods = ('GET', )
+
+    @method_decorator(logged_in_or_basicauth(AUTH_REALM))
+    @method_decorator(group_required(API_GROUP_NAME))  # FIXME: Should be more granular permissions
+    def get(self, request):
+        codes = [code for code in request.GET.get('codes', '').split(',') if code]
+        size = request.GET.get('size', None)
+        if not codes or len(codes) > getattr(settings, 'API_THUMBNAILS_BATCH_LIMIT', 100):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if size and not size in getattr(settings, 'THUMBNAILS_SIZES', {}):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        handler = ThumbnailsFilesystemHandler()
+        operator = PluginsOperator()
+        permitted = {}
+        thumbnails = {}
+        for code in codes:
+            thumbnails[code] = None
+            doc = Document()
+            try:
+                doc.set_filename(code)
+            except DmsException:
+                continue
+            if size:
+                doc.update_options({'thumbnail_size': size})
+            docrule = doc.get_docrule()
+            if not docrule:
+                continue
+            if not docrule.pk in permitted:
+                permitted[docrule.pk] = retrieval_permitted(request.user, doc, operator)
+            if not permitted[docrule.pk]:
+                continue
+            thumbnail = handler.read_existing_thumbnail(doc)
+            if thumbnail is None:
+                revisions = stored_file_revisions(doc)
+                if revisions:
+                    # Not generated yet, it will be served by later requests
+                    data = revisions[max(revisions, key=int)]
+                    doc.mimetype = data.get('mimetype') or mimetypes.guess_type(data.get('name', ''))[0]
+                    doc.mimetype = doc.mimetype or 'application/octet-stream'
+                    enqueue_thumbnail(doc, size, retry_failed=False)
+            elif thumbnail:
+                thumbnails[code] = {'content_type': 'image/png', 'data': base64.b64encode(thumbnail)}
+        log.info('ThumbnailsBatchHandler.get request fulfilled for %s codes' % len(codes))
+        return Response(thumbnails, status=status.HTTP_200_OK)
+
+
+class JobHandler(APIView):
+    """Status of an asynchronous upload job
+
+    Returns JSON object with job id, document code, status ('pending', 'running', 'done' or 'failed'),
+    attempts, error, result ({"code": stored document code, "revision": stored revision} of a done job)
+    and created/updated unix timestamps. Jobs of other users are available for superusers only."""
+    allowed_methods = ('GET', )
+
+    @method_decorator(logged_in_or_basicauth(AUTH_REALM))
+    @method_decorator(group_required(API_GROUP_NAME))  # FIXME: Should be more granular permissions
+    def get(self, request, job_id):
+        job = get_job_queue().get(int(job_id))
+        if job is None or job['queue'] != UPLOADS_QUEUE:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        if job['payload']['user'] != request.user.pk and not request.user.is_superuser:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        data = dict((key, job[key]) for key in ('id', 'status', 'attempts', 'error', 'result', 'created', 'updated'))
+        data['code'] = job['payload']['code']
+        return Response(data, status=status.HTTP_200_OK)
+
 
 class VersionHandler(APIView):
     """Api hook to check the DMS work state"""
@@ -780,6 +1170,9 @@ class ApiDocs(APIView):
             'viersion': rest_reverse('api_version', request=request, format=format),
             'api_file': rest_reverse('api_file', kwargs={'code': 'code'}, request=request, format=format),
             'api_file_info': reverse('api_file_info', kwargs={'code': 'code'}),
+            'api_file_info_batch': reverse('api_file_info_batch'),
+            'api_file_batch': reverse('api_file_batch'),
+            'api_job': reverse('api_job', kwargs={'job_id': 1}),
             'api_file_list': reverse('api_file_list', kwargs={'id_rule': 1}),
             'api_revision_count': reverse('api_revision_count', kwargs={'document': 'code'}),
             'api_rules': rest_reverse('api_rules', request=request, format=format),
@@ -0,0 +1,171 @@
+"""
+Module: DMS Autocomplete prefix index
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+"""
+
+import bisect
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from dmscouch.models import CouchDocument
+from couchlocal import fetch_changes
+
+log = logging.getLogger('core.autocomplete_index')
+
+__all__ = ['AutocompleteIndex', 'autocomplete_index']
+
+
+class AutocompleteIndex(object):
+    """In-process prefix index of documents secondary keys values per docrule.
+
+    Docrule is loaded lazily with one 'dmscouch/search_autocomplete' view request (no documents are fetched)
+    and maintained on CouchDB documents store/update/removal by CouchDB metadata plugin.
+    Changes made by other processes are read from dmscouch '_changes' feed
+    not more often then settings.AUTOCOMPLETE_CHANGES_INTERVAL seconds.
+    Prefix query results are kept in LRU cache of settings.AUTOCOMPLETE_CACHE_SIZE entries.
+
+    Matching is case insensitive, like CouchDB collation of the autocomplete view ranges.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # {docrule_id: {code: mdt_indexes}}
+            self.documents = {}
+            # {docrule_id: {key_name: sorted list of (lowercase value, code)}}
+            self.values = {}
+            self.results = OrderedDict()
+            self.last_seq = None
+            self.checked = 0
+
+    def collation_key(self, value):
+        return unicode(value).lower()
+
+    def load_docrule(self, docrule_id):
+        """Populates index for a docrule from CouchDB"""
+        log.debug('AutocompleteIndex loading docrule: %s' % docrule_id)
+        rows = CouchDocument.get_db().view(
+            'dmscouch/search_autocomplete',
+            startkey=[docrule_id],
+            endkey=[docrule_id, {}],
+            reduce=False,
+        )
+        documents = {}
+        values = {}
+        for row in rows:
+            key, value = row['key'][1:3]
+            documents.setdefault(row['id'], {})[key] = value
+            values.setdefault(key, []).append((self.collation_key(value), row['id']))
+        for key_values in values.itervalues():
+            key_values.sort()
+        self.documents[docrule_id] = documents
+        self.values[docrule_id] = values
+
+    def update_document(self, doc):
+        """Indexes CouchDB document (dict) secondary keys. Removes deleted documents from index."""
+        code = doc['_id']
+        docrule_id = doc.get('metadata_doc_type_rule_id')
+        with self.lock:
+            self.remove_document(code)
+            if doc.get('doc_type') != 'CouchDocument' or doc.get('deleted') == 'deleted' or doc.get('_deleted'):
+                return
+            if not docrule_id in self.documents:
+                # Will be loaded with all it's documents on first request
+                return
+            indexes = dict(doc.get('mdt_indexes') or {})
+            self.documents[docrule_id][code] = indexes
+            for key, value in indexes.iteritems():
+                bisect.insort(self.values[docrule_id].setdefault(key, []), (self.collation_key(value), code))
+            self.clear_results(docrule_id)
+
+    def remove_document(self, code):
+        with self.lock:
+            for docrule_id, documents in self.documents.iteritems():
+                indexes = documents.pop(code, None)
+                if indexes is None:
+                    continue
+                for key, value in indexes.iteritems():
+                    key_values = self.values[docrule_id].get(key, [])
+                    entry = (self.collation_key(value), code)
+                    position = bisect.bisect_left(key_values, entry)
+                    if position < len(key_values) and key_values[position] == entry:
+                        del key_values[position]
+                self.clear_results(docrule_id)
+
+    def clear_results(self, docrule_id):
+        for cache_key in [cache_key for cache_key in self.results if cache_key[0] == docrule_id]:
+            del self.results[cache_key]
+
+    def sync(self):
+        """Applies changes of dmscouch database made since last check"""
+        interval = getattr(settings, 'AUTOCOMPLETE_CHANGES_INTERVAL', 5)
+        now = time.time()
+        with self.lock:
+            if self.last_seq is not None and now - self.checked < interval:
+                return
+            self.checked = now
+            first_check = self.last_seq is None
+            try:
+                changes = fetch_changes(
+                    CouchDocument.get_db(), 'now' if first_check else self.last_seq, include_docs=not first_check
+                )
+            except Exception, e:
+                log.error('AutocompleteIndex can not read changes feed: %s' % e)
+                self.reset()
+                return
+            if first_check:
+                # Nothing is known about changes made before. Loading docrules from scratch.
+                self.reset()
+            for change in changes['results']:
+                if change.get('deleted') or not change.get('doc'):
+                    self.remove_document(change['id'])
+                else:
+                    self.update_document(change['doc'])
+            self.last_seq = changes['last_seq']
+            self.checked = now
+
+    def suggest(self, docrule_id, key_name, prefix, fields, limit):
+        """Suggestions for documents of docrule having key_name value starting with prefix.
+
+        @param fields: list of secondary keys names to return for each suggestion
+        @return: list of up to limit unique dicts of fields values
+        """
+        self.sync()
+        start = self.collation_key(prefix)
+        cache_key = (docrule_id, key_name, start, tuple(fields), limit)
+        with self.lock:
+            if cache_key in self.results:
+                suggestions = self.results.pop(cache_key)
+                self.results[cache_key] = suggestions
+                return suggestions
+            if not docrule_id in self.documents:
+                self.load_docrule(docrule_id)
+            documents = self.documents[docrule_id]
+            key_values = self.values[docrule_id].get(key_name, [])
+            suggestions = []
+            found = set()
+            for value, code in key_values[bisect.bisect_left(key_values, (start, )):]:
+                if not value.startswith(start) or len(suggestions) >= limit:
+                    break
+                indexes = documents[code]
+                if not all(field in indexes for field in fields):
+                    continue
+                suggestion_values = tuple(indexes[field] for field in fields)
+                if not suggestion_values in found:
+                    found.add(suggestion_values)
+                    suggestions.append(dict(zip(fields, suggestion_values)))
+            self.results[cache_key] = suggestions
+            while len(self.results) > getattr(settings, 'AUTOCOMPLETE_CACHE_SIZE', 1000):
+                self.results.popitem(last=False)
+            return suggestions
+
+autocomplete_index = AutocompleteIndex()
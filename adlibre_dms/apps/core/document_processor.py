@@ -10,15 +10,22 @@ Author: Iurii Garmash
 
 import os
 import logging
+from multiprocessing.pool import ThreadPool
 
+from django.conf import settings
 from django.core.files.uploadedfile import UploadedFile
+from django.db import connection
 
 from dms_plugins import pluginpoints
 from dms_plugins.operator import PluginsOperator
+from dms_plugins.workers.storage.metadata.local_json import LocalJSONMetadata
+from dmscouch.models import CouchDocument
 
 from core.models import Document
 from core.errors import DmsException
 
+from couchdbkit.resource import ResourceNotFound
+
 log = logging.getLogger('core.document_processor')
 
 __all__ = ['DocumentProcessor']
@@ -103,15 +110,10 @@ class DocumentProcessor(object):
             if '.' in doc_name:
                 doc_name, extension = os.path.splitext(doc_name)
             # Check the DMS for existence of this code
-            possible_doc = self.read(doc_name, {'only_metadata': True, 'user': doc.user})
-            if possible_doc.file_revision_data and not self.errors \
-                or ('mdt_indexes' in possible_doc.db_info and possible_doc.db_info['mdt_indexes']):
+            if self.exists(doc):
                 error = DmsException('Document "%s" already exists' % doc_name, 409)
                 self.errors.append(error)
                 valid = False
-            if self.errors:
-                if self.errors.__len__() == 1 and self.errors[0].code == 404:
-                    self.errors = []
         # Processing plugins
         if valid:
             if doc.uncategorized:
@@ -125,6 +127,110 @@ class DocumentProcessor(object):
             self.check_errors_in_operator(operator)
         return doc
 
+    def create_many(self, uploaded_files, options):
+        """
+        Creates many new Document() instances and saves them into DMS.
+
+        Files are processed by create() in settings.DOCUMENT_BATCH_THREADS threads.
+        Uncategorized files are processed one by one afterwards, their codes are allocated from one sequence.
+        CouchDB documents of the batch are saved together with one bulk request.
+        Documents failed to save in CouchDB are removed.
+        Returns list of (Document() or None, errors list) tuples in uploaded_files order.
+        """
+        from dms_plugins.workers.database.couchdb import CouchDBMetadataWorker
+        log.debug('CREATE MANY Documents: %s' % len(uploaded_files))
+        couchdocs = []
+        options = dict(options or {}, database_batch=couchdocs)
+
+        def create(uploaded_file):
+            processor = DocumentProcessor()
+            document = processor.create(uploaded_file, options)
+            return document, processor.errors
+
+        def create_in_thread(uploaded_file):
+            try:
+                return create(uploaded_file)
+            finally:
+                # Threads must not leave database connections open
+                connection.close()
+
+        results = [None] * len(uploaded_files)
+        categorized = []
+        uncategorized = []
+        codes = set()
+        for index, uploaded_file in enumerate(uploaded_files):
+            doc = Document()
+            try:
+                doc.set_filename(os.path.basename(uploaded_file.name))
+                docrule = doc.get_docrule()
+            except DmsException:
+                # create() reports it
+                categorized.append(index)
+                continue
+            if docrule.uncategorized:
+                uncategorized.append(index)
+            elif doc.get_code() in codes:
+                # Would be created concurrently with the first one
+                results[index] = (None, [DmsException('Document "%s" already exists' % doc.get_code(), 409)])
+            else:
+                codes.add(doc.get_code())
+                categorized.append(index)
+        threads = min(len(categorized), getattr(settings, 'DOCUMENT_BATCH_THREADS', 4))
+        if threads < 2:
+            created = map(create, [uploaded_files[index] for index in categorized])
+        else:
+            pool = ThreadPool(threads)
+            try:
+                created = pool.map(create_in_thread, [uploaded_files[index] for index in categorized])
+            finally:
+                pool.close()
+                pool.join()
+        for index, result in zip(categorized, created):
+            results[index] = result
+        for index in uncategorized:
+            results[index] = create(uploaded_files[index])
+        try:
+            errors = CouchDBMetadataWorker().save_couchdocs(couchdocs)
+        except Exception, e:
+            errors = dict((couchdoc.get_id, e) for couchdoc in couchdocs)
+        for index, (document, document_errors) in enumerate(results):
+            if document is not None and not document_errors and document.get_code() in errors:
+                # Removing stored files of a document left without CouchDB indexes
+                code = document.get_code()
+                DocumentProcessor().delete(code, {'user': options.get('user')})
+                results[index] = (None, [DmsException('CouchDB error: %s' % errors[code], 500)])
+        for document, document_errors in results:
+            self.errors.extend(document_errors)
+        return results
+
+    def exists(self, document):
+        """Probes if DMS Object with this Document() code is already stored.
+
+        Does not run the retrieval plugins chain. Checks for a file revisions metadata file
+        and a CouchDB HEAD request (fetching a document only when it is present).
+        Code exists if it has file revisions or CouchDB document with secondary indexes.
+        """
+        code = document.get_code()
+        if LocalJSONMetadata().metadata_exists(document):
+            return True
+        docrule = document.get_docrule()
+        if docrule.uncategorized:
+            return False
+        try:
+            mapping = docrule.get_docrule_plugin_mappings()
+        except DmsException:
+            return False
+        if not mapping.get_database_storage_plugins():
+            return False
+        db = CouchDocument.get_db()
+        if not db.doc_exist(code):
+            return False
+        try:
+            couchdoc = db.open_doc(code)
+        except ResourceNotFound:
+            return False
+        return bool(couchdoc.get('mdt_indexes'))
+
     def read(self, document_name, options):
         """
         Reads Document() data from DMS
@@ -150,6 +256,36 @@ class DocumentProcessor(object):
         self.check_errors_in_operator(operator)
         return doc
 
+    def read_many(self, document_names, options):
+        """
+        Reads data of many Document() instances from DMS at once.
+
+        Documents are grouped by document type rule and each group passes the retrieval plugins together.
+        So plugins supporting it read data of a whole group at once (e.g. CouchDB documents with one request).
+        Returns dict of read Document() instances by code. Documents failed to read are missing in it,
+        their errors are stored into self.errors.
+        """
+        log.debug('READ MANY Documents %s with options: %s' % (document_names, options))
+        operator = PluginsOperator()
+        groups = {}
+        for document_name in document_names:
+            doc = Document()
+            try:
+                doc.set_filename(document_name)
+                docrule = doc.get_docrule()
+            except DmsException, e:
+                self.errors.append(unicode(e.parameter))
+                continue
+            doc = self.init_Document_with_data(options, doc)
+            groups.setdefault(docrule.pk, []).append(doc)
+        documents = {}
+        for docs in groups.itervalues():
+            docs, errors = operator.process_pluginpoint_many(pluginpoints.BeforeRetrievalPluginPoint, docs)
+            for doc in docs:
+                documents[doc.get_code()] = doc
+        self.check_errors_in_operator(operator)
+        return documents
+
     # TODO: Update should not delete all the old document's revisions on rename.
     def update(self, document_name, options):
         """
@@ -290,6 +426,9 @@ class DocumentProcessor(object):
                                             'only_metadata': True})
                     if property_name == 'extension':
                         doc.set_requested_extension(value)
+                    if property_name == 'thumbnail_size':
+                        if value:
+                            doc.update_options({property_name: value})
                     if property_name == 'tag_string':
                         if value:
                             doc.set_tag_string(value)
@@ -324,6 +463,9 @@ class DocumentProcessor(object):
                     ]:
                         if value:
                             doc.update_options({property_name: True})
+                    if property_name == 'database_batch':
+                        # List collecting database documents to be stored together
+                        doc.update_options({property_name: value})
                     if property_name == 'update_file':
                         doc.set_file_obj(value)
                         if value:
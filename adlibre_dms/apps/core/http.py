@@ -10,6 +10,9 @@ Desc: Main http objects manipulation methods here.
 
 import logging
 import json
+import hashlib
+import threading
+import time
 import traceback
 import sys
 from copy import copy
@@ -19,9 +22,33 @@ from time import mktime
 
 from django.http import HttpResponse
 from django.core.urlresolvers import reverse
+from django.db.models import signals
+
+from core.models import CoreConfiguration, DocumentTypeRule
+from dms_plugins.models import DoccodePluginMapping
 
 log = logging.getLogger('core.http')
 
+# Versioned thumbnails URLs never change their content
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+
+def thumbnail_etag(content):
+    """Strong ETag of thumbnail contents"""
+    return '"%s"' % hashlib.md5(content).hexdigest()
+
+
+def set_thumbnail_caching(response, immutable=False):
+    """Sets client caching headers of a thumbnail response (or it's 304 Not Modified response)"""
+    if immutable:
+        # Requested by versioned URL
+        response['Cache-Control'] = 'public, max-age=%s, immutable' % IMMUTABLE_MAX_AGE
+        exp = datetime.now() + timedelta(seconds=IMMUTABLE_MAX_AGE)
+    else:
+        # Cache thumbnails for 1 day
+        exp = datetime.now() + timedelta(days=1)
+    response['Expires'] = format_date_time(mktime(exp.timetuple()))
+
 
 class DMSObjectResponse(HttpResponse):
     """
@@ -39,7 +66,7 @@ class DMSObjectResponse(HttpResponse):
             response = DMSObjectResponse(document)
             return response
     """
-    def __init__(self, document, thumbnail=False):
+    def __init__(self, document, thumbnail=False, immutable=False):
         if thumbnail:
             content, content_type, filename = self.retieve_thumbnail(document)
         else:
@@ -49,12 +76,8 @@ class DMSObjectResponse(HttpResponse):
             self["Content-Length"] = len(content)
             if thumbnail:
                 self["Content-Type"] = content_type
-                # Cache thumbnails for 1 day
-                now = datetime.now()
-                exp = now + timedelta(days=1)
-                stamp = mktime(exp.timetuple())
-                expires = format_date_time(stamp)
-                self['Expires'] = expires
+                self['ETag'] = thumbnail_etag(content)
+                set_thumbnail_caching(self, immutable)
             self["Content-Disposition"] = 'filename=%s' % filename
 
     def retrieve_file(self, document):
@@ -94,26 +117,84 @@ class DMSObjectResponse(HttpResponse):
             dt.year, dt.hour, dt.minute, dt.second)
 
 
+class DocruleRevisionsDataCache(object):
+    """In-process cache of document type rule data of file revisions data responses
+
+    Document list URL needs a plugin mapping query and uncategorized flag a configuration query per docrule.
+    Cleared on any docrule, plugin mapping or configuration change in this process
+    and reloaded every 5 minutes to see changes of other processes."""
+
+    cache_data_for = 300  # 5 minutes
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self, **kwargs):
+        with self.lock:
+            # {docrule pk: (loaded time, data)}
+            self.docrules = {}
+
+    def get(self, docrule):
+        """Returns dict with 'doccode', 'document_list_url' and 'uncategorized' data of a docrule"""
+        with self.lock:
+            loaded, data = self.docrules.get(docrule.pk, (0, None))
+        if data is None or time.time() - loaded > self.cache_data_for:
+            mapping = docrule.get_docrule_plugin_mappings()
+            data = {
+                'doccode': {'title': docrule.get_title(), 'id': docrule.get_id()},
+                'document_list_url': reverse("api_file_list", kwargs={'id_rule': mapping.pk}),
+                'uncategorized': docrule.uncategorized,
+            }
+            with self.lock:
+                self.docrules[docrule.pk] = (time.time(), data)
+        return data
+
+docrule_revisions_data_cache = DocruleRevisionsDataCache()
+
+signals.post_save.connect(docrule_revisions_data_cache.clear, sender=DocumentTypeRule, weak=False)
+signals.post_delete.connect(docrule_revisions_data_cache.clear, sender=DocumentTypeRule, weak=False)
+signals.post_save.connect(docrule_revisions_data_cache.clear, sender=DoccodePluginMapping, weak=False)
+signals.post_delete.connect(docrule_revisions_data_cache.clear, sender=DoccodePluginMapping, weak=False)
+signals.post_save.connect(docrule_revisions_data_cache.clear, sender=CoreConfiguration, weak=False)
+signals.post_delete.connect(docrule_revisions_data_cache.clear, sender=CoreConfiguration, weak=False)
+
+
 class DMSOBjectRevisionsData(dict):
-    """Base object for DMS Object file data dict for HTTP responses"""
+    """Base object for DMS Object file data dict for HTTP responses
+
+    Data is serialized into JSON once, on first use of jsons.
+    Compact data (e.g. for many documents at once) has revision data of the current file revision only,
+    without all file revisions and document list URL, and is serialized without indentation."""
 
-    def __init__(self, dms_object):
+    def __init__(self, dms_object, compact=False):
         """Forms dict() for HTTP file revisions output of DMS"""
         d = {}
-        d['metadata'] = dms_object.get_file_revisions_data()
+        if not compact:
+            d['metadata'] = dms_object.get_file_revisions_data()
         d['current_metadata'] = dms_object.get_current_file_revision_data()
-        obj_rule = dms_object.get_docrule()
-        d['doccode'] = {'title': obj_rule.get_title(), 'id': obj_rule.get_id()}
+        docrule_data = docrule_revisions_data_cache.get(dms_object.get_docrule())
+        d['doccode'] = dict(docrule_data['doccode'])
         d['document_name'] = dms_object.get_filename()
         d['tags'] = dms_object.get_tags()
-        obj_mapping = obj_rule.get_docrule_plugin_mappings()
-        d['document_list_url'] = reverse("api_file_list", kwargs={'id_rule': obj_mapping.pk})
-        d['uncategorized'] = obj_rule.uncategorized
+        if not compact:
+            d['document_list_url'] = docrule_data['document_list_url']
+        d['uncategorized'] = docrule_data['uncategorized']
         if dms_object.db_info:
             d['indexing_data'] = self.format_indexes(dms_object.db_info)
         self.data = d
-        self.jsons = json.dumps(d, indent=4)
-        super(DMSOBjectRevisionsData, self).__init__(data=self.data, jsons=self.jsons)
+        self.compact = compact
+        self._jsons = None
+        super(DMSOBjectRevisionsData, self).__init__(data=self.data)
+
+    @property
+    def jsons(self):
+        if self._jsons is None:
+            if self.compact:
+                self._jsons = json.dumps(self.data, separators=(',', ':'))
+            else:
+                self._jsons = json.dumps(self.data, indent=4)
+        return self._jsons
 
     def __repr__(self):
         return self.jsons
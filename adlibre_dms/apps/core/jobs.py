@@ -0,0 +1,278 @@
+"""
+Module: DMS background jobs queue
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Persistent queue of jobs processed out of web requests by worker management commands.
+
+settings.JOBS_BACKEND may be:
+    'local' - default, SQLite database file JOBS_LOCAL_PATH shared by web and worker processes
+    dotted path to a callable, taking no arguments and returning an object with LocalJobQueue interface
+
+Worker management commands subclass WorkerCommand, setting the queue and the job function.
+"""
+
+import json
+import logging
+import multiprocessing
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils.importlib import import_module
+
+from core.errors import ConfigurationError
+
+log = logging.getLogger('core.jobs')
+
+__all__ = ['LocalJobQueue', 'WorkerCommand', 'get_job_queue', 'PENDING', 'RUNNING', 'DONE', 'FAILED']
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_job_queue = None
+_lock = threading.Lock()
+
+
+class LocalJobQueue(object):
+    """Jobs queue stored in SQLite database file. Safe to use from many threads and processes.
+
+    Job is a dict with keys: id, queue, payload (JSON serializable), status, attempts, result, error,
+    created and updated (unix timestamps)."""
+
+    fields = ('id', 'queue', 'payload', 'status', 'attempts', 'result', 'error', 'created', 'updated')
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connect().execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                available REAL NOT NULL
+            )""")
+        self.connect().execute('CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (queue, status, available)')
+
+    def connect(self):
+        """SQLite connection of current thread"""
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return self.local.connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def job_from_row(self, row):
+        job = dict(zip(self.fields, row))
+        job['payload'] = json.loads(job['payload'])
+        if job['result'] is not None:
+            job['result'] = json.loads(job['result'])
+        return job
+
+    def enqueue(self, queue, payload, unique=False):
+        """Adds a job to queue. Returns job id.
+
+        @param unique: do not add a job with the same payload already pending in queue, returning it's id"""
+        data = json.dumps(payload, sort_keys=True)
+        now = time.time()
+        with self.transaction() as connection:
+            if unique:
+                row = connection.execute(
+                    'SELECT id FROM jobs WHERE queue = ? AND status = ? AND payload = ?', (queue, PENDING, data)
+                ).fetchone()
+                if row:
+                    return row[0]
+            cursor = connection.execute(
+                'INSERT INTO jobs (queue, payload, status, created, updated, available) VALUES (?, ?, ?, ?, ?, ?)',
+                (queue, data, PENDING, now, now, now)
+            )
+            return cursor.lastrowid
+
+    def claim(self, queue, limit=1):
+        """Marks up to limit oldest available pending jobs of queue running and returns them"""
+        now = time.time()
+        with self.transaction() as connection:
+            rows = connection.execute(
+                'SELECT %s FROM jobs WHERE queue = ? AND status = ? AND available <= ? ORDER BY id LIMIT ?'
+                % ', '.join(self.fields), (queue, PENDING, now, limit)
+            ).fetchall()
+            jobs = [self.job_from_row(row) for row in rows]
+            for job in jobs:
+                job['status'] = RUNNING
+                job['attempts'] += 1
+                connection.execute(
+                    'UPDATE jobs SET status = ?, attempts = ?, updated = ? WHERE id = ?',
+                    (RUNNING, job['attempts'], now, job['id'])
+                )
+        return jobs
+
+    def complete(self, job_id, result=None):
+        self.connect().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = NULL, updated = ? WHERE id = ?',
+            (DONE, json.dumps(result), time.time(), job_id)
+        )
+
+    def fail(self, job_id, error, retry_in=None):
+        """Marks job failed, or pending again to be retried in retry_in seconds"""
+        now = time.time()
+        if retry_in is None:
+            status, available = FAILED, now
+        else:
+            status, available = PENDING, now + retry_in
+        self.connect().execute(
+            'UPDATE jobs SET status = ?, error = ?, updated = ?, available = ? WHERE id = ?',
+            (status, unicode(error), now, available, job_id)
+        )
+
+    def requeue_stale(self, queue, timeout):
+        """Returns jobs running longer than timeout seconds (e.g. of a killed worker) to pending"""
+        now = time.time()
+        cursor = self.connect().execute(
+            'UPDATE jobs SET status = ?, updated = ?, available = ? WHERE queue = ? AND status = ? AND updated < ?',
+            (PENDING, now, now, queue, RUNNING, now - timeout)
+        )
+        return cursor.rowcount
+
+    def get(self, job_id):
+        """Returns job or None"""
+        row = self.connect().execute(
+            'SELECT %s FROM jobs WHERE id = ?' % ', '.join(self.fields), (job_id, )
+        ).fetchone()
+        return row and self.job_from_row(row)
+
+    def find(self, queue, payload, status=PENDING):
+        """Returns the latest job of queue with payload and status or None"""
+        row = self.connect().execute(
+            'SELECT %s FROM jobs WHERE queue = ? AND status = ? AND payload = ? ORDER BY id DESC LIMIT 1'
+            % ', '.join(self.fields), (queue, status, json.dumps(payload, sort_keys=True))
+        ).fetchone()
+        return row and self.job_from_row(row)
+
+    def count(self, queue, status=PENDING):
+        return self.connect().execute(
+            'SELECT COUNT(*) FROM jobs WHERE queue = ? AND status = ?', (queue, status)
+        ).fetchone()[0]
+
+
+def get_job_queue():
+    """Returns jobs queue of the configured backend"""
+    global _job_queue
+    with _lock:
+        if _job_queue is None:
+            backend = getattr(settings, 'JOBS_BACKEND', 'local')
+            if backend == 'local':
+                _job_queue = LocalJobQueue(settings.JOBS_LOCAL_PATH)
+            else:
+                try:
+                    module_name, factory_name = backend.rsplit('.', 1)
+                    factory = getattr(import_module(module_name), factory_name)
+                except (ValueError, ImportError, AttributeError), e:
+                    raise ConfigurationError('Wrong JOBS_BACKEND setting "%s": %s' % (backend, e))
+                _job_queue = factory()
+        return _job_queue
+
+
+def close_connection():
+    """Pool processes must not share database connection of the parent process"""
+    connection.close()
+
+
+class WorkerCommand(BaseCommand):
+    """Base of management commands processing jobs of a queue in a pool of processes
+
+    Subclasses set queue, job function (called with a job payload in pool processes), settings prefix
+    of <PREFIX>_WORKER_PROCESSES, <PREFIX>_JOB_ATTEMPTS and <PREFIX>_JOB_TIMEOUT settings and job name for reports."""
+
+    queue = None
+    job = None
+    settings_prefix = None
+    job_name = 'Job'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--processes', '-p',
+            type='int',
+            default=None,
+            help='Number of worker processes. Defaults to <QUEUE>_WORKER_PROCESSES setting.'),
+        make_option(
+            '--once',
+            default=False,
+            action='store_true',
+            help='Exit when there are no more queued jobs instead of waiting for new ones.'),
+        make_option(
+            '--interval', '-i',
+            type='float',
+            default=5,
+            help='Seconds to wait for new jobs when the queue is empty.'),
+        make_option(
+            '--quiet', '-q',
+            default=False,
+            action='store_true',
+            help='Do not report processed jobs.'),
+    )
+
+    def get_setting(self, name, default):
+        return getattr(settings, '%s_%s' % (self.settings_prefix, name), default)
+
+    def get_job_outcome(self, value):
+        """Returns (error or None, result to store) of a value job function returned"""
+        return value, None
+
+    def handle(self, *args, **options):
+        processes = options['processes'] or self.get_setting('WORKER_PROCESSES', 2)
+        quiet = options['quiet']
+        attempts = self.get_setting('JOB_ATTEMPTS', 3)
+        queue = get_job_queue()
+        # Jobs of a killed worker
+        queue.requeue_stale(self.queue, self.get_setting('JOB_TIMEOUT', 600))
+        close_connection()
+        pool = multiprocessing.Pool(processes, initializer=close_connection)
+        try:
+            while True:
+                jobs = queue.claim(self.queue, limit=processes * 2)
+                if not jobs:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    continue
+                values = pool.map(self.job, [job['payload'] for job in jobs])
+                for job, value in zip(jobs, values):
+                    code = job['payload']['code']
+                    error, result = self.get_job_outcome(value)
+                    if error is None:
+                        queue.complete(job['id'], result)
+                        if not quiet:
+                            self.stdout.write('%s done: %s\n' % (self.job_name, code))
+                    elif job['attempts'] < attempts:
+                        # Document may be still processed by storage plugins
+                        queue.fail(job['id'], error, retry_in=options['interval'] * job['attempts'])
+                    else:
+                        queue.fail(job['id'], error)
+                        self.stderr.write('%s failed: %s: %s\n' % (self.job_name, code, error))
+        finally:
+            pool.close()
+            pool.join()
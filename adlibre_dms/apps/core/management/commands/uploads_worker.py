@@ -0,0 +1,24 @@
+"""
+Module: Asynchronous uploads worker for Adlibre DMS
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+"""
+
+from core.jobs import WorkerCommand
+from core.uploads import UPLOADS_QUEUE, process_upload_job
+
+
+class Command(WorkerCommand):
+    """Stores documents uploaded through API without waiting for their processing"""
+
+    queue = UPLOADS_QUEUE
+    job = staticmethod(process_upload_job)
+    settings_prefix = 'UPLOADS'
+    job_name = 'Upload processing'
+
+    help = "Processes queued asynchronous uploads."
+
+    def get_job_outcome(self, value):
+        return value
@@ -10,8 +10,10 @@ import logging
 import json
 log = logging.getLogger('core.parallel_keys')
 
+from django.conf import settings
+
 from mdt_manager import MetaDataTemplateManager
-from dmscouch.models import CouchDocument
+from core.autocomplete_index import autocomplete_index
 
 
 class ParallelKeysManager(object):
@@ -68,25 +70,19 @@ class ParallelKeysManager(object):
         return pkeys_list
 
 
-def process_pkeys_request(docrule_id, key_name, autocomplete_req, doc_mdts, letters_limit=2, suggestions_limit=8):
+def process_pkeys_request(docrule_id, key_name, autocomplete_req, doc_mdts, letters_limit=2, suggestions_limit=None):
     """Helper method to process MDT's for special user.
 
-    # We can collect all the documents keys for each docrule in MDT related to requested field and load them into queue.
-    # Then check them for duplicated values and/or make a big index with all the document's keys in it
-    # to fetch only document indexes we need on first request. (Instead of 'include_docs=True')
-    # E.g. Make autocomplete Couch View to output index with all Document's mdt_indexes ONLY.
-    #
-    # Total amount of requests will be 3 instead of 2 (for 2 docrules <> 1 MDT) but they will be smaller.
-    # And that will be good for say 1 000 000 documents. However, DB size will rise too.
-    # (Because we will copy all the doc's indexes into separate specific response for Typehead in fact)
-    # Final step is to load all unique suggestion documents that are passed through our filters.
-    # (Or if we will build this special index it won't be necessary)
-    # (Only if we require parallel keys to be parsed)
-    # It can be done by specifying multiple keys that we need to load here. ('key' ws 'keys' *args in CouchDB request)
+    Returns list of JSON encoded suggestions for autocomplete request.
+    Suggestions are served from in-process prefix index of documents keys (core.autocomplete_index),
+    instead of querying CouchDB on every keystroke.
+    Parallel keys suggestions contain all the parallel keys values of a document.
+
+    @param suggestions_limit: maximum suggestions returned, defaults to settings.AUTOCOMPLETE_SUGGESTIONS_LIMIT
     """
-    # TODO: Can be optimised for huge document's amounts in future (Step: Scalability testing)
+    if suggestions_limit is None:
+        suggestions_limit = getattr(settings, 'AUTOCOMPLETE_SUGGESTIONS_LIMIT', 8)
     resp = []
-    view_name = 'dmscouch/search_autocomplete'
     manager = ParallelKeysManager()
     for mdt in doc_mdts.itervalues():
         mdt_keys = [mdt[u'fields'][mdt_key][u'field_name'] for mdt_key in mdt[u'fields']]
@@ -101,50 +97,25 @@ def process_pkeys_request(docrule_id, key_name, autocomplete_req, doc_mdts, lett
                 # In case of search get only from selected MDT
                 mdt_fields = manager.get_parallel_keys_for_mdts(doc_mdts)
             pkeys = manager.get_parallel_keys_for_key(mdt_fields, key_name)
+            if pkeys:
+                # Making no action if not enough letters
+                if autocomplete_req.__len__() <= letters_limit:
+                    continue
+                # Suggestion for several parallel keys
+                fields = [pkey['field_name'] for pkey in pkeys]
+            else:
+                # Simple 'single' key suggestion
+                fields = [key_name]
             for docrule in mdt_docrules:
                 # Only search through another docrules if response is not full
-                if resp.__len__() > suggestions_limit:
+                if resp.__len__() >= suggestions_limit:
                     break
-                # db call to search in docs
-                if pkeys:
-                    # Making no action if not enough letters
-                    if autocomplete_req.__len__() > letters_limit:
-                        # Suggestion for several parallel keys
-                        documents = CouchDocument.view(
-                            view_name,
-                            startkey=[docrule, key_name, autocomplete_req],
-                            endkey=[docrule, key_name, unicode(autocomplete_req)+u'\ufff0'],
-                            include_docs=True,
-                            reduce=False
-                        )
-                        # Adding each selected value to suggestions list
-                        for doc in documents:
-                            # Only append values until we've got 'suggestions_limit' results
-                            if resp.__len__() > suggestions_limit:
-                                break
-                            resp_array = {}
-                            if pkeys:
-                                for pkey in pkeys:
-                                    resp_array[pkey['field_name']] = doc.mdt_indexes[pkey['field_name']]
-                            suggestion = json.dumps(resp_array)
-                            # filtering from existing results
-                            if not suggestion in resp:
-                                resp.append(suggestion)
-                else:
-                    # Simple 'single' key suggestion
-                    documents = CouchDocument.view(
-                        view_name,
-                        startkey=[docrule, key_name, autocomplete_req],
-                        endkey=[docrule, key_name, unicode(autocomplete_req)+u'\ufff0'],
-                        group=True,
-                    )
-                    # Fetching unique responses to suggestion set
-                    for doc in documents:
-                        # Only append values until we've got 'suggestions_limit' results
-                        if resp.__len__() > suggestions_limit:
-                            break
-                        resp_array = {key_name: doc['key'][2]}
-                        suggestion = json.dumps(resp_array)
-                        if not suggestion in resp:
-                            resp.append(suggestion)
-    return resp
\ No newline at end of file
+                suggestions = autocomplete_index.suggest(docrule, key_name, autocomplete_req, fields, suggestions_limit)
+                for suggestion in suggestions:
+                    suggestion = json.dumps(suggestion)
+                    # filtering from existing results
+                    if not suggestion in resp:
+                        resp.append(suggestion)
+                    if resp.__len__() >= suggestions_limit:
+                        break
+    return resp
@@ -16,10 +16,14 @@ Author: Iurii Garmash
 # 3. CouchDB plugin modifies workflow. Should not do that. Bug #1069
 
 import os
+import time
 import datetime
 import zlib
 import hashlib
 import json
+import shutil
+import struct
+import tempfile
 
 from couchdbkit import Server
 
@@ -28,14 +32,27 @@ from django.contrib.auth.models import User, Group
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.files.uploadedfile import UploadedFile
 
 from adlibre.dms.base_test import DMSTestCase
+from adlibre.converter import ConversionExecutor, ConversionError, ConversionTimeout, NewFileConverter
 
 from document_processor import DocumentProcessor
 from core.models import DocTags
+from core.models import Document
 from core.models import CoreConfiguration
 from core.models import DocumentTypeRule
+from core.autocomplete_index import AutocompleteIndex
+from couchlocal.database import LocalDatabase
+from dmscouch.models import CouchDocument
+from core.jobs import LocalJobQueue, PENDING, RUNNING, DONE, FAILED
+from dms_plugins.models import DoccodePluginMapping, PluginOption
+from dms_plugins.workers.storage.local import LocalFilesystemManager
+from dms_plugins.workers.validators.hashcode import HashCodeValidationOnStoragePlugin
+from dms_plugins.workers.validators.hashcode import HashCodeWorker
+from dms_plugins.workers.transfer.chunked import ChunkedFile, ChunkedFileError, FOOTER, compress_chunked
+from dms_plugins.workers.transfer.convert import ConversionCache, PreRenderForm
 
 
 class CoreTestCase(DMSTestCase):
@@ -118,7 +135,8 @@ class CoreTestCase(DMSTestCase):
             h.update(salt)
             return h.hexdigest()
         if compressed:
-            f_file = zlib.compress(fixtures_file.read())
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            f_file = compressor.compress(fixtures_file.read()) + compressor.flush()
             fixt_hashcode = get_hash(f_file)
         else:
             fixt_hashcode = get_hash(fixtures_file.read())
@@ -181,7 +199,11 @@ class CoreTestCase(DMSTestCase):
                 raise AssertionError('Should not contain revision 2 at this stage of testing')
         rev1 = file_rev_data['1']
         self.assertIn('compression_type', rev1)
-        self.assertEqual(rev1['compression_type'], 'GZIP')
+        if mimetype == 'image/jpeg':
+            # Already compressed files are stored as is
+            self.assertEqual(rev1['compression_type'], 'NONE')
+        else:
+            self.assertEqual(rev1['compression_type'], 'GZIP')
         self.assertIn('created_date', rev1)
         try:
             datetime.datetime.strptime(rev1['created_date'], settings.DATETIME_FORMAT)
@@ -551,7 +573,8 @@ class DocumentProcessorTest(CoreTestCase):
             raise AssertionError('Should not contain revision 2 at this stage of testing')
         rev1 = file_rev_data[1]
         self.assertIn('compression_type', rev1)
-        self.assertEqual(rev1['compression_type'], 'GZIP')
+        # JPEG is already compressed and is stored as is
+        self.assertEqual(rev1['compression_type'], 'NONE')
         self.assertIn('created_date', rev1)
         try:
             datetime.datetime.strptime(rev1['created_date'], settings.DATETIME_FORMAT)
@@ -570,7 +593,7 @@ class DocumentProcessorTest(CoreTestCase):
         if os.path.isfile(path):
             raise AssertionError('Revision 2 file should be absent')
         # Proper files in proper places with proper data
-        self._check_files_equal(self._get_fixtures_file(file_code, extension='jpg'), open(path1, 'r'))
+        self._check_files_equal(self._get_fixtures_file(file_code, extension='jpg'), open(path1, 'r'), compressed=False)
         file_2 = self._get_fixtures_file(file_code, extension='jpg')
         hash_code1, hash_code2 = self._check_files_equal(file_2, open(json_path, 'r'), check=False)
         if hash_code1 == hash_code2:
@@ -1206,6 +1229,46 @@ class DocumentProcessorTest(CoreTestCase):
             raise AssertionError('DocumentProcessor errors for reading a thumbnail %s' % self.processor.errors)
         self.assertNotEqual(doc.thumbnail, thumbnail_1)
 
+    def test_37_exists_probe(self):
+        """Existence probe used by create finds file revisions and 0 revisions (indexes only) documents"""
+        for code, exists in [(self.documents_pdf[0], True), (self.documents_pdf[3], True), ('ADL-9999', False)]:
+            doc = Document()
+            doc.set_filename(code)
+            self.assertEqual(self.processor.exists(doc), exists)
+
+    def test_38_plugin_options(self):
+        """Per docrule plugin options are applied and resolved without queries"""
+        doc = Document()
+        doc.set_filename(self.documents_pdf[0])
+        docrule = doc.get_docrule()
+        plugin = HashCodeValidationOnStoragePlugin()
+        self.assertEqual(plugin.get_option('method', docrule), 'md5')
+        option = PluginOption.objects.create(
+            plugin=plugin.get_model(),
+            pluginmapping=DoccodePluginMapping.objects.get(doccode=docrule.get_id()),
+            name='method',
+            value='sha1',
+        )
+        self.assertEqual(plugin.get_option('method', docrule), 'sha1')
+        with self.assertNumQueries(0):
+            plugin.get_option('method', docrule)
+        option.delete()
+        self.assertEqual(plugin.get_option('method', docrule), 'md5')
+
+    def test_39_thumbnail_sizes(self):
+        """Thumbnails of configured sizes are generated and stored separately"""
+        code = self.documents_pdf[0]
+        doc = self.processor.read(code, options={'user': self.admin_user, 'thumbnail': True})
+        default_thumbnail = doc.thumbnail
+        doc = self.processor.read(code, options={'user': self.admin_user, 'thumbnail': True, 'thumbnail_size': 'large'})
+        if self.processor.errors or not doc.thumbnail:
+            raise AssertionError('DocumentProcessor errors for reading a thumbnail %s' % self.processor.errors)
+        self.assertNotEqual(doc.thumbnail, default_thumbnail)
+        large_path = self._chek_thumbnails_created(code, doc.get_docrule())[:-len('.png')] + '.large.png'
+        self.assertTrue(os.path.isfile(large_path))
+        self.processor.read(code, options={'user': self.admin_user, 'thumbnail': True, 'thumbnail_size': 'huge'})
+        self.assertTrue(self.processor.errors)
+
     def test_zz_cleanup(self):
         """Cleaning alll the docs and data that are touched or used in those tests"""
         for code in self.documents_pdf:
@@ -1256,3 +1319,362 @@ class DocCodeModelTest(TestCase):
             self.assertEquals(obj.allocate_barcode(), result)
             self.assertEquals(obj.get_last_document_number(), 1001)
 
+
+class AutocompleteIndexTest(TestCase):
+    """Prefix index of secondary keys used for autocomplete"""
+
+    def setUp(self):
+        self.index = AutocompleteIndex()
+        # Docrule loaded and changes feed just checked. No CouchDB requests.
+        self.index.documents['2'] = {}
+        self.index.values['2'] = {}
+        self.index.last_seq = 0
+        self.index.checked = time.time()
+        for code, name, employee_id in [('ADL-0001', 'Iurii', '1'), ('ADL-0002', 'ivan', '2'),
+                                        ('ADL-0003', 'Ivan', '2'), ('ADL-0004', 'Ivanka', '3')]:
+            self.index.update_document({
+                '_id': code,
+                'doc_type': 'CouchDocument',
+                'metadata_doc_type_rule_id': '2',
+                'mdt_indexes': {'Employee Name': name, 'Employee ID': employee_id},
+            })
+
+    def test_prefix_suggestions(self):
+        suggestions = self.index.suggest('2', 'Employee Name', 'IVA', ['Employee ID'], 8)
+        self.assertEqual(suggestions, [{'Employee ID': '2'}, {'Employee ID': '3'}])
+        suggestions = self.index.suggest('2', 'Employee Name', 'i', ['Employee Name'], 2)
+        self.assertEqual(len(suggestions), 2)
+
+    def test_index_maintained(self):
+        self.assertEqual(len(self.index.suggest('2', 'Employee Name', 'ivank', ['Employee ID'], 8)), 1)
+        self.index.update_document({
+            '_id': 'ADL-0004',
+            'doc_type': 'CouchDocument',
+            'metadata_doc_type_rule_id': '2',
+            'deleted': 'deleted',
+        })
+        self.assertEqual(self.index.suggest('2', 'Employee Name', 'ivank', ['Employee ID'], 8), [])
+        self.index.remove_document('ADL-0001')
+        self.assertEqual(self.index.suggest('2', 'Employee Name', 'iu', ['Employee ID'], 8), [])
+
+    def test_changes_of_empty_database(self):
+        db = LocalDatabase('dmscouch_test', app_label='dmscouch')
+        self.addCleanup(CouchDocument.set_db, CouchDocument.get_db())
+        CouchDocument.set_db(db)
+        index = AutocompleteIndex()
+        index.sync()
+        # Update sequence of empty database is 0
+        self.assertEqual(index.last_seq, 0)
+        index.documents['2'] = {}
+        index.values['2'] = {}
+        # Stored by other process
+        db.save_doc({
+            '_id': 'ADL-0005',
+            'doc_type': 'CouchDocument',
+            'metadata_doc_type_rule_id': '2',
+            'mdt_indexes': {'Employee Name': 'Ivan'},
+        })
+        index.checked = 0
+        index.sync()
+        self.assertEqual(index.documents['2'], {'ADL-0005': {'Employee Name': 'Ivan'}})
+
+
+class ChunkedCompressionTest(TestCase):
+    """Seekable container of independently compressed chunks"""
+
+    def setUp(self):
+        self.data = ''.join(['%06d' % number for number in range(10000)])
+        self.stored = tempfile.TemporaryFile()
+        source = tempfile.TemporaryFile()
+        source.write(self.data)
+        source.seek(0)
+        self.assertEqual(compress_chunked(source, self.stored, chunk_size=1000)[0], len(self.data))
+
+    def test_read(self):
+        chunked = ChunkedFile(self.stored)
+        self.assertEqual(len(chunked), len(self.data))
+        self.assertEqual(chunked.read(), self.data)
+        self.assertEqual(chunked.read(), '')
+        chunked.seek(0)
+        self.assertEqual(''.join(chunked.chunks()), self.data)
+
+    def test_seek(self):
+        chunked = ChunkedFile(self.stored)
+        chunked.seek(1995)
+        self.assertEqual(chunked.read(10), self.data[1995:2005])
+        self.assertEqual(chunked.tell(), 2005)
+        # Only the chunk read is decompressed
+        self.assertEqual(chunked.chunk_number, 2)
+        chunked.seek(-6, 2)
+        self.assertEqual(chunked.read(100), '009999')
+
+    def test_not_chunked(self):
+        not_chunked = tempfile.TemporaryFile()
+        not_chunked.write(zlib.compress(self.data))
+        self.assertRaises(ChunkedFileError, ChunkedFile, not_chunked)
+
+    def test_corrupted(self):
+        # Original size in footer larger than chunks contents
+        self.stored.seek(-struct.calcsize(FOOTER), 2)
+        footer = list(struct.unpack(FOOTER, self.stored.read()))
+        footer[0] += 1000
+        self.stored.seek(-struct.calcsize(FOOTER), 2)
+        self.stored.write(struct.pack(FOOTER, *footer))
+        chunked = ChunkedFile(self.stored)
+        self.assertEqual(chunked.name, None)
+        self.assertRaises(ChunkedFileError, chunked.read)
+
+
+class HashCodeWorkerTest(TestCase):
+    """Streaming hashing and verification cache of stored files hashcodes"""
+
+    def setUp(self):
+        self.worker = HashCodeWorker('md5')
+        self.stored = tempfile.NamedTemporaryFile()
+        self.stored.write('stored file contents' * 10000)
+        self.stored.flush()
+
+    def test_file_hash(self):
+        self.stored.seek(0)
+        self.assertEqual(
+            self.worker.get_file_hash(self.stored, 'md5'),
+            self.worker.get_hash('stored file contents' * 10000, 'md5')
+        )
+
+    def test_verification_cache(self):
+        document = Document()
+        document.set_fullpath(self.stored.name)
+        hashcode = self.worker.get_stored_file_hash(document, 'md5')
+        # Unchanged stored file is not read again
+        document.set_file_obj(None)
+        document.set_fullpath(self.stored.name)
+        self.worker.get_file_hash = lambda *args: self.fail('Unchanged file hashed again')
+        self.assertEqual(self.worker.get_stored_file_hash(document, 'md5'), hashcode)
+        del self.worker.get_file_hash
+        self.stored.write('modified')
+        self.stored.flush()
+        document.set_file_obj(None)
+        self.assertNotEqual(self.worker.get_stored_file_hash(document, 'md5'), hashcode)
+
+
+class BlobStoreTest(TestCase):
+    """Deduplication of stored files contents"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.filesystem = LocalFilesystemManager()
+        self.source = tempfile.TemporaryFile()
+        self.source.write('scanned file contents')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_deduplication(self):
+        with override_settings(DOCUMENT_ROOT=self.root, DOCUMENT_DEDUPLICATION=True):
+            first = os.path.join(self.root, 'ADL-0001_r1.pdf')
+            second = os.path.join(self.root, 'ADL-0002_r1.pdf')
+            self.assertTrue(self.filesystem.store_file(self.source, first))
+            self.assertTrue(self.filesystem.store_file(self.source, second))
+            blob_path = self.filesystem.blobs.get_path(self.filesystem.blobs.get_digest(self.source))
+            self.assertTrue(os.path.samefile(first, second))
+            self.assertEqual(os.stat(blob_path).st_nlink, 3)
+            self.assertTrue(self.filesystem.remove_file(first))
+            self.assertTrue(os.path.exists(blob_path))
+            self.assertTrue(self.filesystem.remove_file(second))
+            self.assertFalse(os.path.exists(blob_path))
+
+    def test_overwrite_does_not_change_blob(self):
+        with override_settings(DOCUMENT_ROOT=self.root, DOCUMENT_DEDUPLICATION=True):
+            first = os.path.join(self.root, 'ADL-0001_r1.pdf')
+            second = os.path.join(self.root, 'ADL-0002_r1.pdf')
+            self.filesystem.store_file(self.source, first)
+            self.filesystem.store_file(self.source, second)
+            other = tempfile.TemporaryFile()
+            other.write('other contents')
+            self.filesystem.store_file(other, second)
+            self.assertEqual(open(first).read(), 'scanned file contents')
+            self.assertEqual(open(second).read(), 'other contents')
+
+
+class LocalJobQueueTest(TestCase):
+    """SQLite background jobs queue"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = LocalJobQueue(os.path.join(self.directory, 'jobs.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_jobs_lifecycle(self):
+        job_id = self.queue.enqueue('thumbnails', {'code': 'ADL-0001'}, unique=True)
+        self.assertEqual(self.queue.enqueue('thumbnails', {'code': 'ADL-0001'}, unique=True), job_id)
+        self.queue.enqueue('thumbnails', {'code': 'ADL-0002'})
+        jobs = self.queue.claim('thumbnails', limit=1)
+        self.assertEqual([job['payload'] for job in jobs], [{'code': 'ADL-0001'}])
+        self.assertEqual(self.queue.get(job_id)['status'], RUNNING)
+        self.queue.complete(job_id, {'thumbnail': True})
+        self.assertEqual(self.queue.get(job_id)['status'], DONE)
+        self.assertEqual(self.queue.get(job_id)['result'], {'thumbnail': True})
+        second = self.queue.claim('thumbnails', limit=10)[0]
+        self.queue.fail(second['id'], 'Not found', retry_in=60)
+        # Not available for retry yet
+        self.assertEqual(self.queue.claim('thumbnails'), [])
+        self.assertEqual(self.queue.get(second['id'])['status'], PENDING)
+        self.queue.fail(second['id'], 'Not found')
+        self.assertEqual(self.queue.get(second['id'])['status'], FAILED)
+        self.assertEqual(self.queue.find('thumbnails', {'code': 'ADL-0002'}, FAILED)['id'], second['id'])
+        self.assertEqual(self.queue.find('thumbnails', {'code': 'ADL-0002'}), None)
+        self.assertEqual(self.queue.get(100), None)
+
+    def test_requeue_stale(self):
+        job_id = self.queue.enqueue('thumbnails', {'code': 'ADL-0001'})
+        self.queue.claim('thumbnails')
+        self.assertEqual(self.queue.requeue_stale('thumbnails', 60), 0)
+        self.assertEqual(self.queue.requeue_stale('thumbnails', -1), 1)
+        self.assertEqual(self.queue.claim('thumbnails')[0]['attempts'], 2)
+
+
+class ConversionCacheTest(TestCase):
+    """Cache of converted documents files"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = ConversionCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def get_document(self, code, revision=1, hashcode='abc'):
+        document = Document()
+        document.file_name = code
+        document.set_fullpath(os.path.join(self.root, '%s_r%s.tif' % (code, revision)))
+        document.update_current_file_revision_data({'hashcode': hashcode})
+        return document
+
+    def cache_converted(self, document, extension):
+        output = self.cache.create(document, extension)
+        output.write('converted contents')
+        # As converters do
+        output.seek(0)
+        self.cache.commit(document, extension, output).close()
+
+    def test_cache_by_revision_and_hashcode(self):
+        with override_settings(DOCUMENT_ROOT=self.root):
+            document = self.get_document('ADL-0001')
+            self.assertEqual(self.cache.get(document, 'pdf'), None)
+            self.cache_converted(document, 'pdf')
+            self.assertEqual(self.cache.get(document, 'pdf').read(), 'converted contents')
+            self.assertEqual(self.cache.get_mimetype('pdf', self.cache.get(document, 'pdf')), 'application/pdf')
+            self.assertEqual(self.cache.get(document, 'txt'), None)
+            self.assertEqual(self.cache.get(self.get_document('ADL-0001', revision=2), 'pdf'), None)
+            self.assertEqual(self.cache.get(self.get_document('ADL-0001', hashcode='def'), 'pdf'), None)
+            self.cache.remove(document)
+            self.assertEqual(self.cache.get(document, 'pdf'), None)
+
+    def test_conversion_written_into_cache(self):
+        with override_settings(DOCUMENT_ROOT=self.root):
+            document = self.get_document('ADL-0001')
+            output = self.cache.create(document, 'txt')
+            output.write('converted contents')
+            self.assertEqual(self.cache.get(document, 'txt'), None)
+            self.assertEqual(self.cache.commit(document, 'txt', output).read(), 'converted contents')
+            self.assertEqual(self.cache.get(document, 'txt').read(), 'converted contents')
+            self.assertEqual(os.listdir(os.path.dirname(self.cache.get_path(document, 'txt'))), [
+                os.path.basename(self.cache.get_path(document, 'txt'))
+            ])
+
+    def test_derived_conversions(self):
+        size = len('converted contents')
+        with override_settings(DOCUMENT_ROOT=self.root, CONVERSIONS_CACHE_SIZE=size):
+            document = self.get_document('ADL-0001')
+            output = self.cache.create(document, 'pdf', derived=True)
+            output.write('pre-rendered contents')
+            self.cache.commit(document, 'pdf', output, derived=True)
+            self.assertTrue(self.cache.get_path(document, 'pdf', derived=True).startswith(
+                os.path.join(self.root, 'conversions_storage')
+            ))
+            # Derived conversions are served first and never evicted
+            self.cache_converted(document, 'pdf')
+            self.cache_converted(self.get_document('ADL-0002'), 'pdf')
+            self.assertEqual(self.cache.get(document, 'pdf').read(), 'pre-rendered contents')
+            self.cache.remove(document)
+            self.assertEqual(self.cache.get(document, 'pdf'), None)
+
+    def test_pre_render_option(self):
+        form = PreRenderForm([], {'pre_render': ' .PDF, txt,, '})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['pre_render'], 'pdf,txt')
+
+    def test_least_recently_used_eviction(self):
+        size = len('converted contents')
+        with override_settings(DOCUMENT_ROOT=self.root, CONVERSIONS_CACHE_SIZE=size * 2):
+            first, second, third = [self.get_document('ADL-000%s' % number) for number in range(1, 4)]
+            self.cache_converted(first, 'pdf')
+            self.cache_converted(second, 'pdf')
+            # Making first conversion used later then second
+            for document, used in ((first, 200), (second, 100)):
+                path = self.cache.get_path(document, 'pdf')
+                os.utime(path, (time.time() - used, time.time() - used))
+            self.cache.get(first, 'pdf')
+            # Conversions being written are not evicted
+            writing = self.cache.create(self.get_document('ADL-0004'), 'pdf')
+            writing.write('converted contents')
+            writing.flush()
+            self.cache_converted(third, 'pdf')
+            self.assertNotEqual(self.cache.get(first, 'pdf'), None)
+            self.assertEqual(self.cache.get(second, 'pdf'), None)
+            self.assertNotEqual(self.cache.get(third, 'pdf'), None)
+            self.assertTrue(os.path.exists(writing.name))
+
+    def test_estimated_size_eviction(self):
+        size = len('converted contents')
+        with override_settings(DOCUMENT_ROOT=self.root, CONVERSIONS_CACHE_SIZE=size):
+            first, second = self.get_document('ADL-0001'), self.get_document('ADL-0002')
+            self.cache_converted(first, 'pdf')
+            path = self.cache.get_path(first, 'pdf')
+            os.utime(path, (time.time() - 100, time.time() - 100))
+            # Estimate of committed rewound conversion goes over the limit before the scan interval passes
+            self.cache_converted(second, 'pdf')
+            self.assertFalse(os.path.exists(path))
+            self.assertNotEqual(self.cache.get(second, 'pdf'), None)
+
+
+class ConversionExecutorTest(TestCase):
+    """Bounded external converters execution"""
+
+    def setUp(self):
+        self.executor = ConversionExecutor(max_processes=1, timeout=1)
+
+    def test_pipeline(self):
+        source = tempfile.TemporaryFile()
+        source.write('converted contents')
+        source.seek(0)
+        output = tempfile.TemporaryFile()
+        self.executor.run([['cat'], ['tr', 'a-z', 'A-Z']], stdin=source, stdout=output)
+        output.seek(0)
+        self.assertEqual(output.read(), 'CONVERTED CONTENTS')
+        self.assertEqual(self.executor.get_metrics()['completed'], 1)
+
+    def test_failures(self):
+        self.assertRaises(ConversionError, self.executor.run, [['false']])
+        self.assertRaises(ConversionTimeout, self.executor.run, [['sleep', '5']])
+        metrics = self.executor.get_metrics()
+        self.assertEqual((metrics['failed'], metrics['timed_out'], metrics['running']), (1, 1, 0))
+
+    def test_converter_reads_stored_file(self):
+        stored = tempfile.NamedTemporaryFile(suffix='.txt')
+        stored.write('converted contents')
+        stored.flush()
+        converter = NewFileConverter(open(stored.name, 'rb'), stored.name, 'pdf', executor=self.executor)
+        self.assertTrue(converter.can_convert())
+        self.assertEqual(converter.get_input_path(), stored.name)
+        self.assertEqual(converter.temp_input, None)
+        # Decompressed files are copied for converters
+        decompressed = tempfile.TemporaryFile()
+        decompressed.write('converted contents')
+        converter = NewFileConverter(decompressed, stored.name, 'pdf', executor=self.executor)
+        self.assertEqual(open(converter.get_input_path()).read(), 'converted contents')
+        self.assertNotEqual(converter.get_input_path(), stored.name)
+        self.assertFalse(NewFileConverter(decompressed, stored.name, 'txt').can_convert())
+        self.assertFalse(NewFileConverter(decompressed, stored.name, 'doc').can_convert())
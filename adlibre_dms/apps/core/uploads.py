@@ -0,0 +1,113 @@
+"""
+Module: DMS asynchronous uploads
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Uploads accepted without waiting for their processing are copied into
+settings.DOCUMENT_ROOT/settings.UPLOADS_STAGING_DIRECTORY and queued into UPLOADS_QUEUE jobs queue.
+'uploads_worker' command runs documents storage (or update) plugins for them and removes staged files.
+Job result is {"code": document code, "revision": stored revision} of processed upload.
+"""
+
+import errno
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import UploadedFile
+
+from core.document_processor import DocumentProcessor
+from core.jobs import get_job_queue
+
+log = logging.getLogger('core.uploads')
+
+__all__ = ['UPLOADS_QUEUE', 'enqueue_upload', 'process_upload_job']
+
+UPLOADS_QUEUE = 'uploads'
+
+
+def get_staging_directory():
+    directory = os.path.join(settings.DOCUMENT_ROOT, getattr(settings, 'UPLOADS_STAGING_DIRECTORY', '.staging'))
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    return directory
+
+
+def stage_upload(uploaded_file):
+    """Copies uploaded file into staging directory. Returns path of staged file."""
+    staged = tempfile.NamedTemporaryFile(dir=get_staging_directory(), prefix='upload-', delete=False)
+    try:
+        for chunk in uploaded_file.chunks():
+            staged.write(chunk)
+    except:
+        staged.close()
+        os.remove(staged.name)
+        raise
+    staged.close()
+    return staged.name
+
+
+def enqueue_upload(action, code, uploaded_file, user, options=None):
+    """Stages uploaded file and queues it's processing. Returns job id.
+
+    @param action: 'create' or 'update' for a new document or a new revision of existing one
+    @param code: document code
+    @param uploaded_file: Django UploadedFile() instance
+    @param user: Django User() instance uploading the file
+    @param options: JSON serializable DocumentProcessor() options, besides file and user
+    """
+    path = stage_upload(uploaded_file)
+    payload = {
+        'action': action,
+        'code': code,
+        'path': path,
+        'name': uploaded_file.name,
+        'content_type': getattr(uploaded_file, 'content_type', None),
+        'user': user.pk,
+        'options': options or {},
+    }
+    try:
+        return get_job_queue().enqueue(UPLOADS_QUEUE, payload)
+    except:
+        os.remove(path)
+        raise
+
+
+def process_upload_job(payload):
+    """Runs storage or update plugins for a staged upload. Returns (error or None, result).
+
+    Staged file is removed after processing, so a failed upload is not retried.
+    Runs in 'uploads_worker' command processes."""
+    code = payload['code']
+    path = payload['path']
+    try:
+        user = User.objects.get(pk=payload['user'])
+        options = dict(payload['options'], user=user)
+        processor = DocumentProcessor()
+        with open(path, 'rb') as staged:
+            uploaded_file = UploadedFile(
+                staged, payload['name'], content_type=payload['content_type'], size=os.path.getsize(path)
+            )
+            if payload['action'] == 'update':
+                options['update_file'] = uploaded_file
+                document = processor.update(code, options)
+            else:
+                document = processor.create(uploaded_file, options)
+        if processor.errors:
+            error = processor.errors[0]
+            return unicode(getattr(error, 'parameter', error)), None
+        result = {'code': document.get_code(), 'revision': document.get_revision()}
+    except Exception, e:
+        log.error('Upload job for %s failed: %s' % (code, e))
+        return unicode(e), None
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return None, result
@@ -0,0 +1,21 @@
+"""
+Module: Conversions pre-rendering worker for Adlibre DMS
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+"""
+
+from core.jobs import WorkerCommand
+from dms_plugins.workers.transfer.convert import CONVERSIONS_QUEUE, pre_render_job
+
+
+class Command(WorkerCommand):
+    """Converts documents queued by 'Pre-render Conversions' plugins on documents storage and update"""
+
+    queue = CONVERSIONS_QUEUE
+    job = staticmethod(pre_render_job)
+    settings_prefix = 'CONVERSIONS'
+    job_name = 'Pre-rendering'
+
+    help = "Processes queued conversions pre-rendering jobs."
@@ -0,0 +1,21 @@
+"""
+Module: Thumbnails pre-generation worker for Adlibre DMS
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+"""
+
+from core.jobs import WorkerCommand
+from dms_plugins.workers.transfer.thumbnails import THUMBNAILS_QUEUE, generate_thumbnail_job
+
+
+class Command(WorkerCommand):
+    """Generates thumbnails queued by 'Thumbnails Queue' plugins on documents storage and update"""
+
+    queue = THUMBNAILS_QUEUE
+    job = staticmethod(generate_thumbnail_job)
+    settings_prefix = 'THUMBNAILS'
+    job_name = 'Thumbnail generation'
+
+    help = "Processes queued thumbnails generation jobs."
@@ -7,7 +7,10 @@ License: See LICENSE for license information
 """
 
 from django.db import models
+from django.db.models import signals
 import logging
+import threading
+import time
 
 from djangoplugins.fields import ManyPluginField
 from djangoplugins.models import Plugin
@@ -148,3 +151,44 @@ class PluginOption(models.Model):
 
     def __unicode__(self):
         return "%s: %s" % (self.name, self.value)
+
+
+class PluginOptionsCache(object):
+    """In-process cache of plugin options configured per docrule
+
+    Loads all options of a docrule plugin mapping with one query.
+    Cleared on any PluginOption or DoccodePluginMapping change in this process
+    and reloaded every 5 minutes to see changes of other processes."""
+
+    cache_options_for = 300  # 5 minutes
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self, **kwargs):
+        with self.lock:
+            # {docrule_id: (loaded time, {(plugin name, option name): value})}
+            self.options = {}
+
+    def get_docrule_options(self, docrule_id):
+        with self.lock:
+            loaded, options = self.options.get(docrule_id, (0, None))
+            if options is None or time.time() - loaded > self.cache_options_for:
+                options = {}
+                plugin_options = PluginOption.objects.filter(pluginmapping__doccode=docrule_id)
+                for option in plugin_options.select_related('plugin').order_by('pk'):
+                    options.setdefault((option.plugin.name, option.name), option.value)
+                self.options[docrule_id] = (time.time(), options)
+            return options
+
+    def get(self, docrule_id, plugin_name, name, default=None):
+        """Returns option value configured for plugin in docrule mapping or default"""
+        return self.get_docrule_options(docrule_id).get((plugin_name, name), default)
+
+plugin_options_cache = PluginOptionsCache()
+
+signals.post_save.connect(plugin_options_cache.clear, sender=PluginOption, weak=False)
+signals.post_delete.connect(plugin_options_cache.clear, sender=PluginOption, weak=False)
+signals.post_save.connect(plugin_options_cache.clear, sender=DoccodePluginMapping, weak=False)
+signals.post_delete.connect(plugin_options_cache.clear, sender=DoccodePluginMapping, weak=False)
@@ -66,6 +66,51 @@ class PluginsOperator(object):
                 break
         return document
 
+    def process_pluginpoint_many(self, pluginpoint, documents):
+        """
+        Executes plugins of a pluginpoint for many documents of one document type rule at once.
+
+        Plugins having work_many() method process all the documents together (e.g. with one database request),
+        others process them one by one. Documents failed by a plugin are not processed further.
+        Returns list of processed documents and dict of plugin errors by document code.
+
+        @param pluginpoint: a special DMS internal set of plugins to be executed
+        @param documents: list of DMS Document() instances of the same document type rule
+        """
+        errors = {}
+        finished = []
+        if not documents:
+            return documents, errors
+        plugins = self.get_plugins_for_point(pluginpoint, documents[0])
+        for plugin in plugins:
+            if not documents:
+                break
+            if hasattr(plugin, 'work_many'):
+                try:
+                    documents, plugin_errors = plugin.work_many(documents)
+                except PluginError, e:
+                    plugin_errors = dict((document.get_code(), e) for document in documents)
+                    documents = []
+                errors.update(plugin_errors)
+                continue
+            processed = []
+            for document in documents:
+                try:
+                    processed.append(plugin.work(document))
+                except PluginError, e:
+                    errors[document.get_code()] = e
+                except PluginWarning, e:
+                    self.plugin_warnings.append(str(e))
+                    processed.append(document)
+                except BreakPluginChain:
+                    finished.append(document)
+            documents = processed
+        for code, error in errors.iteritems():
+            self.plugin_errors.append(error)
+            if settings.DEBUG:
+                log.error('process_pluginpoint_many: %s: %s.' % (code, error))
+        return finished + documents, errors
+
     def get_plugins_from_mapping(self, mapping, pluginpoint, plugin_type):
         """Extracts and instantiates Plugin() objects from given plugin mapping.
 
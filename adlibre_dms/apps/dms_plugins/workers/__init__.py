@@ -10,7 +10,7 @@ from djangoplugins.models import Plugin as DjangoPlugin, ENABLED
 from djangoplugins.utils import get_plugin_name
 
 from core.errors import DmsException
-from dms_plugins.models import PluginOption
+from dms_plugins.models import PluginOption, plugin_options_cache
 
 
 class Plugin(object):
@@ -65,16 +65,9 @@ class Plugin(object):
         return self.title + ": " + self.description
 
     def get_option(self, option, docrule):
-        value = getattr(self, option, None)
-        try:
-            PluginOption.objects.filter(
-                plugin=self.get_model(),
-                pluginmapping__doccode=docrule.get_id(),
-                name=option
-            )
-        except PluginOption.DoesNotExist:
-            pass
-        return value
+        """Returns plugin option value configured for docrule or plugin's default"""
+        default = getattr(self, option, None)
+        return plugin_options_cache.get(docrule.get_id(), get_plugin_name(self.__class__), option, default)
 
 
 class PluginError(DmsException):
@@ -19,7 +19,9 @@ from core.models import DocTags
 from dms_plugins.workers import Plugin, PluginError
 from core.document_processor import DocumentProcessor
 from dmscouch.models import CouchDocument
+from core.autocomplete_index import autocomplete_index
 
+from couchdbkit.exceptions import BulkSaveError
 from couchdbkit.resource import ResourceNotFound
 
 log = logging.getLogger('plugins.workers.database.couchdb')
@@ -100,7 +102,12 @@ class CouchDBMetadataWorker(object):
                 couchdoc = CouchDocument()
 
                 couchdoc.populate_from_dms(user, document)
-                couchdoc.save(force_update=True)
+                database_batch = document.get_option('database_batch')
+                if database_batch is not None:
+                    # Saved with other documents of the batch by save_couchdocs()
+                    database_batch.append(couchdoc)
+                else:
+                    self.save_couchdoc(couchdoc, force_update=True)
                 return document
 
     def update_document_metadata(self, document):
@@ -114,7 +121,7 @@ class CouchDBMetadataWorker(object):
             # We need to create couchdb document in case it does not exists in database.
             couchdoc = CouchDocument.get_or_create(docid=name)
             couchdoc.update_file_revisions_metadata(document)
-            couchdoc.save()
+            self.save_couchdoc(couchdoc)
         if document.old_docrule:
             old_couchdoc = None
             couchdoc = CouchDocument.get_or_create(docid=document.file_name)
@@ -126,18 +133,18 @@ class CouchDBMetadataWorker(object):
             if old_couchdoc:
                 # Migrate from existing CouchDB document
                 couchdoc.migrate_metadata_for_docrule(document, old_couchdoc)
-                couchdoc.save()
-                old_couchdoc.delete()
+                self.save_couchdoc(couchdoc)
+                self.delete_couchdoc(old_couchdoc)
             else:
                 # store from current Document() instance
                 user = document.user
                 couchdoc.populate_from_dms(user, document)
-                couchdoc.save()
+                self.save_couchdoc(couchdoc)
         # We have to do it after moving document names.
         if document.new_indexes and document.file_name:
             couchdoc = CouchDocument.get(docid=document.file_name)
             couchdoc.update_indexes_revision(document)
-            couchdoc.save()
+            self.save_couchdoc(couchdoc)
             document = couchdoc.populate_into_dms(document)
         return document
 
@@ -149,10 +156,14 @@ class CouchDBMetadataWorker(object):
         """
         # Doing nothing for mark deleted call
         code = document.get_code()
-        couchdoc = CouchDocument.get(docid=code)
+        try:
+            couchdoc = CouchDocument.get(docid=code)
+        except ResourceNotFound:
+            # Not indexed, e.g. failed to save in a batch
+            return document
         if 'mark_deleted' in document.options.iterkeys():
             couchdoc['deleted'] = 'deleted'
-            couchdoc.save()
+            self.save_couchdoc(couchdoc)
             return document
         if 'mark_revision_deleted' in document.options.iterkeys():
             mark_revision = document.options['mark_revision_deleted']
@@ -160,16 +171,16 @@ class CouchDBMetadataWorker(object):
                 couchdoc.revisions[mark_revision]['deleted'] = True
             else:
                 raise PluginError('Object has no revision: %s' % mark_revision, 404)
-            couchdoc.save()
+            self.save_couchdoc(couchdoc)
             return document
         if 'delete_revision' in document.options.iterkeys():
             revision = document.options['delete_revision']
             del couchdoc.revisions[revision]
-            couchdoc.save()
+            self.save_couchdoc(couchdoc)
             return document
         if not document.get_file_obj():
             #doc is fully deleted from fs
-            couchdoc.delete()
+            self.delete_couchdoc(couchdoc)
         return document
 
     def retrieve(self, document):
@@ -201,9 +212,77 @@ class CouchDBMetadataWorker(object):
                 document = couchdoc.populate_into_dms(document)
                 return document
 
+    def retrieve_many(self, documents):
+        """Read CouchDB metadata of many documents of one docrule with one multi-key request.
+
+        @param documents: list of DMS Document() instances
+        Returns list of read documents and dict of errors by document code.
+        """
+        docrule = documents[0].get_docrule()
+        if docrule.uncategorized or not docrule.get_docrule_plugin_mappings().get_database_storage_plugins():
+            return documents, {}
+        self.check_user(documents[0])
+        try:
+            rows = CouchDocument.get_db().all_docs(
+                keys=[document.get_code() for document in documents],
+                include_docs=True
+            ).all()
+        except Exception, e:
+            raise PluginError('CouchDB error: %s' % e, 500)
+        rows = dict((row['key'], row) for row in rows)
+        processed = []
+        errors = {}
+        for document in documents:
+            row = rows.get(document.get_code(), {})
+            couchdoc = CouchDocument()
+            if row.get('doc'):
+                couchdoc = CouchDocument.wrap(row['doc'])
+            elif row.get('error', 'not_found') != 'not_found':
+                # Deleted documents come without 'doc' and missing ones with 'not_found' error (not used in DMS)
+                errors[document.get_code()] = PluginError('CouchDB error: %s' % row['error'], 500)
+                continue
+            processed.append(couchdoc.populate_into_dms(document))
+        return processed, errors
+
     ####################################################################################################################
     #############################################   Helper managers: ###################################################
     ####################################################################################################################
+    def save_couchdoc(self, couchdoc, **params):
+        """Saves CouchDB document keeping autocomplete index in sync"""
+        couchdoc.save(**params)
+        autocomplete_index.update_document(couchdoc.to_json())
+
+    def save_couchdocs(self, couchdocs):
+        """Saves many CouchDB documents with one bulk request keeping autocomplete index in sync
+
+        Documents conflicting with existing ones are overwritten one by one.
+        Returns dict of errors by document id."""
+        errors = {}
+        if not couchdocs:
+            return errors
+        failed = {}
+        try:
+            CouchDocument.save_docs(couchdocs)
+        except BulkSaveError, e:
+            failed = dict((error['id'], error['error']) for error in e.errors)
+        for couchdoc in couchdocs:
+            code = couchdoc.get_id
+            if not code in failed:
+                autocomplete_index.update_document(couchdoc.to_json())
+            elif failed[code] == 'conflict':
+                try:
+                    self.save_couchdoc(couchdoc, force_update=True)
+                except Exception, e:
+                    errors[code] = e
+            else:
+                errors[code] = failed[code]
+        return errors
+
+    def delete_couchdoc(self, couchdoc):
+        code = couchdoc.get_id
+        couchdoc.delete()
+        autocomplete_index.remove_document(code)
+
     def sync_document_tags(self, document):
         """Synchronise document's SQL tags between couchDB and SQL DB
 
@@ -243,6 +322,12 @@ class CouchDBMetadataRetrievalPlugin(Plugin, BeforeRetrievalPluginPoint):
         @param document: is a DMS Document() instance"""
         return self.worker.retrieve(document)
 
+    def work_many(self, documents):
+        """Reads all the documents with one CouchDB request
+
+        @param documents: list of DMS Document() instances of one docrule"""
+        return self.worker.retrieve_many(documents)
+
 
 class CouchDBMetadataStoragePlugin(Plugin, DatabaseStoragePluginPoint):
     title = "CouchDB Metadata Storage"
@@ -21,6 +21,16 @@ class TagsPlugin(Plugin, BeforeRetrievalPluginPoint):
         document.set_tags(tags)
         return document
 
+    def work_many(self, documents, **kwargs):
+        """Populates tags of many documents with one query"""
+        doc_models = DocTags.objects.filter(
+            name__in=[document.get_filename() for document in documents]
+        ).prefetch_related('tags')
+        tags = dict((doc_model.name, doc_model.get_tag_list()) for doc_model in doc_models)
+        for document in documents:
+            document.set_tags(tags.get(document.get_filename(), []))
+        return documents, {}
+
     def get_all_tags(self, docrule=None):
         tags = DocTags.objects.all()
         if docrule:
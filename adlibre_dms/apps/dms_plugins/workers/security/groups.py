@@ -24,6 +24,11 @@ class GroupSecurityRetrieval(Plugin, BeforeRetrievalPluginPoint):
     def work(self, document):
         return GroupSecurity().work(document)
 
+    def work_many(self, documents):
+        """Documents read together belong to the same user, so checking once"""
+        GroupSecurity().work(documents[0])
+        return documents, {}
+
 
 class GroupSecurityRemoval(Plugin, BeforeRemovalPluginPoint):
     title = 'Security Group on removal'
@@ -8,7 +8,9 @@ License: See LICENSE for license information
 import datetime
 import os
 import shutil
+import hashlib
 import logging
+import tempfile
 
 from django.conf import settings
 
@@ -18,6 +20,9 @@ from dms_plugins.workers import Plugin, PluginError, BreakPluginChain
 
 log = logging.getLogger('dms')
 
+# Size of file parts copied at once
+CHUNK_SIZE = 64 * 1024
+
 class NoRevisionError(Exception):
     def __str__(self):
         return "NoRevisionError - No such revision number"
@@ -32,7 +37,65 @@ def naturalsort(L, reverse=False):
     return sorted(L, key=alpha, reverse=reverse)
 
 
+class BlobStore(object):
+    """Content addressed store of stored files under settings.DOCUMENT_ROOT
+
+    Files are kept once per sha256 digest of their stored (e.g. compressed) contents in
+    settings.DOCUMENT_BLOBS_DIRECTORY. Document revision files are hard links to those blobs,
+    so file system links count is the blob reference count:
+    blob is removed with the last revision file referencing it.
+    """
+    def get_root(self):
+        return os.path.join(settings.DOCUMENT_ROOT, getattr(settings, 'DOCUMENT_BLOBS_DIRECTORY', '.blobs'))
+
+    def get_digest(self, file_obj):
+        digest = hashlib.sha256()
+        file_obj.seek(0)
+        for chunk in iter(lambda: file_obj.read(CHUNK_SIZE), ''):
+            digest.update(chunk)
+        file_obj.seek(0)
+        return digest.hexdigest()
+
+    def get_path(self, digest):
+        return os.path.join(self.get_root(), digest[:2], digest[2:4], digest)
+
+    def store(self, file_obj, fpath):
+        """Makes fpath reference blob with file contents. Writes the blob only if it is not stored yet."""
+        blob_path = self.get_path(self.get_digest(file_obj))
+        if os.path.exists(blob_path):
+            log.debug('BlobStore. Deduplicated %s with %s' % (fpath, blob_path))
+        else:
+            blob_directory = os.path.dirname(blob_path)
+            if not os.path.exists(blob_directory):
+                os.makedirs(blob_directory)
+            # Writing aside, so partially written blob is never referenced
+            handle, tmp_path = tempfile.mkstemp(dir=blob_directory)
+            with os.fdopen(handle, 'wb') as destination:
+                shutil.copyfileobj(file_obj, destination, CHUNK_SIZE)
+            os.rename(tmp_path, blob_path)
+        try:
+            os.link(blob_path, fpath)
+        except OSError, e:
+            # Blob removed by concurrent removal of it's last reference
+            log.warning('BlobStore. Storing %s without deduplication: %s' % (fpath, e))
+            file_obj.seek(0)
+            with open(fpath, 'wb') as destination:
+                shutil.copyfileobj(file_obj, destination, CHUNK_SIZE)
+
+    def release(self, fpath):
+        """Removes file, along with the blob it references in case it was the last reference"""
+        if os.stat(fpath).st_nlink == 2:
+            with open(fpath, 'rb') as file_obj:
+                blob_path = self.get_path(self.get_digest(file_obj))
+            if os.path.exists(blob_path) and os.path.samefile(blob_path, fpath):
+                os.remove(blob_path)
+        os.remove(fpath)
+
+
 class LocalFilesystemManager(object):
+    def __init__(self):
+        self.blobs = BlobStore()
+
     def get_document_directory(self, document):
         root = settings.DOCUMENT_ROOT
         # TODO: Refactoring for v2 (splitdir() method from Document() object used only here.)
@@ -56,12 +119,20 @@ class LocalFilesystemManager(object):
         return directory
 
     def store_file(self, file_obj, fpath):
-        """Filesystem worker to store a file from one given object to destination path."""
+        """Filesystem worker to store a file from one given object to destination path.
+
+        Deduplicates file contents with BlobStore in case of settings.DOCUMENT_DEDUPLICATION"""
         try:
-            destination = open(fpath, 'wb+')
+            if os.path.exists(fpath):
+                # Never writing into a blob shared with other files
+                self.blobs.release(fpath)
             file_obj.seek(0)
-            destination.write(file_obj.read())
-            destination.close()
+            if getattr(settings, 'DOCUMENT_DEDUPLICATION', False):
+                self.blobs.store(file_obj, fpath)
+            else:
+                destination = open(fpath, 'wb+')
+                shutil.copyfileobj(file_obj, destination, CHUNK_SIZE)
+                destination.close()
         except Exception, e:
             log.error("LocalFilesystemManager. File storing Error: %s", e)
             return False
@@ -78,7 +149,7 @@ class LocalFilesystemManager(object):
 
     def remove_file(self, path_with_file):
         try:
-            os.remove(path_with_file)
+            self.blobs.release(path_with_file)
             return True
         except Exception, e:
             log.error("LocalFilesystemManager. File removal error: %s" % e)
@@ -211,11 +282,22 @@ class Local(object):
                 #print "LIMIT TO = %s, DOC_NAME = %s" % (limit_to, doc_name)
                 pass
             else:
-                docs.append({'name': doc_name})
+                docs.append({'name': doc_name, 'version': self.get_version(metadata_info)})
         if start:
             docs = docs[start:]
         return docs
 
+    def get_version(self, metadata_info):
+        """Short stamp of document latest file revision. Changes with every new file revision."""
+        metadatas = metadata_info.get('metadatas') or {}
+        revisions = [key for key in metadatas.iterkeys() if unicode(key).isdigit()]
+        if not revisions:
+            return None
+        revision = max(revisions, key=int)
+        data = metadatas[revision]
+        stamp = '%s:%s:%s' % (revision, data.get('hashcode', ''), data.get('created_date', ''))
+        return hashlib.md5(stamp).hexdigest()[:12]
+
     def remove(self, document):
         # TODO: FIXME: Refactor this method so it's safer!
         # Doing nothing for mark deleted call
@@ -230,13 +312,17 @@ class Local(object):
             #print "Deleting Filename: ", filename
             #print "In directory: ", directory
             try:
-                os.unlink(os.path.join(directory, filename))
+                self.filesystem.blobs.release(os.path.join(directory, filename))
             except Exception, e:
                 raise PluginError(str(e), 500)
 
         #check if only '.json' file left in the directory for e.g.
         if not filename:
             try:
+                # Dereferencing deduplicated revisions blobs
+                for name in os.listdir(directory):
+                    if os.path.isfile(os.path.join(directory, name)):
+                        self.filesystem.blobs.release(os.path.join(directory, name))
                 shutil.rmtree(directory)
             except Exception, e:
                 log.error('LocalFileStorage delete exception %s' % e)
@@ -1,6 +1,7 @@
 import json
 import os
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 
@@ -47,6 +48,28 @@ class LocalJSONMetadata(object):
         document.set_file_revisions_data(fileinfo_db)
         return document
 
+    def retrieve_many(self, documents):
+        """Reads file revisions data of many documents, loading their JSON files in parallel threads.
+
+        Returns list of read documents and dict of errors by document code."""
+        def retrieve(document):
+            try:
+                return self.retrieve(document), None
+            except PluginError, e:
+                return document, e
+        threads = min(len(documents), getattr(settings, 'METADATA_READ_THREADS', 8))
+        if threads < 2:
+            results = map(retrieve, documents)
+        else:
+            pool = ThreadPool(threads)
+            try:
+                results = pool.map(retrieve, documents)
+            finally:
+                pool.close()
+                pool.join()
+        errors = dict((document.get_code(), error) for document, error in results if error is not None)
+        return [document for document, error in results if error is None], errors
+
     def update_metadata_after_removal(self, document):
         # Doing nothing for mark deleted call
         mark_revision = False
@@ -119,6 +142,11 @@ class LocalJSONMetadata(object):
             revisions[rev_key] = revision
         return revisions
 
+    def metadata_exists(self, document):
+        """Checks for document file revisions metadata presence without loading it"""
+        directory = self.filesystem.get_document_directory(document)
+        return os.path.isfile(os.path.join(directory, '%s.json' % (document.get_code(),)))
+
     def load_metadata(self, document_name, directory):
         json_file = os.path.join(directory, '%s.json' % (document_name,))
         _file = self.load_from_file(json_file)
@@ -238,6 +266,13 @@ class LocalJSONMetadata(object):
         document.docrule = None
         document.set_filename(new_name)
         # Merging new metadata from Gzip plugin if present
+        compression_type = document.file_revisions.get('compression_type', None)
+        if compression_type:
+            # All the moved file revisions are compressed the same way
+            for revision in new_metadata.iterkeys():
+                new_metadata[revision][u'compression_type'] = compression_type
+                if revision in fileinfo_db:
+                    fileinfo_db[revision][u'compression_type'] = compression_type
         current_data = document.get_current_file_revision_data()
         if current_data:
             for k, v in current_data.iteritems():
@@ -263,6 +298,9 @@ class LocalJSONMetadataRetrievalPlugin(Plugin, BeforeRetrievalPluginPoint):
     def work(self, document, **kwargs):
         return self.worker.retrieve(document)
 
+    def work_many(self, documents):
+        return self.worker.retrieve_many(documents)
+
 
 class LocalJSONMetadataStoragePlugin(Plugin, StoragePluginPoint):
     title = "Filesystem Metadata Storage"
@@ -0,0 +1,136 @@
+"""
+Module: Seekable chunked compression container
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+File is split into chunks of equal size compressed independently with zlib,
+so any byte range can be read decompressing only the chunks it covers.
+
+Layout (big-endian):
+    header: magic 'DMSCHNK1', chunk size (uint32)
+    compressed chunks one after another
+    index: for each chunk it's offset (uint64) and compressed length (uint32)
+    footer: original size (uint64), chunks count (uint32), index offset (uint64), magic 'DMSCIDX1'
+"""
+
+import struct
+import zlib
+
+__all__ = ['ChunkedFile', 'ChunkedFileError', 'compress_chunked']
+
+HEADER = '!8sI'
+HEADER_MAGIC = 'DMSCHNK1'
+INDEX_ENTRY = '!QI'
+FOOTER = '!QIQ8s'
+FOOTER_MAGIC = 'DMSCIDX1'
+
+
+class ChunkedFileError(Exception):
+    pass
+
+
+def compress_chunked(file_obj, destination, compression_level=6, chunk_size=256 * 1024):
+    """Writes file into destination in chunked container format. Returns sizes of input and output."""
+    index = []
+    offset = struct.calcsize(HEADER)
+    destination.write(struct.pack(HEADER, HEADER_MAGIC, chunk_size))
+    bytes_in = 0
+    for chunk in iter(lambda: file_obj.read(chunk_size), ''):
+        bytes_in += len(chunk)
+        data = zlib.compress(chunk, compression_level)
+        destination.write(data)
+        index.append((offset, len(data)))
+        offset += len(data)
+    for entry in index:
+        destination.write(struct.pack(INDEX_ENTRY, *entry))
+    destination.write(struct.pack(FOOTER, bytes_in, len(index), offset, FOOTER_MAGIC))
+    bytes_out = offset + len(index) * struct.calcsize(INDEX_ENTRY) + struct.calcsize(FOOTER)
+    return bytes_in, bytes_out
+
+
+class ChunkedFile(object):
+    """Read only file like object over chunked container.
+
+    Decompresses only the chunks that are read. Keeps one last decompressed chunk in memory."""
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        # Container file path is not a path of the decompressed contents
+        self.name = None
+        file_obj.seek(0, 2)
+        if file_obj.tell() < struct.calcsize(HEADER) + struct.calcsize(FOOTER):
+            raise ChunkedFileError('Chunked compressed file is truncated')
+        file_obj.seek(0)
+        magic, self.chunk_size = self._unpack(HEADER, file_obj.read(struct.calcsize(HEADER)))
+        if magic != HEADER_MAGIC:
+            raise ChunkedFileError('Not a chunked compressed file')
+        file_obj.seek(-struct.calcsize(FOOTER), 2)
+        self.size, count, index_offset, magic = self._unpack(FOOTER, file_obj.read(struct.calcsize(FOOTER)))
+        if magic != FOOTER_MAGIC:
+            raise ChunkedFileError('Chunked compressed file index is corrupted')
+        file_obj.seek(index_offset)
+        entry_size = struct.calcsize(INDEX_ENTRY)
+        index_data = file_obj.read(count * entry_size)
+        self.index = [struct.unpack_from(INDEX_ENTRY, index_data, number * entry_size) for number in range(count)]
+        self.position = 0
+        self.chunk_number = None
+        self.chunk = ''
+
+    def _unpack(self, fmt, data):
+        try:
+            return struct.unpack(fmt, data)
+        except struct.error:
+            raise ChunkedFileError('Chunked compressed file is truncated')
+
+    def _read_chunk(self, number):
+        if number != self.chunk_number:
+            try:
+                offset, length = self.index[number]
+                self.file_obj.seek(offset)
+                self.chunk = zlib.decompress(self.file_obj.read(length))
+            except (IndexError, zlib.error):
+                raise ChunkedFileError('Chunked compressed file is corrupted')
+            self.chunk_number = number
+        return self.chunk
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        parts = []
+        while size > 0:
+            number, chunk_offset = divmod(self.position, self.chunk_size)
+            data = self._read_chunk(number)[chunk_offset:chunk_offset + size]
+            if not data:
+                raise ChunkedFileError('Chunked compressed file is shorter than its index states')
+            parts.append(data)
+            self.position += len(data)
+            size -= len(data)
+        return ''.join(parts)
+
+    def chunks(self, chunk_size=None):
+        """Iterates over the rest of the file decompressing one chunk at a time"""
+        chunk_size = chunk_size or self.chunk_size
+        for data in iter(lambda: self.read(chunk_size), ''):
+            yield data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(0, min(offset, self.size))
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.file_obj.close()
+        self.chunk = ''
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return self.chunks()
@@ -1,7 +1,66 @@
-from adlibre.converter import NewFileConverter
+"""
+Module: DMS File Type Converter Plugins
 
-from dms_plugins.pluginpoints import BeforeRetrievalPluginPoint
-from dms_plugins.workers import Plugin
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Converted files are cached in settings.DOCUMENT_ROOT/settings.CONVERSIONS_CACHE_DIRECTORY,
+in a directory per document code, by stored revision file, it's hash and target extension.
+Least recently used conversions are removed when cache grows over settings.CONVERSIONS_CACHE_SIZE bytes.
+
+Conversions to extensions configured with 'Pre-render Conversions' plugins option are made in background
+by 'conversions_worker' command after storage, and kept in the document directory until it's update or removal.
+
+External converters of a process are run by one executor, limiting their number to
+settings.CONVERSIONS_MAX_PROCESSES and killing ones running over settings.CONVERSIONS_TIMEOUT seconds.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import mimetypes
+
+import magic
+from django import forms
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from adlibre.converter import NewFileConverter, ConversionExecutor, ConversionError
+
+from core.jobs import get_job_queue
+from dms_plugins.pluginpoints import BeforeRetrievalPluginPoint, BeforeRemovalPluginPoint, BeforeUpdatePluginPoint
+from dms_plugins.pluginpoints import StoragePluginPoint, UpdatePluginPoint
+from dms_plugins.workers import Plugin, PluginError
+from dms_plugins.workers.storage.local import LocalFilesystemManager
+
+log = logging.getLogger('dms')
+
+# Jobs queue of conversions pre-rendering, processed by 'conversions_worker' command
+CONVERSIONS_QUEUE = 'conversions'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# (estimated size, last scan time) of conversions caches of this process by cache root
+_cache_sizes = {}
+_cache_sizes_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns conversions executor of this process"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ConversionExecutor(
+                max_processes=getattr(settings, 'CONVERSIONS_MAX_PROCESSES', 2),
+                timeout=getattr(settings, 'CONVERSIONS_TIMEOUT', 60),
+            )
+        return _executor
 
 
 class ConvertFileTypePlugin(Plugin, BeforeRetrievalPluginPoint):
@@ -13,14 +72,324 @@ class ConvertFileTypePlugin(Plugin, BeforeRetrievalPluginPoint):
         return Converter().work_retrieve(document)
 
 
+class ConvertFileTypeRemovalPlugin(Plugin, BeforeRemovalPluginPoint):
+    title = "File Type Converter"
+    description = "Removes cached conversions of the document"
+    plugin_type = "retrieval_processing"
+
+    def work(self, document):
+        ConversionCache().remove(document)
+        return document
+
+
+class ConvertFileTypeUpdatePlugin(Plugin, BeforeUpdatePluginPoint):
+    title = "File Type Converter"
+    description = "Removes cached conversions of the document"
+    plugin_type = "retrieval_processing"
+
+    def work(self, document):
+        ConversionCache().remove(document)
+        return document
+
+
+class PreRenderForm(forms.Form):
+    """Form for configuration of pre-rendering plugins options in DMS config"""
+    pre_render = forms.CharField(
+        required=False,
+        help_text='Comma separated extensions documents are converted to after storage, e.g. "pdf, txt"'
+    )
+
+    def __init__(self, options, *args, **kwargs):
+        self.options = options
+        super(PreRenderForm, self).__init__(*args, **kwargs)
+
+    def clean_pre_render(self):
+        extensions = [extension.strip().strip('.').lower() for extension in self.cleaned_data['pre_render'].split(',')]
+        return ','.join([extension for extension in extensions if extension])
+
+    def save(self, commit=True):
+        """Stores settings for a plugin
+        @param commit: execute save()"""
+        for option in self.options:
+            option.value = self.cleaned_data[option.name]
+            if commit:
+                option.save()
+        return self.options
+
+
+class PreRenderStoragePlugin(Plugin, StoragePluginPoint):
+    title = "Pre-render Conversions"
+    description = "Queues conversions of a stored document to configured extensions. Should be the last storage plugin."
+    plugin_type = "conversions"
+    has_configuration = True
+    pre_render = ''
+    configurable_fields = ['pre_render', ]
+    form = PreRenderForm
+
+    def work(self, document):
+        return enqueue_pre_render(document, self.get_option('pre_render', document.get_docrule()))
+
+
+class PreRenderUpdatePlugin(Plugin, UpdatePluginPoint):
+    title = "Pre-render Conversions"
+    description = "Queues conversions of an updated document to configured extensions. Should be the last update plugin."
+    plugin_type = "conversions"
+    has_configuration = True
+    pre_render = ''
+    configurable_fields = ['pre_render', ]
+    form = PreRenderForm
+
+    def work(self, document):
+        return enqueue_pre_render(document, self.get_option('pre_render', document.get_docrule()))
+
+
 class Converter(object):
+    def __init__(self):
+        self.cache = ConversionCache()
+
     def work_retrieve(self, document):
         to_extension = document.get_requested_extension()
         if to_extension:
-            converter = NewFileConverter(document.get_file_obj(), document.get_fullpath(), to_extension)
-            mimetype, new_file_obj = converter.convert()
+            cached = self.cache.get(document, to_extension)
+            if cached is not None:
+                document.set_mimetype(self.cache.get_mimetype(to_extension, cached))
+                document.set_file_obj(cached)
+                return document
+            converter = NewFileConverter(
+                document.get_file_obj(), document.get_fullpath(), to_extension, executor=get_executor()
+            )
+            output = None
+            if converter.can_convert():
+                # Converter writes straight into the cache
+                output = self.cache.create(document, to_extension)
+            try:
+                mimetype, new_file_obj = converter.convert(output)
+            except ConversionError, e:
+                self.cache.discard(output)
+                log.error('Conversion of %s to %s failed: %s' % (document.get_code(), to_extension, e))
+                raise PluginError('Conversion of %s to %s failed' % (document.get_code(), to_extension), 500)
+            if output is not None:
+                new_file_obj = self.cache.commit(document, to_extension, output)
             document.set_mimetype(mimetype)
             document.set_file_obj(new_file_obj)
         return document
 
 
+class ConversionCache(object):
+    """Size bounded cache of converted document files.
+
+    Cached file is named by stored revision file name, digest of revision hashcode (or file modification time
+    and size, for documents without hashcodes) and target extension, so a new revision or changed file
+    is never served a stale conversion. Cached file modification time is it's last usage time.
+
+    Derived (pre-rendered) conversions are named the same way, but stored in the document directory
+    and never evicted.
+
+    Cache size is estimated by conversions committed in this process. Cache directory is scanned for eviction
+    only when the estimate grows over the limit, or the last scan is older than scan_interval seconds
+    (catching up with conversions of other processes)."""
+
+    derived_folder = 'conversions_storage'
+    scan_interval = 60
+
+    def get_root(self):
+        return os.path.join(settings.DOCUMENT_ROOT, getattr(settings, 'CONVERSIONS_CACHE_DIRECTORY', '.conversions'))
+
+    def get_derived_directory(self, document):
+        """Returns directory of derived conversions, next to stored revisions of document"""
+        fullpath = document.get_fullpath()
+        if fullpath:
+            directory = os.path.dirname(fullpath)
+        else:
+            directory = LocalFilesystemManager().get_document_directory(document)
+        return os.path.join(directory, self.derived_folder)
+
+    def get_size_limit(self):
+        return getattr(settings, 'CONVERSIONS_CACHE_SIZE', 512 * 1024 * 1024)
+
+    def get_path(self, document, extension, derived=False):
+        """Returns path of document conversion to extension or None if document has no stored file"""
+        fullpath = document.get_fullpath()
+        if not fullpath:
+            return None
+        hashcode = (document.get_current_file_revision_data() or {}).get('hashcode')
+        if not hashcode:
+            try:
+                stat = os.stat(fullpath)
+            except OSError:
+                return None
+            hashcode = '%s:%s' % (stat.st_mtime, stat.st_size)
+        revision_name = os.path.splitext(os.path.basename(fullpath))[0]
+        digest = hashlib.md5('%s:%s' % (fullpath, hashcode)).hexdigest()[:12]
+        name = '%s.%s.%s' % (revision_name, digest, extension.lower())
+        if derived:
+            return os.path.join(self.get_derived_directory(document), name)
+        return os.path.join(self.get_root(), document.get_code(), name)
+
+    def get_mimetype(self, extension, file_obj):
+        mimetype = mimetypes.guess_type('file.%s' % extension)[0]
+        if mimetype is None:
+            mimetype = magic.Magic(mime=True).from_buffer(file_obj.read(1024))
+            file_obj.seek(0)
+        return mimetype
+
+    def get(self, document, extension):
+        """Returns opened derived or cached conversion of document to extension or None"""
+        for derived in (True, False):
+            path = self.get_path(document, extension, derived=derived)
+            if path is None:
+                return None
+            try:
+                file_obj = open(path, 'rb')
+                if not derived:
+                    # Marking recently used
+                    os.utime(path, None)
+            except (IOError, OSError):
+                continue
+            return file_obj
+        return None
+
+    def create(self, document, extension, derived=False):
+        """Returns new temporary file in cache for conversion of document to extension, or None"""
+        path = self.get_path(document, extension, derived=derived)
+        if path is None:
+            return None
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Written aside, so concurrent requests never read partial conversion
+            return tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False)
+        except (IOError, OSError), e:
+            log.error('Conversion of %s to %s will not be cached: %s' % (document.get_code(), extension, e))
+            return None
+
+    def commit(self, document, extension, tmp_file, derived=False):
+        """Makes written temporary file conversion of document to extension. Returns it at it's start."""
+        tmp_file.flush()
+        try:
+            os.rename(tmp_file.name, self.get_path(document, extension, derived=derived))
+        except OSError, e:
+            # Conversion is returned anyway
+            log.error('Conversion of %s to %s was not cached: %s' % (document.get_code(), extension, e))
+            self.discard(tmp_file, close=False)
+        else:
+            # Converters leave file at it's start
+            if not derived and self.add_size(os.fstat(tmp_file.fileno()).st_size):
+                self.evict()
+        tmp_file.seek(0)
+        return tmp_file
+
+    def add_size(self, size):
+        """Adds size of committed conversion to estimated cache size. Returns True if cache should be scanned."""
+        root = self.get_root()
+        with _cache_sizes_lock:
+            if not root in _cache_sizes:
+                return True
+            total, scanned = _cache_sizes[root]
+            total += size
+            _cache_sizes[root] = (total, scanned)
+        return total > self.get_size_limit() or time.time() - scanned > self.scan_interval
+
+    def discard(self, tmp_file, close=True):
+        if tmp_file is None:
+            return
+        if close:
+            tmp_file.close()
+        try:
+            os.remove(tmp_file.name)
+        except OSError:
+            pass
+
+    def remove(self, document):
+        """Removes all derived and cached conversions of document code"""
+        shutil.rmtree(self.get_derived_directory(document), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.get_root(), document.get_code()), ignore_errors=True)
+
+    def evict(self):
+        """Removes least recently used conversions until cache fits settings.CONVERSIONS_CACHE_SIZE"""
+        files = []
+        total = 0
+        scanned = time.time()
+        for directory, dirs, names in os.walk(self.get_root()):
+            for name in names:
+                if name.endswith('.tmp'):
+                    # Conversion being written
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        limit = self.get_size_limit()
+        if total > limit:
+            files.sort()
+            for mtime, size, path in files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                if total <= limit:
+                    break
+        with _cache_sizes_lock:
+            _cache_sizes[self.get_root()] = (total, scanned)
+
+
+def pre_render(document, extensions):
+    """Makes derived conversions of document file to extensions it can be converted to"""
+    cache = ConversionCache()
+    for extension in extensions:
+        path = cache.get_path(document, extension, derived=True)
+        if path is None or os.path.exists(path):
+            # No stored file or already pre-rendered
+            continue
+        converter = NewFileConverter(
+            document.get_file_obj(), document.get_fullpath(), extension, executor=get_executor()
+        )
+        if not converter.can_convert():
+            continue
+        output = cache.create(document, extension, derived=True)
+        if output is None:
+            continue
+        try:
+            converter.convert(output)
+        except ConversionError:
+            cache.discard(output)
+            raise
+        cache.commit(document, extension, output, derived=True).close()
+    return document
+
+
+def enqueue_pre_render(document, extensions):
+    """Adds pre-rendering job for document, if any extensions are configured (comma separated)"""
+    extensions = [extension for extension in (extensions or '').split(',') if extension]
+    if not extensions:
+        return document
+    try:
+        get_job_queue().enqueue(CONVERSIONS_QUEUE, {'code': document.get_code(), 'extensions': extensions}, unique=True)
+    except Exception, e:
+        # Conversions will be made and cached on first request
+        log.error('Pre-rendering job for %s was not queued: %s' % (document.get_code(), e))
+    return document
+
+
+def pre_render_job(payload):
+    """Makes derived conversions of a document, reading it's latest revision. Returns error or None.
+
+    Runs in 'conversions_worker' command processes."""
+    from core.document_processor import DocumentProcessor
+    code = payload['code']
+    try:
+        admin = User.objects.filter(is_superuser=True)[0]
+        processor = DocumentProcessor()
+        document = processor.read(code, {'user': admin})
+        if processor.errors:
+            return unicode(processor.errors[0])
+        pre_render(document, payload['extensions'])
+    except Exception, e:
+        log.error('Pre-rendering job for %s failed: %s' % (code, e))
+        return unicode(e)
+    return None
@@ -6,30 +6,78 @@ License: See LICENSE for license information
 """
 
 import zlib
+import time
+import logging
 import tempfile
 
+import magic
+from django import forms
+from django.conf import settings
+
 from dms_plugins.pluginpoints import BeforeStoragePluginPoint, BeforeRetrievalPluginPoint, BeforeUpdatePluginPoint
 from dms_plugins.workers import Plugin
+from dms_plugins.workers.transfer.chunked import ChunkedFile, compress_chunked
+
+log = logging.getLogger('plugins.workers.transfer.gzip')
+
+# Size of file parts processed at once
+CHUNK_SIZE = 64 * 1024
+
+
+class GzipForm(forms.Form):
+    """Form for configuration of compression plugins options in DMS config"""
+    OPTION = [(str(level), str(level)) for level in range(1, 10)]
+    TYPE_OPTION = (
+        ('GZIP', 'Gzip (whole file stream)'),
+        ('CHUNKED', 'Chunked (seekable, partial reads decompress only needed chunks)'),
+    )
+    compression_level = forms.ChoiceField(choices=OPTION)
+    compression_type = forms.ChoiceField(choices=TYPE_OPTION)
+
+    def __init__(self, options, *args, **kwargs):
+        self.options = options
+        super(GzipForm, self).__init__(*args, **kwargs)
+
+    def save(self, commit=True):
+        """Stores settings for a plugin
+        @param commit: execute save()"""
+        for option in self.options:
+            option.value = self.cleaned_data[option.name]
+            if commit:
+                option.save()
+        return self.options
 
 
 class GzipOnStorePlugin(Plugin, BeforeStoragePluginPoint):
     title = 'Gzip Plugin on storage'
-    has_configuration = True  # TODO: configure
+    has_configuration = True
     description = "Compresses files before storing"
     plugin_type = "storage_processing"
+    compression_level = '6'
+    compression_type = 'GZIP'
+    configurable_fields = ['compression_level', 'compression_type', ]
+    form = GzipForm
 
     def work(self, document):
-        return Gzip().work_store(document)
+        compression_level = self.get_option('compression_level', document.get_docrule())
+        compression_type = self.get_option('compression_type', document.get_docrule())
+        return Gzip(compression_level, compression_type).work_store(document)
 
 
 class GzipOnUpdatePlugin(Plugin, BeforeUpdatePluginPoint):
     title = 'Gzip Plugin on update'
-    has_configuration = True  # TODO: configure
+    has_configuration = True
     description = "Compresses files on updating file"
     plugin_type = "update_processing"
+    compression_level = '6'
+    compression_type = 'GZIP'
+    configurable_fields = ['compression_level', 'compression_type', ]
+    form = GzipForm
 
     def work(self, document):
-        return Gzip().work_store(document)
+        compression_level = self.get_option('compression_level', document.get_docrule())
+        compression_type = self.get_option('compression_type', document.get_docrule())
+        return Gzip(compression_level, compression_type).work_store(document)
 
 
 class GzipOnRetrievePlugin(Plugin, BeforeRetrievalPluginPoint):
@@ -43,24 +91,85 @@ class GzipOnRetrievePlugin(Plugin, BeforeRetrievalPluginPoint):
 
 
 class Gzip(object):
+    """Compresses files into gzip format streaming them by chunks of CHUNK_SIZE
+
+    Decompresses both gzip and zlib (files stored by previous DMS versions) formatted files.
+
+    Files of settings.COMPRESSION_SKIP_MIMETYPES and files with first settings.COMPRESSION_SAMPLE_SIZE bytes
+    not shrinking by settings.COMPRESSION_MIN_SAVING fraction at least are stored as is,
+    with 'NONE' compression_type.
+
+    'CHUNKED' compression_type stores files in seekable container of independently compressed chunks
+    of settings.COMPRESSION_CHUNK_SIZE bytes. Those are not decompressed on retrieval at all,
+    but wrapped into a file like object decompressing only the chunks actually read.
+    """
     compression_type = 'GZIP'
+    chunked_compression_type = 'CHUNKED'
+    no_compression_type = 'NONE'
+
+    def __init__(self, compression_level=6, compression_type=None):
+        self.compression_level = int(compression_level)
+        if compression_type:
+            self.compression_type = compression_type
 
     def _work(self, file_obj, method):
         file_obj.seek(0)
         tmp_file_obj = tempfile.TemporaryFile()
         if method == 'STORAGE':
-            compressed_file = zlib.compress(file_obj.read())
-            tmp_file_obj.write(compressed_file)
-            tmp_file_obj.seek(0)
+            self.compress(file_obj, tmp_file_obj)
         elif method == 'RETRIEVAL':
-            content = file_obj.read()
-            before = len(content)
-            decompressed = zlib.decompress(content)
-            after = len(decompressed)
-            tmp_file_obj.write(decompressed)
-            tmp_file_obj.seek(0)
+            self.decompress(file_obj, tmp_file_obj)
+        tmp_file_obj.seek(0)
         return tmp_file_obj
 
+    def compress(self, file_obj, destination):
+        """Compresses file into destination. Returns sizes of input and output."""
+        if self.compression_type == self.chunked_compression_type:
+            chunk_size = getattr(settings, 'COMPRESSION_CHUNK_SIZE', 4 * CHUNK_SIZE)
+            return compress_chunked(file_obj, destination, self.compression_level, chunk_size)
+        bytes_in = bytes_out = 0
+        # wbits 16 + MAX_WBITS makes zlib write gzip header and trailer
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in iter(lambda: file_obj.read(CHUNK_SIZE), ''):
+            bytes_in += len(chunk)
+            data = compressor.compress(chunk)
+            bytes_out += len(data)
+            destination.write(data)
+        data = compressor.flush()
+        bytes_out += len(data)
+        destination.write(data)
+        return bytes_in, bytes_out
+
+    def decompress(self, file_obj, destination):
+        # wbits 32 + MAX_WBITS detects gzip or zlib header automatically
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        for chunk in iter(lambda: file_obj.read(CHUNK_SIZE), ''):
+            # Limiting output size, so highly compressed data does not expand in memory at once
+            destination.write(decompressor.decompress(chunk, CHUNK_SIZE))
+            while decompressor.unconsumed_tail:
+                destination.write(decompressor.decompress(decompressor.unconsumed_tail, CHUNK_SIZE))
+        destination.write(decompressor.flush())
+
+    def should_compress(self, document, file_obj):
+        """Decides if file is worth compressing by it's mimetype and compressibility of it's beginning"""
+        file_obj.seek(0)
+        sample = file_obj.read(getattr(settings, 'COMPRESSION_SAMPLE_SIZE', CHUNK_SIZE))
+        file_obj.seek(0)
+        if not sample:
+            return True
+        mimetype = document.mimetype or document.get_current_file_revision_data().get('mimetype', None)
+        if not mimetype:
+            mimetype = magic.Magic(mime=True).from_buffer(sample)
+        if mimetype in getattr(settings, 'COMPRESSION_SKIP_MIMETYPES', ()):
+            log.debug('Gzip skips compression of already compressed mimetype: %s' % mimetype)
+            return False
+        # Fastest compression level is enough to estimate
+        ratio = len(zlib.compress(sample, 1)) / float(len(sample))
+        if ratio > 1 - getattr(settings, 'COMPRESSION_MIN_SAVING', 0.03):
+            log.debug('Gzip skips compression of not compressible %s file. Sample ratio: %.3f' % (mimetype, ratio))
+            return False
+        return True
+
     def work_store(self, document):
         # Treating as multiple revisions object
         if document.file_revisions:
@@ -75,16 +184,34 @@ class Gzip(object):
             document.update_current_file_revision_data({'compression_type': self.compression_type})
         processing_document = document.get_file_obj()
         if processing_document:
-            compressed_file = self._work(processing_document, method='STORAGE')
-            document.set_file_obj(compressed_file)
-            document.update_current_file_revision_data({'compression_type': self.compression_type})
+            if self.should_compress(document, processing_document):
+                compressed_file = self.compress_file(processing_document)
+                document.set_file_obj(compressed_file)
+                document.update_current_file_revision_data({'compression_type': self.compression_type})
+            else:
+                document.update_current_file_revision_data({'compression_type': self.no_compression_type})
         return document
 
+    def compress_file(self, file_obj):
+        """Compresses file into a temporary file"""
+        started = time.clock()
+        file_obj.seek(0)
+        tmp_file_obj = tempfile.TemporaryFile()
+        bytes_in, bytes_out = self.compress(file_obj, tmp_file_obj)
+        tmp_file_obj.seek(0)
+        cpu_time = time.clock() - started
+        log.debug('Gzip compressed %s bytes into %s bytes in %.3f CPU seconds' % (bytes_in, bytes_out, cpu_time))
+        return tmp_file_obj
+
     def work_retrieve(self, document):
         # Doing nothing for only_metadata option
         if document.get_option('only_metadata') or document.get_option('indexing_data'):
             return document
-        if document.get_current_file_revision_data().get('compression_type', None) == self.compression_type:
+        compression_type = document.get_current_file_revision_data().get('compression_type', None)
+        if compression_type == self.chunked_compression_type:
+            # Nothing is decompressed until read
+            document.set_file_obj(ChunkedFile(document.get_file_obj()))
+        elif compression_type == self.compression_type:
             try:
                 decompressed_file = self._work(document.get_file_obj(), method='RETRIEVAL')
             except:
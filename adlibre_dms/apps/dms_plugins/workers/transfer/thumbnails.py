@@ -8,17 +8,121 @@ Author: Iurii Garmash
 """
 import os
 import shutil
-import ghostscript
 import logging
+import tempfile
+import threading
 import traceback
 
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from adlibre.converter import ConversionExecutor, ConversionError, ConversionTimeout
+
+from core.jobs import FAILED, get_job_queue
 from dms_plugins.workers.storage.local import LocalFilesystemManager
 
 from dms_plugins.pluginpoints import BeforeRetrievalPluginPoint, BeforeRemovalPluginPoint, BeforeUpdatePluginPoint
+from dms_plugins.pluginpoints import StoragePluginPoint, UpdatePluginPoint
 from dms_plugins.workers import Plugin, PluginError
 
 log = logging.getLogger('dms')
 
+# Jobs queue of thumbnails pre-generation, processed by 'thumbnails_worker' command
+THUMBNAILS_QUEUE = 'thumbnails'
+
+# Size of file parts fed to converters at once
+CHUNK_SIZE = 64 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns thumbnails converters executor of this process"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ConversionExecutor(
+                max_processes=getattr(settings, 'THUMBNAILS_MAX_PROCESSES', 2),
+                timeout=getattr(settings, 'THUMBNAILS_TIMEOUT', 30),
+            )
+        return _executor
+
+
+class ThumbnailsEngine(object):
+    """Converts documents first page into PNG thumbnails with external tools
+
+    Files are fed directly by stored file path, or through converter stdin, and thumbnails are read from it's stdout.
+    Converters are run by a thumbnails executor, so not more than settings.THUMBNAILS_MAX_PROCESSES conversions
+    run at once in a process, each killed after settings.THUMBNAILS_TIMEOUT seconds.
+    """
+
+    def get_command(self, mimetype, size, source_path=None):
+        """Converter arguments list for mimetype. Reads stdin without source_path."""
+        width, height = size
+        if mimetype == 'application/pdf':
+            return [
+                'gs',
+                '-q',  # Quiet
+                '-dSAFER',
+                '-sDEVICE=png16m',  # Type. PNG used
+                '-dBATCH',  # Quit GS after converting
+                '-dNOPAUSE',  # Do not stop on pages
+                '-dFirstPage=1',
+                '-dLastPage=1',
+                '-dPDFFitPage',  # Scale page to thumbnail size
+                '-dFIXEDMEDIA',
+                '-g%dx%d' % (width, height),
+                '-sOutputFile=-',  # Destination: stdout
+                source_path or '-',
+            ]
+        if mimetype == 'image/jpeg':
+            return ['convert', 'jpg:%s' % (source_path or '-'), '-thumbnail', '%dx%d' % (width, height), 'png:-']
+        return None
+
+    def convert(self, document, size):
+        """Returns PNG thumbnail of a document file"""
+        command = self.get_command(document.mimetype, size)
+        if command is None:
+            raise PluginError('No thumbnail converter for mimetype: %s' % document.mimetype, 404)
+        file_obj = document.get_file_obj()
+        if isinstance(file_obj, file) and file_obj.name == document.get_fullpath():
+            # Stored file is not compressed. Converter can read it itself.
+            return self.run(self.get_command(document.mimetype, size, document.get_fullpath()))
+        return self.run(command, file_obj)
+
+    def run(self, command, input_file=None):
+        """Runs converter command, returning it's output"""
+        stdin = None
+        temp_input = None
+        if input_file is not None:
+            input_file.seek(0)
+            try:
+                # Real files are read by converter directly
+                input_file.fileno()
+                stdin = input_file
+            except (AttributeError, IOError, ValueError):
+                temp_input = tempfile.TemporaryFile()
+                shutil.copyfileobj(input_file, temp_input, CHUNK_SIZE)
+                temp_input.seek(0)
+                stdin = temp_input
+        output = tempfile.TemporaryFile()
+        try:
+            get_executor().run([command], stdin=stdin, stdout=output)
+            output.seek(0)
+            thumbnail = output.read()
+        except ConversionTimeout:
+            raise PluginError('Thumbnail conversion timed out: %s' % command[0], 404)
+        except ConversionError, e:
+            raise PluginError('Thumbnail conversion failed: %s' % e, 404)
+        finally:
+            output.close()
+            if temp_input is not None:
+                temp_input.close()
+        if not thumbnail:
+            raise PluginError('Thumbnail conversion failed: %s: no output' % command[0], 404)
+        return thumbnail
+
 
 class ThumbnailsFilesystemHandler(object):
     """Handles a thumbnails interaction
@@ -26,38 +130,89 @@ class ThumbnailsFilesystemHandler(object):
     Implemented in a lazy way.
     Thumbnail is created on first request
     and stored for farther usage afterwards withing that code directory
+
+    Thumbnails of settings.THUMBNAILS_SIZES, other then 'default', are stored with size name suffix.
     """
 
+    mimetypes = ('application/pdf', 'image/jpeg')
+
     def __init__(self):
         self.filesystem = LocalFilesystemManager()
         self.thumbnail_folder = 'thumbnails_storage'
-        self.thumb_size = (64, 64)  # px, px (pixels size - width, height)
+        self.engine = ThumbnailsEngine()
+
+    def get_size(self, document):
+        """Returns requested thumbnail size name and it's (width, height) pixels size"""
+        sizes = getattr(settings, 'THUMBNAILS_SIZES', {'default': (64, 64)})
+        size = document.get_option('thumbnail_size') or 'default'
+        if not size in sizes:
+            raise PluginError('Unknown thumbnail size: %s' % size, 404)
+        return size, sizes[size]
+
+    def get_suffix(self, size):
+        if size == 'default':
+            return '.png'
+        return '.%s.png' % size
 
     def retrieve_thumbnail(self, document):
         """Handles retrieval of thumbnail and optional generation of it"""
+        size, pixels = self.get_size(document)
         thumbnail_location, thumbnail_directory = self.get_thumbnail_path(document)
-        if not os.path.exists(thumbnail_location + '.png'):
+        thumbnail_location += self.get_suffix(size)
+        if not os.path.exists(thumbnail_location):
             # TODO: remove this try/except block and stabilize
             # Operations are not stable due to plugin usage of external tools that are under testing now
             try:
-                # To write a mimetype thumbnail handler add similar code  and create your function
                 log.debug('mimetype for thumbnail: %s' % document.mimetype)
                 if not document.mimetype:
                     raise PluginError('ThumbnailsFilesystemHandler missconfiguration. Mimetype = None', 404)
-                if document.mimetype == 'application/pdf':
-                    self.generate_thumbnail_from_pdf(document)
-                if document.mimetype == 'image/jpeg':
-                    self.generate_thumbnail_from_jpeg(document)
-                document.thumbnail = open(thumbnail_location + '.png').read()
+                thumbnail = self.engine.convert(document, pixels)
+                if not os.path.exists(thumbnail_directory):
+                    os.makedirs(thumbnail_directory)
+                # Writing aside, so concurrent requests never read partial thumbnail
+                handle, tmp_path = tempfile.mkstemp(dir=thumbnail_directory, suffix='.tmp')
+                with os.fdopen(handle, 'wb') as tmp_file:
+                    tmp_file.write(thumbnail)
+                os.rename(tmp_path, thumbnail_location)
+                document.thumbnail = thumbnail
             except Exception, e:
                 traceback.print_exc()
                 error = 'ThumbnailsFilesystemHandler.generate_thumbnail method error: %s' % e
                 log.error(error)
                 raise PluginError(error, 404)
         else:
-            document.thumbnail = open(thumbnail_location + '.png').read()
+            with open(thumbnail_location, 'rb') as thumbnail:
+                document.thumbnail = thumbnail.read()
         return document
 
+    def find_thumbnail(self, document):
+        """Returns path of stored thumbnail of document code or None. Does not need document file or metadata."""
+        size, pixels = self.get_size(document)
+        suffix = self.get_suffix(size)
+        sizes = getattr(settings, 'THUMBNAILS_SIZES', {})
+        thumbnail_directory = os.path.join(self.filesystem.get_document_directory(document), self.thumbnail_folder)
+        try:
+            names = os.listdir(thumbnail_directory)
+        except OSError:
+            return None
+        code = document.get_code()
+        for name in names:
+            # Thumbnails are stored as code + suffix or code + '.' + extension + suffix
+            if not name.endswith(suffix):
+                continue
+            base, extension = os.path.splitext(name[:-len(suffix)])
+            if name[:-len(suffix)] == code or (base == code and not extension[1:] in sizes):
+                return os.path.join(thumbnail_directory, name)
+        return None
+
+    def read_existing_thumbnail(self, document):
+        """Returns stored thumbnail of document code or None. Does not need document file or metadata."""
+        thumbnail_path = self.find_thumbnail(document)
+        if thumbnail_path is None:
+            return None
+        with open(thumbnail_path, 'rb') as thumbnail:
+            return thumbnail.read()
+
     def remove_thumbnails(self, document):
         """Removes existing thumbnails path along with all files inside it"""
         thumbnail_location, thumbnail_directory = self.get_thumbnail_path(document, filename=False)
@@ -69,45 +224,6 @@ class ThumbnailsFilesystemHandler(object):
     # ****************************************** Helper methods (Internal) *********************************************
     # ******************************************************************************************************************
 
-    def generate_thumbnail_from_pdf(self, document):
-        """Generating a thumbnail based on document first file"""
-        thumbnail_temporary, thumbnail_directory = self.get_thumbnail_path(document)
-        # Creating directory for thumbnail if not exists
-        if not os.path.exists(thumbnail_directory):
-            os.makedirs(thumbnail_directory)
-        # Storing temporary PDF file for converting
-        tmp_pdf = open(thumbnail_temporary, 'w')
-        tmp_pdf.write(document.get_file_obj().read())
-        tmp_pdf.close()
-        args = [
-            'gs',
-            '-q',  # Quiet
-            '-dSAFER',
-            '-sDEVICE=png16m',  # Type. PNG used
-            '-r10',  # resolution of the thumbnail
-            '-dBATCH',  # Quit GS after converting
-            '-dNOPAUSE',  # Do not stop on pages
-            '-dFirstPage=1',
-            '-dLastPage=1',
-            '-sOutputFile=%s.png' % thumbnail_temporary,  # Destination
-            '%s' % thumbnail_temporary,  # Source
-        ]
-        ghostscript.Ghostscript(*args)
-        # Deleting the temp PDF
-        os.unlink(thumbnail_temporary)
-
-    def generate_thumbnail_from_jpeg(self, document):
-        """Generating a thumbnail based on document first file"""
-        thumbnail_temporary, thumbnail_directory = self.get_thumbnail_path(document)
-        # Creating directory for thumbnail if not exists
-        if not os.path.exists(thumbnail_directory):
-            os.makedirs(thumbnail_directory)
-        tmp_jpg = open(thumbnail_temporary + '.jpg', 'w')
-        tmp_jpg.write(document.get_file_obj().read())
-        tmp_jpg.close()
-        os.system('convert %s.jpg -resize 65x65 %s.png' % (thumbnail_temporary, thumbnail_temporary))
-        os.unlink(thumbnail_temporary + '.jpg')
-
     def get_thumbnail_path(self, document, filename=True):
         """Produces 2 path of tmp thumbnail file and a directory for thumbnails storage"""
         # Support for old docrule
@@ -163,3 +279,62 @@ class ThumbnailsLocalUpdatePlugin(Plugin, BeforeUpdatePluginPoint):
 
     def work(self, document):
         return ThumbnailsFilesystemHandler().remove_thumbnails(document)
+
+
+class ThumbnailsQueueStoragePlugin(Plugin, StoragePluginPoint):
+
+    title = "Thumbnails Queue"
+    description = "Queues generation of thumbnail for a stored document. Should be the last storage plugin."
+    plugin_type = "thumbnails"
+
+    def work(self, document):
+        return enqueue_thumbnail(document)
+
+
+class ThumbnailsQueueUpdatePlugin(Plugin, UpdatePluginPoint):
+
+    title = "Thumbnails Queue"
+    description = "Queues generation of thumbnail for an updated document. Should be the last update plugin."
+    plugin_type = "thumbnails"
+
+    def work(self, document):
+        return enqueue_thumbnail(document)
+
+
+def enqueue_thumbnail(document, size=None, retry_failed=True):
+    """Adds thumbnail generation job for document, unless it's file can not have one
+
+    @param size: thumbnail size name of settings.THUMBNAILS_SIZES, default size if not given
+    @param retry_failed: add a job even if the same job has already failed"""
+    if document.mimetype and not document.mimetype in ThumbnailsFilesystemHandler.mimetypes:
+        return document
+    payload = {'code': document.get_code()}
+    if size:
+        payload['size'] = size
+    try:
+        queue = get_job_queue()
+        if not retry_failed and queue.find(THUMBNAILS_QUEUE, payload, FAILED):
+            return document
+        queue.enqueue(THUMBNAILS_QUEUE, payload, unique=True)
+    except Exception, e:
+        # Thumbnail will be generated on first request
+        log.error('Thumbnail generation job for %s was not queued: %s' % (document.get_code(), e))
+    return document
+
+
+def generate_thumbnail_job(payload):
+    """Generates thumbnail of a document, reading it with thumbnail option. Returns error or None.
+
+    Runs in 'thumbnails_worker' command processes."""
+    from core.document_processor import DocumentProcessor
+    code = payload['code']
+    try:
+        admin = User.objects.filter(is_superuser=True)[0]
+        processor = DocumentProcessor()
+        processor.read(code, {'user': admin, 'thumbnail': True, 'thumbnail_size': payload.get('size', None)})
+        if processor.errors:
+            return unicode(processor.errors[0])
+    except Exception, e:
+        log.error('Thumbnail generation job for %s failed: %s' % (code, e))
+        return unicode(e)
+    return None
@@ -5,10 +5,12 @@ Copyright: Adlibre Pty Ltd 2013
 License: See LICENSE for license information
 """
 
+import os
 import hashlib
 
 from django import forms
 from django.conf import settings
+from django.core.cache import get_cache
 
 from dms_plugins.pluginpoints import BeforeRetrievalPluginPoint
 from dms_plugins.pluginpoints import BeforeStoragePluginPoint
@@ -16,6 +18,9 @@ from dms_plugins.pluginpoints import BeforeUpdatePluginPoint
 from dms_plugins.workers import Plugin
 from dms_plugins.workers import PluginError
 
+# Size of file parts hashed at once
+CHUNK_SIZE = 64 * 1024
+
 
 class HashForm(forms.Form):
     """Form for configuration of those plugins options in DMS config"""
@@ -58,7 +63,7 @@ class HashCodeValidationOnStoragePlugin(Plugin, BeforeStoragePluginPoint):
         """Main plugin method
         @param document: DMS Document() instance"""
         method = self.get_option('method', document.get_docrule())
-        return HashCodeWorker(self.method).work_store(document, method)
+        return HashCodeWorker(method).work_store(document, method)
 
 
 class HashCodeValidationOnUpdatePlugin(Plugin, BeforeUpdatePluginPoint):
@@ -75,7 +80,7 @@ class HashCodeValidationOnUpdatePlugin(Plugin, BeforeUpdatePluginPoint):
         """Main plugin method
         @param document: DMS Document() instance"""
         method = self.get_option('method', document.get_docrule())
-        return HashCodeWorker(self.method).work_store(document, method)
+        return HashCodeWorker(method).work_store(document, method)
 
 
 class HashCodeValidationOnRetrievalPlugin(Plugin, BeforeRetrievalPluginPoint):
@@ -92,13 +97,18 @@ class HashCodeValidationOnRetrievalPlugin(Plugin, BeforeRetrievalPluginPoint):
         """Main plugin method
         @param document: DMS Document() instance"""
         method = self.get_option('method', document.get_docrule())
-        return HashCodeWorker(self.method).work_retrieve(document, method)
+        return HashCodeWorker(method).work_retrieve(document, method)
 
 
 class HashCodeWorker(object):
-    """Main Hash Codes plugin worker"""
+    """Main Hash Codes plugin worker
+
+    Hashes files by chunks of CHUNK_SIZE, never reading them into memory at once.
+    Hashcodes of stored files verified on retrieval are cached (settings.HASHCODE_CACHE_TIMEOUT seconds)
+    by stored file path, modification time and size, so unchanged revisions are not hashed on every read."""
     def __init__(self, method):
         self.method = method
+        self.cache = get_cache('core')
 
     def get_hash(self, document, method, salt=settings.SECRET_KEY):
         """Retruns hash for a given document
@@ -111,26 +121,61 @@ class HashCodeWorker(object):
         h.update(salt)
         return h.hexdigest()
 
+    def get_file_hash(self, file_obj, method, salt=settings.SECRET_KEY):
+        """Returns hash for a file object, same as get_hash() for it's contents
+
+        @param file_obj: is a file like object to hash from the beginning
+        @param method: is a str() method of hash code checking. e.g. 'md5'
+        @param salt: is a string to encode data with"""
+        h = hashlib.new(method)
+        file_obj.seek(0)
+        for chunk in iter(lambda: file_obj.read(CHUNK_SIZE), ''):
+            h.update(chunk)
+        file_obj.seek(0)
+        h.update(salt)
+        return h.hexdigest()
+
+    def get_verification_cache_key(self, fullpath, method):
+        """Cache key of hash for stored file. Changes when file is modified."""
+        try:
+            stat = os.stat(fullpath)
+        except OSError:
+            return None
+        file_key = '%s:%s:%s:%s' % (fullpath, stat.st_mtime, stat.st_size, method)
+        return 'hashcode_%s' % hashlib.md5(file_key.encode('utf-8')).hexdigest()
+
+    def get_stored_file_hash(self, document, method):
+        """Returns hash for document file, taking it from verification cache when the stored file is unchanged"""
+        cache_key = None
+        if document.get_fullpath():
+            cache_key = self.get_verification_cache_key(document.get_fullpath(), method)
+        hashcode = cache_key and self.cache.get(cache_key)
+        if not hashcode:
+            hashcode = self.get_file_hash(document.get_file_obj(), method)
+            if cache_key:
+                self.cache.set(cache_key, hashcode, getattr(settings, 'HASHCODE_CACHE_TIMEOUT', 60 * 60 * 24))
+        return hashcode
+
     def work_store(self, document, method):
         """Stores hash for given document
 
         @param document: is a DMS Document() instance
         @param method: is a str() method of hash code checking. e.g. 'md5'
         """
-        new_hashcode = self.get_hash(document.get_file_obj().read(), method)
+        new_hashcode = self.get_file_hash(document.get_file_obj(), method)
         document.set_hashcode(new_hashcode)
         document.save_hashcode(new_hashcode)
         return document
 
     def work_retrieve(self, document, method):
-        """Reads hash for given document
+        """Validates hash for given document, if it was requested with one
 
         @param document: is a DMS Document() instance
         @param method: is a str() method of hash code checking. e.g. 'md5'
         """
-        if document.get_file_obj():
-            hashcode = document.get_hashcode()
-            new_hashcode = self.get_hash(document.get_file_obj().read(), method)
-            if hashcode and not (new_hashcode == hashcode):
+        hashcode = document.get_hashcode()
+        if hashcode and document.get_file_obj():
+            new_hashcode = self.get_stored_file_hash(document, method)
+            if not (new_hashcode == hashcode):
                 raise PluginError("Hashcode did not validate.", 500)
         return document
@@ -141,14 +141,13 @@ def check_for_secondary_keys_pairs(input_keys_list, docrule_id):
         # Checking if this parallel keys group already was checked.
         if not pkeys_with_values in checked_keys:
             checked_keys.append(pkeys_with_values)
-            # Getting all keys for parallel key to check if it exists in any document metadata already.
-            for pkey, pvalue in pkeys_with_values:
-                documents = CouchDocument.view('dmscouch/search_autocomplete',
-                                                key=[docrule_id, pkey, pvalue],
-                                                reduce=False)
-                # Appending non existing keys into list to be checked.
-                if not documents:
-                    suspicious_keys_list[pkey] = pvalue
+    # Getting all keys for parallel keys to check if they exist in any document metadata already.
+    pairs = [pair for pkeys_with_values in checked_keys for pair in pkeys_with_values]
+    existing_pairs = find_existing_keys_pairs(pairs, docrule_id)
+    for pkey, pvalue in pairs:
+        # Appending non existing keys into list to be checked.
+        if not (pkey, pvalue) in existing_pairs:
+            suspicious_keys_list[pkey] = pvalue
     if suspicious_keys_list:
         log.debug('Found new unique key/values in secondary keys: ', suspicious_keys_list)
     else:
@@ -187,26 +186,31 @@ def check_for_forbidden_new_keys_created(document_indexes, docrule, user):
                 permit = True
     if user.is_superuser or permit:
         admin_restricted_keys = []
+    pairs = [(key, document_indexes[key]) for key in admin_restricted_keys + locked_keys]
+    existing_pairs = find_existing_keys_pairs(pairs, docrule)
     # Checking all keys locked for editing to staff or superuser only
     for key in admin_restricted_keys:
-        value = document_indexes[key]
-        exists = check_docs_for_existence(key, value, docrule)
-        if not exists:
+        if not (key, document_indexes[key]) in existing_pairs:
             user_locked_keys.append((key, 'adminlock'))
-            # Checking all the keys that are marked locked
+    # Checking all the keys that are marked locked
     for key in locked_keys:
-        value = document_indexes[key]
-        exists = check_docs_for_existence(key, value, docrule)
-        if not exists:
+        if not (key, document_indexes[key]) in existing_pairs:
             user_locked_keys.append((key, 'locked'))
     return user_locked_keys
 
-def check_docs_for_existence(key, value, docrule):
-    """Check if at least one document with specified docrule, key and value exist"""
-    documents = CouchDocument.view('dmscouch/search_autocomplete', key=[str(docrule), key, value], reduce=False)
-    if documents.__len__() > 0:
-        # There is at least one this type document...
-        return True
-    else:
-        # No such documents
-        return False
\ No newline at end of file
+
+def find_existing_keys_pairs(pairs, docrule):
+    """Checks which of the key/value pairs exist in documents of docrule
+
+    Does one multi-key request to CouchDB for all the pairs.
+    @param pairs: list of (key, value) tuples
+    @return: set of existing (key, value) tuples"""
+    keys = []
+    for key, value in pairs:
+        view_key = [str(docrule), key, value]
+        if not view_key in keys:
+            keys.append(view_key)
+    if not keys:
+        return set()
+    documents = CouchDocument.view('dmscouch/search_autocomplete', keys=keys, group=True)
+    return set((doc['key'][1], doc['key'][2]) for doc in documents)
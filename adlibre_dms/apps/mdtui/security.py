@@ -7,9 +7,15 @@ License: See LICENSE for license information
 Author: Iurii Garmash
 """
 
-from django.contrib.auth.models import Group, Permission
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission, User
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import signals
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import signals, Q
 
 from core.models import DocumentTypeRule
 
@@ -20,6 +26,64 @@ SEC_GROUP_NAMES = {
     'edit_index': 'MUI can Edit Document Indexes',
 }
 
+PERMITTED_DOCRULES_GENERATION_KEY = 'permitted_docrules_generation'
+
+
+def permitted_docrules_set(user):
+    """
+    Returns frozenset of PK's of all user permitted Document Type Rules.
+
+    Cached per user for settings.PERMITTED_DOCRULES_CACHE_TIMEOUT seconds, if 'core' cache backend is shared
+    between processes. Cache is invalidated on changes of users/groups permissions, users groups and Document Type Rules.
+    Usually we need to check if user is superuser and/or staff before calling this.
+    @param user: django User() instance
+    """
+    cache = get_permitted_docrules_cache()
+    if cache is None:
+        return get_permitted_docrules(user)
+    generation = cache.get(PERMITTED_DOCRULES_GENERATION_KEY)
+    if generation is None:
+        generation = invalidate_permitted_docrules()
+    cache_key = 'permitted_docrules_%s_%s' % (generation, user.pk)
+    docrules_pks = cache.get(cache_key)
+    if docrules_pks is None:
+        docrules_pks = get_permitted_docrules(user)
+        cache.set(cache_key, docrules_pks, getattr(settings, 'PERMITTED_DOCRULES_CACHE_TIMEOUT', 300))
+    return docrules_pks
+
+
+def get_permitted_docrules(user):
+    """Returns frozenset of PK's of all user permitted Document Type Rules, bypassing the cache."""
+    # Permissions of user and of user groups, with a 'document type' permission codename per docrule title
+    permissions = Permission.objects.filter(content_type__name='document type').filter(
+        Q(user=user) | Q(group__user=user)
+    )
+    return frozenset(DocumentTypeRule.objects.filter(
+        title__in=permissions.values('codename')
+    ).values_list('pk', flat=True))
+
+
+def get_permitted_docrules_cache():
+    """
+    Returns 'core' cache if it is shared between processes, None otherwise.
+
+    Invalidation of a process local cache (LocMemCache) would not reach other processes,
+    leaving them with stale permissions until the timeout.
+    """
+    cache = get_cache('core')
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        return None
+    return cache
+
+
+def invalidate_permitted_docrules(**kwargs):
+    """Starts new generation of permitted docrules cache of all users. Returns it."""
+    generation = uuid.uuid4().hex
+    cache = get_permitted_docrules_cache()
+    if cache is not None:
+        cache.set(PERMITTED_DOCRULES_GENERATION_KEY, generation, 60 * 60 * 24)
+    return generation
+
 
 def list_permitted_docrules_qs(user):
     """
@@ -28,21 +92,7 @@ def list_permitted_docrules_qs(user):
     Usually we need to check if user is superuser and/or staff before calling this.
     @param user: django User() instance
     """
-    # Filtering Document Type Rules for user
-    perms = user.user_permissions.all()
-    allowed_docrules_names = []
-    # Checking for permitted docrules
-    for permission in perms:
-        if permission.content_type.name == 'document type':
-            if not permission.codename in allowed_docrules_names:
-                allowed_docrules_names.append(permission.codename)
-    for group in user.groups.all():
-        for permission in group.permissions.all():
-            if permission.content_type.name == 'document type':
-                if not permission.codename in allowed_docrules_names:
-                    allowed_docrules_names.append(permission.codename)
-    docrules_queryset = DocumentTypeRule.objects.filter(title__in=allowed_docrules_names)
-    return docrules_queryset
+    return DocumentTypeRule.objects.filter(pk__in=permitted_docrules_set(user))
 
 
 def list_permitted_docrules_pks(user):
@@ -52,13 +102,7 @@ def list_permitted_docrules_pks(user):
     Usually need to check if user is superuser and/or staff before calling this.
     @param user: django User() instance
     """
-    docrules_queryset = list_permitted_docrules_qs(user)
-    # Getting list of PKs of allowed Document Type Rules.
-    allowed_docrules_pks = []
-    if docrules_queryset:
-        for rule in docrules_queryset:
-            allowed_docrules_pks.append(unicode(rule.pk))
-    return allowed_docrules_pks
+    return [unicode(pk) for pk in sorted(permitted_docrules_set(user))]
 
 
 def filter_permitted_docrules(docrules_list, user):
@@ -98,4 +142,16 @@ def create_groups(**kwargs):
 
 # Attached this to recreate permissions for each syncdb
 signals.post_syncdb.connect(update_docrules_permissions)
-signals.post_syncdb.connect(create_groups)
\ No newline at end of file
+signals.post_syncdb.connect(create_groups)
+
+# Permitted docrules depend on users and groups permissions, users groups and docrules titles
+signals.m2m_changed.connect(invalidate_permitted_docrules, sender=User.user_permissions.through)
+signals.m2m_changed.connect(invalidate_permitted_docrules, sender=User.groups.through)
+signals.m2m_changed.connect(invalidate_permitted_docrules, sender=Group.permissions.through)
+signals.post_save.connect(invalidate_permitted_docrules, sender=DocumentTypeRule)
+signals.post_delete.connect(invalidate_permitted_docrules, sender=DocumentTypeRule)
+signals.post_save.connect(invalidate_permitted_docrules, sender=Permission)
+signals.post_delete.connect(invalidate_permitted_docrules, sender=Permission)
+# Deletion removes users groups and permissions relations without m2m_changed signals
+signals.post_delete.connect(invalidate_permitted_docrules, sender=Group)
+signals.post_delete.connect(invalidate_permitted_docrules, sender=User)
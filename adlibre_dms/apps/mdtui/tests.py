@@ -13,8 +13,11 @@ import os
 import urllib
 import datetime
 import re
+import shutil
+import tempfile
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator
 from django.conf import settings
@@ -27,7 +30,7 @@ from couchdbkit import Server
 
 from adlibre.date_converter import date_standardized
 from mdtui.views import MDTUI_ERROR_STRINGS
-from mdtui.security import SEC_GROUP_NAMES
+from mdtui.security import SEC_GROUP_NAMES, permitted_docrules_set, list_permitted_docrules_pks
 from mdtui.templatetags.paginator_tags import rebuild_sequence_digg
 from mdtcouch.models import MetaDataTemplate
 from dmscouch.models import CouchDocument
@@ -734,6 +737,52 @@ class PaginatorTestCase(TestCase):
         self.assertEqual(result_sequence, [1, 2, '...', 19, 20])
 
 
+class PermittedDocrulesTestCase(TestCase):
+    """Cached user permitted Document Type Rules"""
+    fixtures = ['initial_datas.json', 'djangoplugins.json', 'dms_plugins.json', 'core.json', ]
+
+    def shared_core_cache(self):
+        """Settings override with 'core' cache shared between processes"""
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches = dict(settings.CACHES)
+        caches['core'] = {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': location,
+        }
+        return override_settings(CACHES=caches)
+
+    def test_permitted_docrules_not_cached_in_process_local_cache(self):
+        user = User.objects.create_user('permitted_docrules', 'permitted@example.com', 'permitted')
+        self.assertEqual(permitted_docrules_set(user), frozenset())
+        with self.assertNumQueries(1):
+            permitted_docrules_set(user)
+
+    def test_permitted_docrules_cache_invalidation(self):
+        with self.shared_core_cache():
+            user = User.objects.create_user('permitted_docrules', 'permitted@example.com', 'permitted')
+            docrule = DocumentTypeRule.objects.get(title='Adlibre Invoices')
+            permission = Permission.objects.get(codename=docrule.title, content_type__name='document type')
+            self.assertEqual(permitted_docrules_set(user), frozenset())
+            user.user_permissions.add(permission)
+            self.assertEqual(permitted_docrules_set(user), frozenset([docrule.pk]))
+            self.assertEqual(list_permitted_docrules_pks(user), [unicode(docrule.pk)])
+            with self.assertNumQueries(0):
+                permitted_docrules_set(user)
+            user.user_permissions.remove(permission)
+            self.assertEqual(permitted_docrules_set(user), frozenset())
+            group = Group.objects.create(name='permitted docrules')
+            group.permissions.add(permission)
+            user.groups.add(group)
+            self.assertEqual(permitted_docrules_set(user), frozenset([docrule.pk]))
+            group.permissions.clear()
+            self.assertEqual(permitted_docrules_set(user), frozenset())
+            group.permissions.add(permission)
+            self.assertEqual(permitted_docrules_set(user), frozenset([docrule.pk]))
+            group.delete()
+            self.assertEqual(permitted_docrules_set(user), frozenset())
+
+
 class MDTUI(MUITestData):
     """Tests for MUI interface of DMS"""
     fixtures = ['initial_datas.json', 'djangoplugins.json', 'dms_plugins.json', 'core.json', ]
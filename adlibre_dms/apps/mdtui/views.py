@@ -999,7 +999,7 @@ def mdt_parallel_keys(request):
     # Change it to 0 to search all, starting from empty value
     letters_limit = 2
     # Limit of response results
-    suggestions_limit = 8
+    suggestions_limit = settings.AUTOCOMPLETE_SUGGESTIONS_LIMIT
 
     valid_call = True
     autocomplete_req = None
@@ -0,0 +1,93 @@
+"""
+Module: DMS pluggable metadata backend
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Selects the database CouchDocument and MetaDataTemplate models talk to.
+
+settings.COUCHDB_BACKEND may be:
+    'couchdb' - default, a real CouchDB server configured with COUCHDB_DATABASES
+    'local' - in-process SQLite database (COUCHDB_LOCAL_PATH) emulating DMS CouchDB views
+    dotted path to a callable, taking (app_label) and returning a couchdbkit.Database compatible object
+"""
+
+import threading
+
+from django.conf import settings
+from django.utils.importlib import import_module
+from couchdbkit.ext.django.loading import couchdbkit_handler
+
+from core.errors import ConfigurationError
+from database import LocalDatabase
+
+__all__ = ['connect_document', 'fetch_changes', 'get_backend_name', 'get_database', 'local_database']
+
+_databases = {}
+_connections = {}
+_lock = threading.Lock()
+
+
+def get_backend_name():
+    return getattr(settings, 'COUCHDB_BACKEND', 'couchdb')
+
+
+def _dbname(app_label):
+    """Database name configured for app in COUCHDB_DATABASES (e.g. 'dmscouch_test')"""
+    for label, uri in getattr(settings, 'COUCHDB_DATABASES', ()):
+        if label.split('.')[-1] == app_label:
+            return uri.rsplit('/', 1)[-1]
+    return app_label
+
+
+def local_database(app_label):
+    """Backend factory for 'local' backend. All apps share one SQLite connection (and its lock) per file."""
+    path = getattr(settings, 'COUCHDB_LOCAL_PATH', ':memory:')
+    if not path in _connections:
+        _connections[path] = (LocalDatabase.connect(path), threading.RLock())
+    connection, lock = _connections[path]
+    return LocalDatabase(_dbname(app_label), app_label=app_label, path=path, connection=connection, lock=lock)
+
+
+def get_database(app_label):
+    """Returns database instance of the configured backend for a couchdbkit app label"""
+    with _lock:
+        if not app_label in _databases:
+            backend = get_backend_name()
+            if backend == 'local':
+                factory = local_database
+            else:
+                try:
+                    module_name, factory_name = backend.rsplit('.', 1)
+                    factory = getattr(import_module(module_name), factory_name)
+                except (ValueError, ImportError, AttributeError), e:
+                    raise ConfigurationError('Wrong COUCHDB_BACKEND setting "%s": %s' % (backend, e))
+            _databases[app_label] = factory(app_label)
+        return _databases[app_label]
+
+
+def connect_document(schema):
+    """Binds a couchdbkit Document class to configured metadata backend.
+
+    Does nothing for default 'couchdb' backend, keeping couchdbkit lazy connection to CouchDB server.
+    Registers database within couchdbkit handler, so syncdb pushes design docs to it as well."""
+    if get_backend_name() == 'couchdb':
+        return
+    app_label = schema._meta.app_label
+    db = get_database(app_label)
+    couchdbkit_handler._databases[app_label] = db
+    schema.set_db(db)
+
+
+def fetch_changes(db, since, include_docs=False):
+    """Reads '_changes' feed of a database of any backend. Returns dict with 'results' and 'last_seq'.
+
+    @param since: update sequence to read changes after or 'now' to get only the current 'last_seq'
+    """
+    if hasattr(db, 'changes'):
+        return db.changes(since=since, include_docs=include_docs)
+    params = {'since': since}
+    if include_docs:
+        params['include_docs'] = 'true'
+    return db.res.get('_changes', **params).json_body
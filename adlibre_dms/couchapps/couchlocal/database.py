@@ -0,0 +1,428 @@
+"""
+Module: DMS local metadata backend database
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+In-process stand-in for couchdbkit.Database, storing documents and materialised view rows in SQLite.
+"""
+
+import json
+import hashlib
+import logging
+import sqlite3
+import threading
+import uuid
+
+from couchdbkit.client import ViewResults, _maybe_serialize
+from couchdbkit.exceptions import ResourceNotFound, ResourceConflict, BulkSaveError
+
+from views import DESIGNS
+
+log = logging.getLogger('dms.couchlocal')
+
+__all__ = ['LocalDatabase', 'couch_collate']
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS documents (
+        db TEXT NOT NULL,
+        id TEXT NOT NULL,
+        rev TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        body TEXT NOT NULL,
+        PRIMARY KEY (db, id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS view_rows (
+        db TEXT NOT NULL,
+        view TEXT NOT NULL,
+        key TEXT NOT NULL COLLATE couchjson,
+        id TEXT NOT NULL,
+        value TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS view_rows_key ON view_rows (db, view, key, id)",
+    "CREATE INDEX IF NOT EXISTS view_rows_id ON view_rows (db, id)",
+    "CREATE INDEX IF NOT EXISTS documents_seq ON documents (db, seq)",
+)
+
+
+def _type_rank(value):
+    """CouchDB view collation order of JSON types"""
+    if value is None:
+        return 0
+    if value is False:
+        return 1
+    if value is True:
+        return 2
+    if isinstance(value, (int, long, float)):
+        return 3
+    if isinstance(value, basestring):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    return 6
+
+
+def couch_collate(first, second):
+    """cmp() of two JSON values following CouchDB view collation rules"""
+    first_rank, second_rank = _type_rank(first), _type_rank(second)
+    if first_rank != second_rank:
+        return cmp(first_rank, second_rank)
+    if first_rank in (5, 6):
+        if first_rank == 6:
+            first, second = sorted(first.items()), sorted(second.items())
+        for first_item, second_item in zip(first, second):
+            result = couch_collate(first_item, second_item)
+            if result:
+                return result
+        return cmp(len(first), len(second))
+    if first_rank == 4:
+        return cmp(unicode(first), unicode(second))
+    return cmp(first, second)
+
+
+def _collate_json(first, second):
+    return couch_collate(json.loads(first), json.loads(second))
+
+
+def _dump(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def _normalize(value):
+    """Makes query keys look exactly like the JSON decoded keys stored in a view (tuples, str, etc.)"""
+    return json.loads(json.dumps(value))
+
+
+class LocalResponse(object):
+    """Mimics restkit response object consumed by couchdbkit.client.ViewResults"""
+
+    def __init__(self, json_body):
+        self.json_body = json_body
+
+
+class LocalDatabase(object):
+    """SQLite based replacement of couchdbkit.Database for one CouchDB database
+
+    Implements the subset of the couchdbkit Database API DMS uses:
+    get/open_doc, doc_exist, get_rev, save_doc, save_docs, delete_doc, view, info and changes.
+    Views are read from couchlocal.views.DESIGNS and kept up to date on every write.
+    """
+
+    def __init__(self, dbname, app_label=None, path=':memory:', connection=None, lock=None):
+        self.dbname = dbname
+        if app_label is not None:
+            self.designs = {app_label: DESIGNS.get(app_label, {})}
+        else:
+            self.designs = DESIGNS
+        self.uri = 'local://%s/%s' % (path, dbname)
+        # Guards all the statements, SQLite connection may be shared with other databases and threads
+        self.lock = lock or threading.RLock()
+        if connection is None:
+            connection = self.connect(path)
+        self.connection = connection
+
+    @classmethod
+    def connect(cls, path):
+        """Opens a SQLite connection usable by LocalDatabase instances"""
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.create_collation('couchjson', _collate_json)
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+        return connection
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.uri)
+
+    ####################################### Documents API ##############################################################
+    def info(self):
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT COUNT(*), MAX(seq) FROM documents WHERE db = ? AND deleted = 0', (self.dbname,))
+            doc_count = cursor.fetchone()[0]
+        return {'db_name': self.dbname, 'doc_count': doc_count, 'update_seq': self.update_seq()}
+
+    def update_seq(self):
+        with self.lock:
+            cursor = self.connection.execute('SELECT MAX(seq) FROM documents WHERE db = ?', (self.dbname,))
+            return cursor.fetchone()[0] or 0
+
+    def doc_exist(self, docid):
+        row = self._load(docid)
+        return row is not None and not row[1]
+
+    def open_doc(self, docid, **params):
+        wrapper = params.pop('wrapper', None)
+        schema = params.pop('schema', None)
+        if wrapper is None and schema is not None:
+            wrapper = schema.wrap
+        row = self._load(docid)
+        if row is None:
+            raise ResourceNotFound('missing', http_code=404)
+        if row[1]:
+            raise ResourceNotFound('deleted', http_code=404)
+        doc = json.loads(row[2])
+        if wrapper is not None:
+            return wrapper(doc)
+        return doc
+    get = open_doc
+
+    def get_rev(self, docid):
+        return self.open_doc(docid)['_rev']
+
+    def save_doc(self, doc, encode_attachments=True, force_update=False, **params):
+        doc1, schema = _maybe_serialize(doc)
+        with self.lock:
+            result = self._save(doc1, force_update)
+            self.connection.commit()
+        if schema:
+            doc._doc = doc1
+        else:
+            doc.update(doc1)
+        return result
+
+    def save_docs(self, docs, use_uuids=True, all_or_nothing=False, **params):
+        """Bulk save. Writes all the documents inside one SQLite transaction."""
+        results = []
+        errors = []
+        with self.lock:
+            for doc in docs:
+                doc1, schema = _maybe_serialize(doc)
+                try:
+                    result = self._save(doc1, force_update=False)
+                except ResourceConflict:
+                    result = {'id': doc1.get('_id'), 'error': 'conflict', 'reason': 'Document update conflict.'}
+                    errors.append(result)
+                else:
+                    if schema:
+                        doc._doc.update({'_id': result['id'], '_rev': result['rev']})
+                    else:
+                        doc.update({'_id': result['id'], '_rev': result['rev']})
+                results.append(result)
+            self.connection.commit()
+        if errors:
+            raise BulkSaveError(errors, results)
+        return results
+    bulk_save = save_docs
+
+    def delete_doc(self, doc, **params):
+        doc1, schema = _maybe_serialize(doc)
+        if isinstance(doc1, basestring):
+            docid = doc1
+        else:
+            docid = doc1['_id']
+        with self.lock:
+            row = self._load(docid)
+            if row is None or row[1]:
+                raise ResourceNotFound('missing', http_code=404)
+            rev = self._next_rev(row[0], {'_id': docid, '_deleted': True})
+            self.connection.execute(
+                'UPDATE documents SET rev = ?, seq = ?, deleted = 1, body = ? WHERE db = ? AND id = ?',
+                (rev, self.update_seq() + 1, _dump({'_id': docid, '_rev': rev, '_deleted': True}), self.dbname, docid)
+            )
+            self.connection.execute('DELETE FROM view_rows WHERE db = ? AND id = ?', (self.dbname, docid))
+            self.connection.commit()
+        result = {'ok': True, 'id': docid, 'rev': rev}
+        if schema:
+            doc._doc.update({'_rev': rev, '_deleted': True})
+        elif isinstance(doc, dict):
+            doc.update({'_rev': rev, '_deleted': True})
+        return result
+
+    def changes(self, since=0, include_docs=False):
+        """Emulates CouchDB '_changes' feed (normal, not continuous)"""
+        if since == 'now':
+            return {'results': [], 'last_seq': self.update_seq()}
+        with self.lock:
+            changed = self.connection.execute(
+                'SELECT id, rev, seq, deleted, body FROM documents WHERE db = ? AND seq > ? ORDER BY seq',
+                (self.dbname, since)
+            ).fetchall()
+        results = []
+        last_seq = since
+        for docid, rev, seq, deleted, body in changed:
+            change = {'id': docid, 'seq': seq, 'changes': [{'rev': rev}]}
+            if deleted:
+                change['deleted'] = True
+            if include_docs:
+                change['doc'] = json.loads(body)
+            results.append(change)
+            last_seq = seq
+        return {'results': results, 'last_seq': last_seq}
+
+    ########################################## Views API ###############################################################
+    def view(self, view_name, schema=None, wrapper=None, **params):
+        if view_name.startswith('/'):
+            view_name = view_name[1:]
+        return ViewResults(self.raw_view, view_name, wrapper, schema, params)
+
+    def all_docs(self, **params):
+        return self.view('_all_docs', **params)
+
+    def raw_view(self, view_name, params):
+        """Executes a view query returning CouchDB-like response body
+
+        Supports key, keys, startkey, endkey, inclusive_end, descending, skip, limit,
+        include_docs, reduce, group and group_level query parameters."""
+        if view_name == '_all_docs':
+            view = None
+        else:
+            view = self._get_view(view_name)
+        if 'keys' in params:
+            rows = []
+            for key in params['keys']:
+                key_params = dict(params, key=key)
+                del key_params['keys']
+                rows.extend(self._query_rows(view_name, view, key_params))
+        else:
+            rows = self._query_rows(view_name, view, params)
+        if view is not None and view.reduce is not None and params.get('reduce', True):
+            rows = self._reduce_rows(view, rows, params)
+            return LocalResponse({'rows': self._slice(rows, params)})
+        rows = self._slice(rows, params)
+        if params.get('include_docs'):
+            for row in rows:
+                try:
+                    row['doc'] = self.open_doc(row['id'])
+                except ResourceNotFound:
+                    row['doc'] = None
+        return LocalResponse({'total_rows': len(rows), 'offset': params.get('skip', 0), 'rows': rows})
+
+    def rebuild_views(self):
+        """Recalculates all view rows for this database. (e.g. after view functions change)"""
+        with self.lock:
+            self.connection.execute('DELETE FROM view_rows WHERE db = ?', (self.dbname,))
+            cursor = self.connection.execute(
+                'SELECT body FROM documents WHERE db = ? AND deleted = 0', (self.dbname,))
+            for (body,) in cursor.fetchall():
+                self._index(json.loads(body))
+            self.connection.commit()
+
+    ####################################### Internal helpers ###########################################################
+    def _load(self, docid):
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT rev, deleted, body FROM documents WHERE db = ? AND id = ?', (self.dbname, docid))
+            return cursor.fetchone()
+
+    def _next_rev(self, current_rev, doc):
+        number = 1
+        if current_rev:
+            number = int(current_rev.split('-', 1)[0]) + 1
+        return '%s-%s' % (number, hashlib.md5(_dump(doc)).hexdigest())
+
+    def _save(self, doc, force_update):
+        """Writes a serialized document. Caller must hold the lock and commit."""
+        docid = doc.get('_id') or uuid.uuid4().hex
+        row = self._load(docid)
+        current_rev = None
+        if row is not None:
+            current_rev = row[0]
+            if not row[1] and doc.get('_rev') != current_rev and not force_update:
+                raise ResourceConflict('Document update conflict.', http_code=409)
+        doc['_id'] = docid
+        doc.pop('_rev', None)
+        doc['_rev'] = self._next_rev(current_rev, doc)
+        seq = self.update_seq() + 1
+        self.connection.execute(
+            'INSERT OR REPLACE INTO documents (db, id, rev, seq, deleted, body) VALUES (?, ?, ?, ?, 0, ?)',
+            (self.dbname, docid, doc['_rev'], seq, _dump(doc))
+        )
+        self.connection.execute('DELETE FROM view_rows WHERE db = ? AND id = ?', (self.dbname, docid))
+        if docid.startswith('_design/'):
+            # Pushing design docs (syncdb) refreshes the materialised views
+            self.rebuild_views()
+        else:
+            self._index(doc)
+        return {'ok': True, 'id': docid, 'rev': doc['_rev']}
+
+    def _get_view(self, view_name):
+        try:
+            design, name = view_name.split('/', 1)
+            return self.designs[design][name]
+        except (ValueError, KeyError):
+            raise ResourceNotFound('missing_named_view', http_code=404)
+
+    def _index(self, doc):
+        """Stores view rows emitted for a document"""
+        for design, views in self.designs.iteritems():
+            for name, view in views.iteritems():
+                for key, value in view.map(doc):
+                    self.connection.execute(
+                        'INSERT INTO view_rows (db, view, key, id, value) VALUES (?, ?, ?, ?, ?)',
+                        (self.dbname, '%s/%s' % (design, name), _dump(key), doc['_id'], _dump(value))
+                    )
+
+    def _query_rows(self, view_name, view, params):
+        descending = params.get('descending', False)
+        if view is None:
+            sql = 'SELECT id, id, rev FROM documents WHERE db = ? AND deleted = 0'
+            args = [self.dbname]
+            key_column = 'id'
+        else:
+            sql = 'SELECT key, id, value FROM view_rows WHERE db = ? AND view = ?'
+            args = [self.dbname, view_name]
+            key_column = 'key'
+        encode = _dump if view is not None else (lambda k: k)
+        if 'key' in params:
+            sql += ' AND %s = ?' % key_column
+            args.append(encode(_normalize(params['key'])))
+        lower, upper = params.get('startkey'), params.get('endkey')
+        if descending:
+            lower, upper = upper, lower
+        if lower is not None:
+            sql += ' AND %s >= ?' % key_column
+            args.append(encode(_normalize(lower)))
+        if upper is not None:
+            if params.get('inclusive_end', True) or descending:
+                sql += ' AND %s <= ?' % key_column
+            else:
+                sql += ' AND %s < ?' % key_column
+            args.append(encode(_normalize(upper)))
+        order = descending and 'DESC' or 'ASC'
+        sql += ' ORDER BY %s %s, id %s' % (key_column, order, order)
+        with self.lock:
+            found = self.connection.execute(sql, args).fetchall()
+        rows = []
+        for key, docid, value in found:
+            if view is None:
+                rows.append({'id': docid, 'key': docid, 'value': {'rev': value}})
+            else:
+                rows.append({'id': docid, 'key': json.loads(key), 'value': json.loads(value)})
+        return rows
+
+    def _reduce_rows(self, view, rows, params):
+        group_level = params.get('group_level', None)
+        if params.get('group', False) and group_level is None:
+            group_key = lambda key: key
+        elif group_level is not None:
+            group_key = lambda key: key[:int(group_level)] if isinstance(key, list) else key
+        else:
+            group_key = lambda key: None
+        reduced = []
+        current = None
+        keys, values = [], []
+        for row in rows:
+            key = group_key(row['key'])
+            if current is not None and couch_collate(key, current[0]) != 0:
+                reduced.append({'key': current[0], 'value': view.reduce(current[1], current[2], False)})
+                current = None
+            if current is None:
+                keys, values = [], []
+                current = (key, keys, values)
+            keys.append([row['key'], row['id']])
+            values.append(row['value'])
+        if current is not None:
+            reduced.append({'key': current[0], 'value': view.reduce(current[1], current[2], False)})
+        return reduced
+
+    def _slice(self, rows, params):
+        skip = int(params.get('skip', 0) or 0)
+        limit = params.get('limit', None)
+        if skip:
+            rows = rows[skip:]
+        if limit is not None:
+            rows = rows[:int(limit)]
+        return rows
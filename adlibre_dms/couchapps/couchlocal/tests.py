@@ -0,0 +1,92 @@
+"""
+Module: DMS local metadata backend tests
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+"""
+
+from django.test import TestCase
+from couchdbkit.exceptions import ResourceNotFound, ResourceConflict
+
+from couchlocal import local_database
+from couchlocal.database import LocalDatabase, couch_collate
+
+
+def couch_doc(docid, docrule, indexes, created='2014-01-01T00:00:00Z'):
+    return {
+        '_id': docid,
+        'doc_type': 'CouchDocument',
+        'metadata_doc_type_rule_id': docrule,
+        'metadata_created_date': created,
+        'mdt_indexes': indexes,
+    }
+
+
+class LocalDatabaseTest(TestCase):
+
+    def setUp(self):
+        self.db = LocalDatabase('dmscouch_test', app_label='dmscouch')
+        self.mdt_db = LocalDatabase(
+            'mdtcouch_test', app_label='mdtcouch', connection=self.db.connection, lock=self.db.lock
+        )
+
+    def test_collation(self):
+        ordered = [None, False, True, 1, 2.5, u'a', u'b', u'b\ufff0', [u'a'], [u'a', 1], {u'a': 1}]
+        for index in range(len(ordered) - 1):
+            self.assertEqual(couch_collate(ordered[index], ordered[index + 1]), -1)
+        self.assertEqual(couch_collate([u'a', 1], [u'a', 1]), 0)
+
+    def test_document_revisions(self):
+        result = self.db.save_doc(couch_doc('ADL-0001', '1', {}))
+        self.assertTrue(result['rev'].startswith('1-'))
+        doc = self.db.get('ADL-0001')
+        self.assertEqual(doc['_rev'], result['rev'])
+        self.assertRaises(ResourceConflict, self.db.save_doc, couch_doc('ADL-0001', '1', {}))
+        self.db.save_doc(couch_doc('ADL-0001', '1', {}), force_update=True)
+        self.assertTrue(self.db.get_rev('ADL-0001').startswith('2-'))
+        self.db.delete_doc('ADL-0001')
+        self.assertFalse(self.db.doc_exist('ADL-0001'))
+        try:
+            self.db.get('ADL-0001')
+        except ResourceNotFound, e:
+            self.assertEqual(str(e), 'deleted')
+        else:
+            self.fail('Deleted document returned')
+        self.assertRaises(ResourceNotFound, self.db.get, 'ADL-0002')
+
+    def test_views(self):
+        self.db.save_docs([
+            couch_doc('ADL-0001', '1', {'Employee': 'Iurii'}, '2014-01-02T00:00:00Z'),
+            couch_doc('ADL-0002', '1', {'Employee': 'Andrew'}, '2014-01-01T00:00:00Z'),
+            couch_doc('BBB-0001', '2', {'Employee': 'Ivan'}),
+        ])
+        rows = self.db.view('dmscouch/search_date', startkey=['1', None], endkey=['1', u'\ufff0']).all()
+        self.assertEqual([row['id'] for row in rows], ['ADL-0002', 'ADL-0001'])
+        rows = self.db.view('dmscouch/search', key=['Employee', 'Ivan', '2']).all()
+        self.assertEqual([row['id'] for row in rows], ['BBB-0001'])
+        rows = self.db.view('dmscouch/all', keys=['BBB-0001', 'ADL-0001'], include_docs=True).all()
+        self.assertEqual([row['doc']['_id'] for row in rows], ['BBB-0001', 'ADL-0001'])
+        rows = self.db.view(
+            'dmscouch/search_autocomplete', startkey=['1', 'Employee', 'I'], endkey=['1', 'Employee', u'I\ufff0'],
+            group=True
+        ).all()
+        self.assertEqual([row['key'] for row in rows], [['1', 'Employee', 'Iurii']])
+        self.db.delete_doc('ADL-0001')
+        self.assertEqual(len(self.db.view('dmscouch/all').all()), 2)
+        self.assertRaises(ResourceNotFound, self.db.view('dmscouch/missing').all)
+
+    def test_shared_connection(self):
+        self.mdt_db.save_doc({'_id': 'mdt1', 'doc_type': 'MetaDataTemplate', 'docrule_id': ['1', '2']})
+        self.db.save_doc(couch_doc('ADL-0001', '1', {}))
+        rows = self.mdt_db.view('mdtcouch/docrule', key='2').all()
+        self.assertEqual([row['id'] for row in rows], ['mdt1'])
+        self.assertEqual(self.db.info()['doc_count'], 1)
+        self.assertEqual(len(self.mdt_db.changes()['results']), 1)
+
+    def test_local_database_lock(self):
+        with self.settings(COUCHDB_LOCAL_PATH=':memory:'):
+            db = local_database('dmscouch')
+            mdt_db = local_database('mdtcouch')
+        self.assertIs(db.connection, mdt_db.connection)
+        self.assertIs(db.lock, mdt_db.lock)
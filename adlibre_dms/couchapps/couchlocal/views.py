@@ -0,0 +1,115 @@
+"""
+Module: DMS local metadata backend views
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Python ports of the CouchDB design documents stored in couchapps/*/_design/views.
+Every map function here must emit exactly the same rows as its JavaScript twin,
+so please update both when changing a view.
+"""
+
+
+class View(object):
+    """A CouchDB view: map function (generator of (key, value) pairs) and optional reduce function"""
+
+    def __init__(self, map_function, reduce_function=None):
+        self.map = map_function
+        self.reduce = reduce_function
+
+
+def _active_couch_document(doc):
+    return doc.get('doc_type') == 'CouchDocument' and doc.get('deleted') != 'deleted'
+
+
+############################################ dmscouch ################################################################
+def dmscouch_all(doc):
+    if _active_couch_document(doc):
+        yield doc['_id'], {'rev': doc['_rev']}
+
+
+def dmscouch_deleted(doc):
+    if doc.get('doc_type') == 'CouchDocument' and doc.get('deleted') == 'deleted':
+        yield doc['_id'], {'rev': doc['_rev']}
+
+
+def dmscouch_deleted_files_revisions(doc):
+    if _active_couch_document(doc):
+        for revision, revision_data in (doc.get('revisions') or {}).iteritems():
+            if revision_data.get('deleted') is True:
+                yield revision, {'rev': doc['_rev'], 'deleted_revision': revision}
+
+
+def dmscouch_search(doc):
+    if _active_couch_document(doc):
+        docrule_id = doc.get('metadata_doc_type_rule_id')
+        for key, value in (doc.get('mdt_indexes') or {}).iteritems():
+            row_value = {'rev': doc['_rev'], 'metadata_doc_type_rule_id': docrule_id}
+            yield [key, value, docrule_id], row_value
+            yield [key, value, docrule_id, doc.get('metadata_created_date')], dict(row_value)
+
+
+def dmscouch_search_date(doc):
+    if _active_couch_document(doc):
+        docrule_id = doc.get('metadata_doc_type_rule_id')
+        yield [docrule_id, doc.get('metadata_created_date')], {
+            'rev': doc['_rev'],
+            'metadata_doc_type_rule_id': docrule_id,
+        }
+
+
+def dmscouch_search_main_indexes(doc):
+    if _active_couch_document(doc):
+        yield doc['_id'], {
+            'metadata_doc_type_rule_id': doc.get('metadata_doc_type_rule_id'),
+            'metadata_created_date': doc.get('metadata_created_date'),
+            'mdt_indexes': doc.get('mdt_indexes'),
+            'metadata_description': doc.get('metadata_description'),
+        }
+
+
+def dmscouch_search_autocomplete(doc):
+    if _active_couch_document(doc):
+        for key, value in (doc.get('mdt_indexes') or {}).iteritems():
+            yield [doc.get('metadata_doc_type_rule_id'), key, value], {'rev': doc['_rev']}
+
+
+def reduce_one(keys, values, rereduce):
+    return 1
+
+
+############################################ mdtcouch ################################################################
+def mdtcouch_all(doc):
+    if doc.get('doc_type') == 'MetaDataTemplate':
+        yield doc['_id'], {'rev': doc['_rev']}
+
+
+def mdtcouch_docrule(doc):
+    if doc.get('doc_type') == 'MetaDataTemplate':
+        for docrule_id in doc.get('docrule_id') or []:
+            yield docrule_id, {'rev': doc['_rev']}
+
+
+def mdtcouch_docrules_list(doc):
+    if doc.get('doc_type') == 'MetaDataTemplate':
+        yield doc['_id'], {'rev': doc['_rev'], 'docrule_id': doc.get('docrule_id')}
+
+
+# Design documents by name (== couchdbkit app label the database is registered for)
+DESIGNS = {
+    'dmscouch': {
+        'all': View(dmscouch_all),
+        'deleted': View(dmscouch_deleted),
+        'deleted_files_revisions': View(dmscouch_deleted_files_revisions),
+        'search': View(dmscouch_search),
+        'search_date': View(dmscouch_search_date),
+        'search_main_indexes': View(dmscouch_search_main_indexes),
+        'search_autocomplete': View(dmscouch_search_autocomplete, reduce_one),
+    },
+    'mdtcouch': {
+        'all': View(mdtcouch_all),
+        'docrule': View(mdtcouch_docrule),
+        'docrules_list': View(mdtcouch_docrules_list),
+    },
+}
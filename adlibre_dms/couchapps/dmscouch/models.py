@@ -14,6 +14,7 @@ from couchdbkit.ext.django.schema import DateTimeProperty
 from couchdbkit.ext.django.schema import ListProperty
 from couchdbkit.ext.django.schema import DictProperty
 from adlibre.date_converter import str_date_to_couch
+from couchlocal import connect_document
 
 
 class CouchDocument(Document):
@@ -265,3 +266,6 @@ class CouchDocument(Document):
             self.metadata_user_name = user.first_name + u' ' + user.last_name
         else:
             self.metadata_user_name = user.username
+
+
+connect_document(CouchDocument)
@@ -7,13 +7,78 @@ License: See LICENSE for license information
 Author: Iurii Garmash
 """
 
+import copy
 import logging
+import threading
+import time
+
+from django.conf import settings
 from mdtcouch.models import MetaDataTemplate
+from couchlocal import fetch_changes
 from couchdbkit.exceptions import ResourceConflict
 
 log = logging.getLogger('dms.mdtcouch.mdt_manager')
 
 
+class MetaDataTemplateCache(object):
+    """In-process cache of MDT CouchDB documents by docrule and by MDT name.
+
+    Invalidated by MetaDataTemplateManager.store()/delete_mdt() calls and by polling mdtcouch '_changes' feed
+    (not more often then settings.MDT_CACHE_CHANGES_INTERVAL seconds), so changes made by other processes are seen.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.last_seq = None
+        self.checked = 0
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.by_docrule = {}
+            self.by_name = {}
+
+    def validate(self):
+        """Drops cached MDT's in case mdtcouch database has changed since last check"""
+        interval = getattr(settings, 'MDT_CACHE_CHANGES_INTERVAL', 5)
+        now = time.time()
+        with self.lock:
+            if self.last_seq is not None and now - self.checked < interval:
+                return
+            self.checked = now
+            try:
+                changes = fetch_changes(MetaDataTemplate.get_db(), 'now' if self.last_seq is None else self.last_seq)
+            except Exception, e:
+                log.error('MetaDataTemplateCache can not read changes feed: %s' % e)
+                self.last_seq = None
+                self.clear()
+                return
+            if self.last_seq is None or changes['results']:
+                self.clear()
+            self.last_seq = changes['last_seq']
+
+    def get_docrule(self, docrule_id):
+        self.validate()
+        return self.by_docrule.get(docrule_id, None)
+
+    def set_docrule(self, docrule_id, docs):
+        with self.lock:
+            self.by_docrule[docrule_id] = docs
+            for doc in docs:
+                self.by_name[doc['_id']] = doc
+
+    def get_names(self, names_list):
+        """Returns dict of cached MDT's for names provided"""
+        self.validate()
+        return dict((name, self.by_name[name]) for name in names_list if name in self.by_name)
+
+    def set_names(self, docs):
+        with self.lock:
+            for doc in docs:
+                self.by_name[doc['_id']] = doc
+
+mdt_cache = MetaDataTemplateCache()
+
+
 class MetaDataTemplateManager(object):
     """Main DMS manager for operating with Metadata Templates.
 
@@ -34,18 +99,13 @@ class MetaDataTemplateManager(object):
         self.docrule_id = docrule_id
         # Validating
         if self.mdt_read_call_valid():
-            # Getting MDT's from DB
-            mdts_view = MetaDataTemplate.view('mdtcouch/docrule', key=docrule_id, include_docs=True)
-            # Constructing MDT's response dict
-            id = 1
-            for row in mdts_view:
-                mdts_list[str(id)] = row._doc
-                # cleaning up _id and _rev from response to unify response
-                mdts_list[str(id)]["mdt_id"] = mdts_list[str(id)]['_id']
-                del mdts_list[str(id)]['_id']
-                del mdts_list[str(id)]['_rev']
-                id+=1
-            return mdts_list
+            docs = mdt_cache.get_docrule(docrule_id)
+            if docs is None:
+                # Getting MDT's from DB
+                mdts_view = MetaDataTemplate.view('mdtcouch/docrule', key=docrule_id, include_docs=True)
+                docs = [row._doc for row in mdts_view]
+                mdt_cache.set_docrule(docrule_id, docs)
+            return self.mdts_response(docs)
         else:
             log.error('Got no mdts for docrule: %s' % docrule_id)
             return False
@@ -53,23 +113,20 @@ class MetaDataTemplateManager(object):
     def get_mdts_by_name(self, names_list):
         """ """
         log.debug('Getting MDT-s named: %s' % names_list)
-        mdts_list = {}
-        # Getting MDT's from DB
+        docs = []
         if names_list:
-            mdts_view = MetaDataTemplate.view('mdtcouch/all', keys=names_list, include_docs=True)
-        else:
-            mdts_view = None
+            cached = mdt_cache.get_names(names_list)
+            missing = [name for name in names_list if not name in cached]
+            if missing:
+                # Getting MDT's from DB
+                mdts_view = MetaDataTemplate.view('mdtcouch/all', keys=missing, include_docs=True)
+                fetched = [row._doc for row in mdts_view]
+                mdt_cache.set_names(fetched)
+                cached.update((doc['_id'], doc) for doc in fetched)
+            docs = [cached[name] for name in names_list if name in cached]
         # Constructing MDT's response dict
-        if mdts_view:
-            id = 1
-            for row in mdts_view:
-                mdts_list[str(id)] = row._doc
-                # cleaning up _id and _rev from response to unify response
-                mdts_list[str(id)]["mdt_id"] = mdts_list[str(id)]['_id']
-                del mdts_list[str(id)]['_id']
-                del mdts_list[str(id)]['_rev']
-                id+=1
-            return mdts_list
+        if docs:
+            return self.mdts_response(docs)
         else:
             log.error('Got no MDT-s from CouchDB named: %s' % names_list)
             return False
@@ -127,6 +184,7 @@ class MetaDataTemplateManager(object):
             mdt.populate_from_DMS(mdt_data)
             try:
                 mdt.save()
+                mdt_cache.clear()
                 log.debug('MetaDataTemplateManager.store added mdt with _id: %s' % mdt._id)
                 return {"status": "ok", "mdt_id": "%s" % mdt._id}
             except ResourceConflict, e:
@@ -141,11 +199,25 @@ class MetaDataTemplateManager(object):
         try:
             mdt = MetaDataTemplate.get(docid=mdt_id)
             mdt.delete()
+            mdt_cache.clear()
         except Exception, e:
             log.error("%s template with _id: %s" % (e, mdt_id))
             return False
         return True
 
+    def mdts_response(self, docs):
+        """Constructs MDT's response dict out of MDT CouchDB documents.
+
+        Documents are copied, so callers are free to modify response."""
+        mdts_list = {}
+        for id, doc in enumerate(docs, 1):
+            mdt = copy.deepcopy(doc)
+            # cleaning up _id and _rev from response to unify response
+            mdt["mdt_id"] = mdt.pop('_id')
+            del mdt['_rev']
+            mdts_list[str(id)] = mdt
+        return mdts_list
+
     def get_restricted_keys_names(self, mdts):
         """ Checking MDTs provided for locked indexes
         @param mdts is a list of MDT's for analysis
@@ -7,6 +7,7 @@ License: See LICENSE for license information
 Author: Iurii Garmash
 """
 from couchdbkit.ext.django.schema import *
+from couchlocal import connect_document
 
 
 class MetaDataTemplate(Document):
@@ -29,3 +30,6 @@ class MetaDataTemplate(Document):
         self.fields = mdt_data["fields"]
         self.parallel_keys = mdt_data["parallel"]
         return self
+
+
+connect_document(MetaDataTemplate)
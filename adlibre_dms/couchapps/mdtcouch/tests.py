@@ -10,6 +10,10 @@ import json
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 
+from couchlocal.database import LocalDatabase
+from mdt_manager import MetaDataTemplateCache
+from mdtcouch.models import MetaDataTemplate
+
 # auth user
 username = 'admin'
 password = 'admin'
@@ -189,6 +193,9 @@ class MetadataCouchDB(TestCase):
                 content_type='application/x-www-form-urlencoded',
             )
             self.assertEqual(response.status_code, 204)
+        # Cached MDT's are dropped on removal
+        response = self.client.get(url, {"docrule_id": "10000"})
+        self.assertEqual(response.status_code, 404)
 
 
 class MetadataTemplateExternalUser(TestCase):
@@ -222,3 +229,25 @@ class MetadataTemplateExternalUser(TestCase):
         url = reverse('api_mdt')
         response = self.client.post(url, {"mdt": mdt})
         self.assertEqual(response.status_code, 401)
+
+
+class MetaDataTemplateCacheTest(TestCase):
+    """In-process cache of MDT's invalidated by mdtcouch changes feed"""
+
+    def setUp(self):
+        self.db = LocalDatabase('mdtcouch_test', app_label='mdtcouch')
+        self.addCleanup(MetaDataTemplate.set_db, MetaDataTemplate.get_db())
+        MetaDataTemplate.set_db(self.db)
+
+    def test_changes_of_empty_database(self):
+        cache = MetaDataTemplateCache()
+        # Update sequence of empty database is 0
+        self.assertEqual(cache.get_docrule('1'), None)
+        self.assertEqual(cache.last_seq, 0)
+        cache.set_docrule('1', [])
+        self.assertEqual(cache.get_docrule('1'), [])
+        self.db.save_doc({'_id': 'mdt1', 'doc_type': 'MetaDataTemplate', 'docrule_id': ['1']})
+        # Saved by other process
+        cache.checked = 0
+        self.assertEqual(cache.get_docrule('1'), None)
+        self.assertEqual(cache.last_seq, 1)
@@ -6,10 +6,19 @@ License: See LICENSE for license information
 """
 
 import os
+import time
+import shutil
+import logging
+import threading
 from subprocess import Popen, PIPE
 import magic
 import tempfile
 
+log = logging.getLogger('adlibre.converter')
+
+# Size of file parts copied at once
+CHUNK_SIZE = 64 * 1024
+
 # FIXME: All of these converters write their temp file into the repository! This is a bad idea.
 # FIXME: These should work with a fileobject, not filepath!
 
@@ -74,62 +83,215 @@ class FileConverter:
         return ['application/pdf', content]
 
 
+class ConversionError(Exception):
+    pass
+
+
+class ConversionTimeout(ConversionError):
+    pass
+
+
+class ConversionExecutor(object):
+    """Runs converter commands, at most max_processes of them at once, killing ones running over timeout seconds.
+
+    Commands wait for a free slot in calling thread. Metrics of the executor are counters of jobs
+    queued (waiting for a slot), running, completed, failed and timed out, and seconds jobs waited for a slot."""
+
+    def __init__(self, max_processes=2, timeout=60):
+        self.max_processes = max_processes
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_processes)
+        self.lock = threading.Lock()
+        self.metrics = {
+            'queued': 0,
+            'running': 0,
+            'completed': 0,
+            'failed': 0,
+            'timed_out': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+        }
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+        metrics['max_processes'] = self.max_processes
+        return metrics
+
+    def update_metrics(self, **changes):
+        with self.lock:
+            for name, change in changes.iteritems():
+                self.metrics[name] += change
+
+    def run(self, commands, stdin=None, stdout=None):
+        """Runs commands (argument lists) as a pipeline, each one reading output of the previous one.
+
+        @param stdin: file the first command reads, or None for no input
+        @param stdout: file the last command writes to, or None to discard it's output"""
+        queued = time.time()
+        self.update_metrics(queued=1)
+        self.slots.acquire()
+        try:
+            waited = time.time() - queued
+            with self.lock:
+                self.metrics['queued'] -= 1
+                self.metrics['running'] += 1
+                self.metrics['wait_time'] += waited
+                self.metrics['max_wait_time'] = max(self.metrics['max_wait_time'], waited)
+            if waited >= 1:
+                log.info('Conversion %s waited %.1f seconds for a free converter process' % (commands[0][0], waited))
+            try:
+                self.execute(commands, stdin, stdout)
+            except ConversionTimeout:
+                self.update_metrics(timed_out=1)
+                raise
+            except ConversionError:
+                self.update_metrics(failed=1)
+                raise
+            self.update_metrics(completed=1)
+        finally:
+            self.update_metrics(running=-1)
+            self.slots.release()
+
+    def execute(self, commands, stdin, stdout):
+        processes = []
+        errors = tempfile.TemporaryFile()
+        devnull = None
+        if stdin is None or stdout is None:
+            devnull = open(os.devnull, 'r+b')
+        try:
+            for number, command in enumerate(commands):
+                if processes:
+                    process_stdin = processes[-1].stdout
+                else:
+                    process_stdin = stdin or devnull
+                if number == len(commands) - 1:
+                    process_stdout = stdout or devnull
+                else:
+                    process_stdout = PIPE
+                try:
+                    process = Popen(command, stdin=process_stdin, stdout=process_stdout, stderr=errors, close_fds=True)
+                except OSError, e:
+                    self.kill(processes)
+                    raise ConversionError('Converter %s can not be started: %s' % (command[0], e))
+                if processes:
+                    # Previous command gets SIGPIPE if this one exits early
+                    processes[-1].stdout.close()
+                processes.append(process)
+        finally:
+            if devnull is not None:
+                devnull.close()
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            self.kill(processes)
+
+        timer = threading.Timer(self.timeout, kill)
+        timer.start()
+        try:
+            codes = [process.wait() for process in processes]
+        finally:
+            timer.cancel()
+        if timed_out:
+            raise ConversionTimeout('Conversion %s timed out after %s seconds' % (commands[0][0], self.timeout))
+        for command, code in zip(commands, codes):
+            if code:
+                errors.seek(0)
+                raise ConversionError('Converter %s exited with code %s: %s' % (command[0], code, errors.read(1024)))
+
+    def kill(self, processes):
+        for process in processes:
+            try:
+                process.kill()
+            except OSError:
+                # Already finished
+                pass
+
+
+default_executor = ConversionExecutor()
+
+
 class NewFileConverter(object):
-    """Convert file from one mimetype to another mimetype"""
+    """Convert file from one mimetype to another mimetype
 
-    def __init__(self, file_obj, file_path, extension):
+    Stored (uncompressed) files are read by converters directly from file_path, other file objects
+    (e.g. decompressed ones) are copied to a temporary file first. Converters write to their stdout,
+    straight into output file given to convert() or a temporary file.
+
+    External converters are run by executor, module default_executor if not given."""
+
+    def __init__(self, file_obj, file_path, extension, executor=None):
         self.file_obj = file_obj
         self.filepath = file_path
         self.filename = os.path.basename(self.filepath)
-        self.document = os.path.splitext(self.filename)[0]
-
-        self.temp_input = tempfile.NamedTemporaryFile()
-        self.file_obj.seek(0)
-        self.temp_input.write(self.file_obj.read())
-        self.temp_input.seek(0)
+        self.document, extension_from = os.path.splitext(self.filename)
+        self.executor = executor or default_executor
+        self.temp_input = None
+        self.output = None
 
+        self.extension_from = extension_from.strip(".")
         self.extension_to = extension
 
-    def convert(self):
-        document, extension = os.path.splitext(self.filename)
-        extension_from = extension.strip(".")
+    def get_conversion(self):
+        return getattr(self, '%s_to_%s' % (self.extension_from, self.extension_to), None)
 
-        if self.extension_to is None or self.extension_to == extension_from:
+    def can_convert(self):
+        """Tells if file will be converted by an external converter"""
+        return self.extension_to not in (None, self.extension_from) and self.get_conversion() is not None
+
+    def convert(self, output=None):
+        """Returns mimetype and file object of converted file, or None, None for unsupported conversion
+
+        @param output: real file, opened for writing and reading, converted file is written to"""
+        if self.extension_to is None or self.extension_to == self.extension_from:
+            self.file_obj.seek(0)
+            content = self.file_obj.read(1024)
             self.file_obj.seek(0)
-            content = self.file_obj.read()
             mime = magic.Magic( mime = True )
             mimetype = mime.from_buffer( content )
             return [mimetype, self.file_obj]
-        try:
-            #print "from: %s, to: %s" % (extension_from, self.extension_to)
-            func = getattr(self, '%s_to_%s' % (extension_from, self.extension_to))
-            return func()
-        except AttributeError:
+        func = self.get_conversion()
+        if func is None:
             return (None, None)
+        self.output = output
+        return func()
 
-    def do_convert(self, command):
-        from_path = self.temp_input.name
-        temp_output = tempfile.NamedTemporaryFile()
-        to_path = temp_output.name
-        p = Popen(command % {'to': to_path, 'from': from_path}, shell=True, stdout=PIPE, stderr=PIPE)
-        #print command % {'to': to_path, 'from': from_path}
-        stdout, stderr = p.communicate()
-        temp_output.seek(0)
-        return temp_output
+    def get_input_path(self):
+        if isinstance(self.file_obj, file) and os.path.abspath(self.file_obj.name) == os.path.abspath(self.filepath):
+            return self.filepath
+        if self.temp_input is None:
+            self.temp_input = tempfile.NamedTemporaryFile()
+            self.file_obj.seek(0)
+            shutil.copyfileobj(self.file_obj, self.temp_input, CHUNK_SIZE)
+            self.temp_input.flush()
+        return self.temp_input.name
+
+    def do_convert(self, *commands):
+        """Runs commands pipeline, substituting %(from)s arguments with input file path.
+
+        Last command must write converted file to it's stdout."""
+        output = self.output or tempfile.TemporaryFile()
+        paths = {'from': self.get_input_path()}
+        self.executor.run([[argument % paths for argument in command] for command in commands], stdout=output)
+        output.seek(0)
+        return output
 
     def tif_to_pdf(self):
         """tiff to pdf conversion, use tiff2pdf command (libtiff)"""
-        file_obj = self.do_convert('tiff2pdf -o %(to)s %(from)s')
+        file_obj = self.do_convert(['tiff2pdf', '%(from)s'])
         return ['application/pdf', file_obj]
 
     def pdf_to_txt(self):
         """pdf to txt conversion, use pdftotext command (poppler)"""
-        file_obj = self.do_convert('pdftotext -enc Latin1 %(from)s %(to)s')
+        file_obj = self.do_convert(['pdftotext', '-enc', 'Latin1', '%(from)s', '-'])
         return ['text/plain', file_obj]
 
-
     def txt_to_pdf(self):
         """text to pdf conversion, use a2ps and ps2pdf command (a2ps & ghostscript)"""
-        file_obj = self.do_convert('a2ps --quiet --portrait --columns=1 --rows=1 -L 100 --no-header --borders=off -o - %(from)s | ps2pdf -sPAPERSIZE=a4 - %(to)s')
+        file_obj = self.do_convert(
+            ['a2ps', '--quiet', '--portrait', '--columns=1', '--rows=1', '-L', '100', '--no-header',
+             '--borders=off', '-o', '-', '%(from)s'],
+            ['ps2pdf', '-sPAPERSIZE=a4', '-', '-'],
+        )
         return ['application/pdf', file_obj]
-
@@ -51,6 +51,12 @@ else:
         ('mdtcouch', 'http://127.0.0.1:5984/mdtcouch'),
     )
 COUCHDB_COMPACT = False
+# Metadata storage backend: 'couchdb' (server above), 'local' (in-process SQLite emulating DMS CouchDB views)
+# or dotted path to a callable(app_label) returning couchdbkit Database compatible object.
+COUCHDB_BACKEND = 'couchdb'
+COUCHDB_LOCAL_PATH = os.path.join(LIBRARY_PATH, '..', 'db', 'couchlocal.sqlite')
+# Seconds between mdtcouch '_changes' feed checks of in-process Metadata Templates cache
+MDT_CACHE_CHANGES_INTERVAL = 5
 
 # Required for using password (adlibre.auth) app
 # We must override with real email server at Production
@@ -94,6 +100,10 @@ USE_L10N = True
 # Example: "/home/media/media.lawrence.com/media/"
 MEDIA_ROOT = os.path.join(LIBRARY_PATH, '..', 'www', 'media')
 DOCUMENT_ROOT = os.path.join(LIBRARY_PATH, '..', 'documents')
+# Store identical files contents once, as hard links to blobs in DOCUMENT_ROOT/DOCUMENT_BLOBS_DIRECTORY.
+# Requires a file system supporting hard links.
+DOCUMENT_DEDUPLICATION = False
+DOCUMENT_BLOBS_DIRECTORY = '.blobs'
 FIXTURE_DIRS = (os.path.join(LIBRARY_PATH, '..', 'fixtures'), )
 
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
@@ -225,7 +235,10 @@ INSTALLED_APPS = (
     'compressor',  # MUI js / css compression
     'django-log-file-viewer',
     'south',
-) + PROJECT_APPS + ADDITIONAL_APPS
+) + PROJECT_APPS + ADDITIONAL_APPS + (
+    # API tokens. Installed last, not to shift content types of other apps referenced by fixtures.
+    'rest_framework.authtoken',
+)
 
 # FILE_UPLOAD_HANDLERS is only necessary if you want to track upload
 # progress in your Django app -- if you have a front-end proxy like
@@ -461,6 +474,96 @@ DATE_COUCHDB_FORMAT = "%Y-%m-%dT00:00:00Z"
 # Pagination of MUI search results to be overridden if needed.
 MUI_SEARCH_PAGINATE = 20
 MUI_SEARCH_PAGINATOR_PAGE_SEPARATOR = '...'
+# Seconds to cache document types permitted to a user (changes of permissions and groups invalidate it).
+PERMITTED_DOCRULES_CACHE_TIMEOUT = 300
+
+# Compression plugin stores files of those mimetypes and files whose first COMPRESSION_SAMPLE_SIZE bytes
+# compress by less then COMPRESSION_MIN_SAVING fraction uncompressed.
+COMPRESSION_SKIP_MIMETYPES = (
+    'image/jpeg',
+    'image/png',
+    'image/gif',
+    'application/zip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-rar',
+    'application/x-7z-compressed',
+    'audio/mpeg',
+    'video/mp4',
+    'video/mpeg',
+)
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MIN_SAVING = 0.03
+# Size of independently compressed parts of files stored with 'CHUNKED' compression type.
+COMPRESSION_CHUNK_SIZE = 256 * 1024
+
+# Seconds to keep hashcodes of stored files verified on retrieval (until the file is modified).
+HASHCODE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Background jobs queue backend: 'local' (SQLite file JOBS_LOCAL_PATH)
+# or dotted path to a callable returning core.jobs.LocalJobQueue compatible object.
+JOBS_BACKEND = 'local'
+JOBS_LOCAL_PATH = os.path.join(LIBRARY_PATH, '..', 'db', 'jobs.sqlite')
+# Thumbnails pre-generation by 'thumbnails_worker' command: processes, attempts per document
+# and seconds after which a running job is considered abandoned by a killed worker.
+THUMBNAILS_WORKER_PROCESSES = 2
+THUMBNAILS_JOB_ATTEMPTS = 3
+THUMBNAILS_JOB_TIMEOUT = 600
+# Thumbnails sizes (width, height) by name requested with 'size' API parameter,
+# maximum conversions running at once in a process and seconds before a conversion is killed.
+THUMBNAILS_SIZES = {
+    'default': (64, 64),
+    'large': (256, 256),
+}
+THUMBNAILS_MAX_PROCESSES = 2
+THUMBNAILS_TIMEOUT = 30
+# Seconds API basic auth credentials stay verified, skipping password hashing on repeated requests.
+API_AUTH_CACHE_TIMEOUT = 60
+# Accept 'Authorization: Token <key>' API requests, with keys of rest_framework.authtoken tokens.
+API_TOKEN_AUTHENTICATION = False
+# Maximum number of codes in one batch thumbnails API request.
+API_THUMBNAILS_BATCH_LIMIT = 100
+# Maximum number of codes in one batch file info API request.
+API_FILE_INFO_BATCH_LIMIT = 100
+# Threads loading file revisions data files of documents read together.
+METADATA_READ_THREADS = 8
+# Maximum number of files (archive contents included) in one batch upload API request.
+API_BATCH_UPLOAD_LIMIT = 200
+# Maximum total size in bytes of files extracted from archives of one batch upload API request.
+API_BATCH_UPLOAD_ARCHIVE_MAX_SIZE = 1024 * 1024 * 1024
+# Request content types of archive streams accepted by batch upload API, with their file extensions.
+API_BATCH_UPLOAD_ARCHIVE_TYPES = {
+    'application/zip': '.zip',
+    'application/x-tar': '.tar',
+    'application/x-gzip': '.tar.gz',
+    'application/gzip': '.tar.gz',
+}
+# Threads creating documents of one batch upload. Tests use 1, in-memory SQLite database is not shared by threads.
+DOCUMENT_BATCH_THREADS = 4
+# Files converted by 'File Type Converter' plugin are cached in DOCUMENT_ROOT/CONVERSIONS_CACHE_DIRECTORY,
+# least recently used ones are removed when cache grows over CONVERSIONS_CACHE_SIZE bytes.
+CONVERSIONS_CACHE_DIRECTORY = '.conversions'
+CONVERSIONS_CACHE_SIZE = 512 * 1024 * 1024
+# Maximum external converters running at once in a process and seconds before a conversion is killed.
+CONVERSIONS_MAX_PROCESSES = 2
+CONVERSIONS_TIMEOUT = 60
+# Pre-rendering of conversions by 'conversions_worker' command: processes, attempts per document
+# and seconds after which a running job is considered abandoned by a killed worker.
+CONVERSIONS_WORKER_PROCESSES = 2
+CONVERSIONS_JOB_ATTEMPTS = 3
+CONVERSIONS_JOB_TIMEOUT = 600
+# Files uploaded through API with 'async' parameter are staged in DOCUMENT_ROOT/UPLOADS_STAGING_DIRECTORY
+# until 'uploads_worker' processes them. Staged files are removed after processing, so jobs are not retried.
+UPLOADS_STAGING_DIRECTORY = '.staging'
+UPLOADS_WORKER_PROCESSES = 2
+UPLOADS_JOB_ATTEMPTS = 1
+UPLOADS_JOB_TIMEOUT = 3600
+
+# Indexing/search forms autocomplete: maximum suggestions, prefix results LRU cache size
+# and seconds between dmscouch '_changes' feed checks of in-process prefix index.
+AUTOCOMPLETE_SUGGESTIONS_LIMIT = 8
+AUTOCOMPLETE_CACHE_SIZE = 1000
+AUTOCOMPLETE_CHANGES_INTERVAL = 5
 
 DEMO = True
 NEW_SYSTEM = False